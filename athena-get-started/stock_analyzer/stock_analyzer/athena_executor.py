@@ -0,0 +1,464 @@
+import io
+import random
+import statistics
+import time
+from collections import deque
+
+from athena_results import athena_csv_to_batches, athena_rows_to_df, read_athena_csv_rows
+from query_metrics import athena_query_metrics, emit_metrics
+
+ATHENA_ACTIVE_STATES = ['QUEUED', 'RUNNING']
+
+# Total execution times (ms) of recent runs per query text. The dict lives
+# at module level, so it survives across warm invocations of the Lambda
+# and seeds the polling schedule of the next run of the same query.
+_query_runtime_history = {}
+QUERY_RUNTIME_HISTORY_SIZE = 10
+# Runs of a single-flight follower whose shared query was cancelled by its owner
+SINGLE_FLIGHT_ATTEMPTS = 3
+
+
+class QueryCancelled(Exception):
+    pass
+
+
+class NoResultReuse:
+    def start_query_execution_kwargs(self):
+        return {}
+
+
+class ResultReuseByAge:
+    def __init__(self, max_age_in_minutes=1):
+        self.max_age_in_minutes = max_age_in_minutes
+
+    def start_query_execution_kwargs(self):
+        return {
+            'ResultReuseConfiguration': {
+                'ResultReuseByAgeConfiguration': {
+                    'Enabled': True,
+                    'MaxAgeInMinutes': self.max_age_in_minutes
+                }
+            }
+        }
+
+
+class AthenaQueryExecutor:
+    """Starts Athena queries, waits for them to finish and fetches their results.
+
+    Polling uses exponential backoff with jitter. The first poll is delayed
+    by most of the median runtime of previous runs of the same query, so
+    slow queries don't burn GetQueryExecution calls and fast ones are
+    picked up within a few tens of milliseconds. When a deadline is given,
+    a query that is still running at the deadline is stopped and
+    TimeoutError is raised.
+
+    Results are fetched with GetQueryResults paging, 1000 rows per call.
+    When an s3_client is given and the result CSV in the workgroup output
+    location is larger than direct_download_threshold_bytes, the CSV is
+    instead streamed with a single S3 GET. fetch_page() fetches a bounded
+    slice of the results that a later call can resume from, from the CSV
+    too when it is that large.
+
+    Every query logs its Statistics, client-side start, poll and fetch
+    times and an estimated cost as CloudWatch EMF metrics in
+    metrics_namespace, with the query_name given to execute() as dimension.
+    athena_fanout.AthenaFanOut runs many queries concurrently on top of it.
+    """
+
+    def __init__(
+            self,
+            athena_client,
+            database_name,
+            workgroup='primary',
+            catalog_id='AwsDataCatalog',
+            result_reuse_policy=None,
+            min_poll_interval_ms=50,
+            max_poll_interval_ms=2000,
+            deadline_margin_ms=3000,
+            s3_client=None,
+            direct_download_threshold_bytes=1024 * 1024,
+            metrics_namespace='StockAnalyzer/Athena',
+            debug=False
+    ):
+        self.athena_client = athena_client
+        self.database_name = database_name
+        self.workgroup = workgroup
+        self.catalog_id = catalog_id
+        self.result_reuse_policy = result_reuse_policy or NoResultReuse()
+        self.min_poll_interval_ms = min_poll_interval_ms
+        self.max_poll_interval_ms = max_poll_interval_ms
+        self.deadline_margin_ms = deadline_margin_ms
+        self.s3_client = s3_client
+        self.direct_download_threshold_bytes = direct_download_threshold_bytes
+        self.metrics_namespace = metrics_namespace
+        self.debug = debug
+
+    def execute(
+            self,
+            query,
+            parameters=None,
+            context=None,
+            result_reuse_policy=None,
+            query_name=None,
+            timeout_seconds=None,
+            single_flight_claim=None
+    ):
+        """Run the query to completion and return its QueryExecution.
+
+        The query is stopped at the Lambda deadline from context or after
+        timeout_seconds, whichever comes first. Callers with claims of the
+        same single_flight.S3SingleFlight key share one execution. Its owner
+        releases the claim and stops it at the owner's deadline, the others
+        leave it running and raise TimeoutError at theirs. A follower whose
+        query was stopped by the owner claims the key again and retries.
+        The returned QueryExecution has an extra 'ClientStatistics' entry
+        with the query_name and the client-side timings.
+        """
+        deadline = self.deadline_from_context(context)
+        if timeout_seconds is not None:
+            timeout_deadline = time.monotonic() + timeout_seconds
+            deadline = timeout_deadline if deadline is None else min(deadline, timeout_deadline)
+        claim = single_flight_claim
+        for attempt in range(1, SINGLE_FLIGHT_ATTEMPTS + 1):
+            started_at = time.monotonic()
+            query_execution_id = self.start(
+                query, parameters, result_reuse_policy, claim.token if claim else None
+            )
+            start_ms = (time.monotonic() - started_at) * 1000
+            try:
+                query_execution = self.wait(
+                    query_execution_id, query=query, deadline=deadline, stop_at_deadline=False
+                )
+                break
+            except TimeoutError:
+                # The claim goes first, so followers that see the query
+                # cancelled don't get the same token again
+                if claim is not None:
+                    claim.release()
+                if claim is None or claim.is_owner:
+                    self.athena_client.stop_query_execution(QueryExecutionId=query_execution_id)
+                raise
+            except QueryCancelled:
+                if claim is None or claim.is_owner or attempt == SINGLE_FLIGHT_ATTEMPTS:
+                    raise
+                print(f'Query {query_execution_id} was stopped by its single-flight owner, retrying')
+                claim = claim.reclaim()
+            except Exception:
+                if claim is not None:
+                    claim.release()
+                raise
+        query_execution['ClientStatistics'].update({
+            'QueryName': query_name or 'unnamed',
+            'StartMillis': start_ms,
+        })
+        self.emit_query_metrics(query_execution)
+        return query_execution
+
+    def execute_named(self, named_query, parameter_values, context=None, single_flight_claim=None):
+        """Run a query_registry.NamedQuery with its reuse and timeout settings."""
+        return self.execute(
+            **self.named_query_kwargs(named_query, parameter_values),
+            context=context,
+            single_flight_claim=single_flight_claim
+        )
+
+    def named_query_kwargs(self, named_query, parameter_values):
+        """Arguments of execute() for a query_registry.NamedQuery."""
+        if named_query.result_reuse_max_age_minutes is None:
+            result_reuse_policy = NoResultReuse()
+        else:
+            result_reuse_policy = ResultReuseByAge(named_query.result_reuse_max_age_minutes)
+        return {
+            'query': named_query.execute_statement,
+            'parameters': named_query.execution_parameters(parameter_values),
+            'result_reuse_policy': result_reuse_policy,
+            'query_name': named_query.name,
+            'timeout_seconds': named_query.timeout_seconds,
+        }
+
+    def start(self, query, parameters=None, result_reuse_policy=None, client_request_token=None):
+        if self.debug:
+            print(f'Query: {query}')
+        result_reuse_policy = result_reuse_policy or self.result_reuse_policy
+        optional_kwargs = {}
+        if parameters is not None:
+            optional_kwargs['ExecutionParameters'] = parameters
+        if client_request_token is not None:
+            # Athena returns the execution of an earlier request with the same token
+            optional_kwargs['ClientRequestToken'] = client_request_token
+        response = self.athena_client.start_query_execution(
+            QueryString=query,
+            QueryExecutionContext={
+                'Catalog': self.catalog_id,
+                'Database': self.database_name
+            },
+            WorkGroup=self.workgroup,
+            **optional_kwargs,
+            **result_reuse_policy.start_query_execution_kwargs()
+        )
+        query_execution_id = response['QueryExecutionId']
+        print(f'QueryExecutionId: {query_execution_id}')
+        return query_execution_id
+
+    def wait(self, query_execution_id, query=None, deadline=None, stop_at_deadline=True):
+        """Poll the query until it leaves the active states.
+
+        deadline is a time.monotonic() timestamp; None means no deadline.
+        """
+        started_at = time.monotonic()
+        for poll_count, delay_ms in enumerate(self.poll_delays_ms(query), start=1):
+            query_execution = self.athena_client.get_query_execution(
+                QueryExecutionId=query_execution_id
+            )['QueryExecution']
+            query_status = query_execution['Status']['State']
+            if self.debug:
+                print(f'Query status: {query_status}')
+            if query_status not in ATHENA_ACTIVE_STATES:
+                break
+            if deadline is not None:
+                remaining_ms = (deadline - time.monotonic()) * 1000
+                if remaining_ms <= 0:
+                    if stop_at_deadline:
+                        self.athena_client.stop_query_execution(
+                            QueryExecutionId=query_execution_id
+                        )
+                    raise TimeoutError(
+                        f'Query {query_execution_id} did not finish before the deadline'
+                    )
+                # Make the last poll land right on the deadline
+                delay_ms = min(delay_ms, remaining_ms)
+            time.sleep(delay_ms / 1000)
+        return self.finish_wait(query_execution, query, started_at, poll_count)
+
+    def finish_wait(self, query_execution, query, started_at, poll_count):
+        """Check the final state of a polled query and record its poll statistics."""
+        query_status = query_execution['Status']['State']
+        if query_status != 'SUCCEEDED':
+            reason = query_execution['Status'].get('StateChangeReason', '')
+            if query_status == 'CANCELLED':
+                raise QueryCancelled(f'Query status: {query_status}\n{reason}')
+            raise Exception(f'Query status: {query_status}\n{reason}')
+        query_statistics = query_execution.get('Statistics', {})
+        print(
+            f'Query {query_execution["QueryExecutionId"]} scanned '
+            f'{query_statistics.get("DataScannedInBytes")} bytes '
+            f'in {query_statistics.get("TotalExecutionTimeInMillis")} ms'
+        )
+        if query is not None:
+            record_query_runtime(query, query_execution)
+        query_execution['ClientStatistics'] = {
+            'PollMillis': (time.monotonic() - started_at) * 1000,
+            'PollCount': poll_count,
+        }
+        return query_execution
+
+    def emit_query_metrics(self, query_execution):
+        client_statistics = query_execution['ClientStatistics']
+        emit_metrics(
+            namespace=self.metrics_namespace,
+            dimensions={'QueryName': client_statistics['QueryName']},
+            metrics={
+                **athena_query_metrics(query_execution),
+                'ClientStartMillis': (client_statistics['StartMillis'], 'Milliseconds'),
+                'ClientPollMillis': (client_statistics['PollMillis'], 'Milliseconds'),
+                'ClientPollCount': (client_statistics['PollCount'], 'Count'),
+            },
+            properties={'QueryExecutionId': query_execution['QueryExecutionId']}
+        )
+
+    def poll_delays_ms(self, query=None):
+        """Yield the delays to sleep between consecutive polls."""
+        expected_runtime_ms = expected_query_runtime_ms(query)
+        if expected_runtime_ms is not None:
+            # Sleep through most of the expected runtime first
+            yield max(expected_runtime_ms * 0.8, self.min_poll_interval_ms)
+        delay_ms = self.min_poll_interval_ms
+        while True:
+            # "Equal jitter": keep half of the backoff and randomize the rest
+            yield delay_ms / 2 + random.uniform(0, delay_ms / 2)
+            delay_ms = min(delay_ms * 2, self.max_poll_interval_ms)
+
+    def deadline_from_context(self, context):
+        if context is None:
+            return None
+        remaining_ms = context.get_remaining_time_in_millis() - self.deadline_margin_ms
+        return time.monotonic() + max(remaining_ms, 0) / 1000
+
+    def iter_batches(self, query_execution, page_size=1000):
+        """Yield the query results as typed DataFrame batches."""
+        started_at = time.monotonic()
+        output_object = self.large_output_object(query_execution)
+        if output_object is not None:
+            fetch_source = 'output'
+            bucket_name, s3_key, _ = output_object
+            batches = self.iter_batches_from_output(query_execution, bucket_name, s3_key)
+        else:
+            fetch_source = 'pages'
+            batches = self.iter_batches_from_pages(query_execution, page_size)
+
+        # Only the time spent fetching and decoding counts,
+        # not the time the caller spends on each batch
+        fetch_seconds = time.monotonic() - started_at
+        row_count = 0
+        while True:
+            started_at = time.monotonic()
+            batch = next(batches, None)
+            fetch_seconds += time.monotonic() - started_at
+            if batch is None:
+                break
+            row_count += len(batch)
+            yield batch
+
+        self.emit_fetch_metrics(
+            query_name=query_execution.get('ClientStatistics', {}).get('QueryName'),
+            query_execution_id=query_execution['QueryExecutionId'],
+            fetch_ms=fetch_seconds * 1000,
+            row_count=row_count,
+            fetch_source=fetch_source
+        )
+
+    def get_query_execution(self, query_execution_id):
+        return self.athena_client.get_query_execution(QueryExecutionId=query_execution_id)['QueryExecution']
+
+    def fetch_page(self, query_execution, max_rows, next_token=None, query_name=None):
+        """Fetch up to max_rows result rows, resuming from next_token.
+
+        Returns (batches, next_token) where next_token is None after the last
+        row. Like iter_batches, results larger than direct_download_threshold_bytes
+        are read from the result CSV, with a ranged GET from the byte offset
+        of the page, and next_token is the (int) offset of the next page.
+        Otherwise they are read with GetQueryResults and next_token is its
+        NextToken. Both stay valid as long as the query results, so a later
+        call resumes where this one stopped without re-running the query.
+        """
+        started_at = time.monotonic()
+        output_object = None
+        if next_token is None or isinstance(next_token, int):
+            output_object = self.large_output_object(query_execution)
+        if output_object is not None:
+            fetch_source = 'output'
+            batches, next_token = self.fetch_page_from_output(
+                query_execution, *output_object, max_rows, next_token or 0
+            )
+        else:
+            fetch_source = 'page'
+            batches, next_token = self.fetch_page_from_pages(query_execution, max_rows, next_token)
+        self.emit_fetch_metrics(
+            query_name=query_name,
+            query_execution_id=query_execution['QueryExecutionId'],
+            fetch_ms=(time.monotonic() - started_at) * 1000,
+            row_count=sum(len(batch) for batch in batches),
+            fetch_source=fetch_source
+        )
+        return batches, next_token
+
+    def fetch_page_from_pages(self, query_execution, max_rows, next_token=None):
+        batches = []
+        row_count = 0
+        is_first_page = next_token is None
+        while row_count < max_rows:
+            token_kwargs = {'NextToken': next_token} if next_token else {}
+            response = self.athena_client.get_query_results(
+                QueryExecutionId=query_execution['QueryExecutionId'],
+                # The first page also has the header row
+                MaxResults=min(1000, max_rows - row_count + int(is_first_page)),
+                **token_kwargs
+            )
+            column_info = response['ResultSet']['ResultSetMetadata']['ColumnInfo']
+            rows = response['ResultSet']['Rows']
+            if is_first_page:
+                rows = rows[1:]
+                is_first_page = False
+            batches.append(athena_rows_to_df(column_info, rows))
+            row_count += len(rows)
+            next_token = response.get('NextToken')
+            if next_token is None:
+                break
+        return batches, next_token
+
+    def fetch_page_from_output(self, query_execution, bucket_name, s3_key, output_size, max_rows, offset):
+        column_info = self.athena_client.get_query_results(
+            QueryExecutionId=query_execution['QueryExecutionId'],
+            MaxResults=1
+        )['ResultSet']['ResultSetMetadata']['ColumnInfo']
+        body = self.s3_client.get_object(Bucket=bucket_name, Key=s3_key, Range=f'bytes={offset}-')['Body']
+        is_first_page = offset == 0
+        try:
+            # The first page also has the header row
+            page_csv = read_athena_csv_rows(body, max_rows + int(is_first_page))
+        finally:
+            # The rest of the object is not read
+            body.close()
+        next_offset = offset + len(page_csv)
+        batches = list(athena_csv_to_batches(io.BytesIO(page_csv), column_info, has_header=is_first_page))
+        return batches, next_offset if next_offset < output_size else None
+
+    def large_output_object(self, query_execution):
+        """Return (bucket, key, size) of the result CSV if it is worth reading from S3, else None."""
+        output_location = query_execution.get('ResultConfiguration', {}).get('OutputLocation')
+        if self.s3_client is None or not output_location or not output_location.endswith('.csv'):
+            return None
+        bucket_name, s3_key = output_location[len('s3://'):].split('/', 1)
+        output_size = self.s3_client.head_object(Bucket=bucket_name, Key=s3_key)['ContentLength']
+        if output_size <= self.direct_download_threshold_bytes:
+            return None
+        return bucket_name, s3_key, output_size
+
+    def emit_fetch_metrics(self, query_name, query_execution_id, fetch_ms, row_count, fetch_source):
+        emit_metrics(
+            namespace=self.metrics_namespace,
+            dimensions={'QueryName': query_name or 'unnamed'},
+            metrics={
+                'ClientFetchMillis': (fetch_ms, 'Milliseconds'),
+                'ResultRows': (row_count, 'Count'),
+            },
+            properties={
+                'QueryExecutionId': query_execution_id,
+                'FetchSource': fetch_source
+            }
+        )
+
+    def iter_batches_from_pages(self, query_execution, page_size=1000):
+        """Yield one typed DataFrame per GetQueryResults page."""
+        response_iterator = self.athena_client.get_paginator('get_query_results').paginate(
+            QueryExecutionId=query_execution['QueryExecutionId'],
+            PaginationConfig={'PageSize': page_size}
+        )
+        is_first_page = True
+        for page in response_iterator:
+            column_info = page['ResultSet']['ResultSetMetadata']['ColumnInfo']
+            rows = page['ResultSet']['Rows']
+            if is_first_page:
+                # Only the first page starts with the header row
+                rows = rows[1:]
+                is_first_page = False
+            yield athena_rows_to_df(column_info, rows)
+
+    def iter_batches_from_output(self, query_execution, bucket_name, s3_key):
+        """Yield typed DataFrames parsed from the result CSV streamed from S3."""
+        if self.debug:
+            print(f'Downloading results from s3://{bucket_name}/{s3_key}')
+        # The CSV has no types, so take them from a one-row GetQueryResults call
+        column_info = self.athena_client.get_query_results(
+            QueryExecutionId=query_execution['QueryExecutionId'],
+            MaxResults=1
+        )['ResultSet']['ResultSetMetadata']['ColumnInfo']
+        body = self.s3_client.get_object(Bucket=bucket_name, Key=s3_key)['Body']
+        yield from athena_csv_to_batches(body, column_info)
+
+
+def expected_query_runtime_ms(query):
+    history = _query_runtime_history.get(query)
+    if not history:
+        return None
+    return statistics.median(history)
+
+
+def record_query_runtime(query, query_execution):
+    runtime_ms = query_execution.get('Statistics', {}).get('TotalExecutionTimeInMillis')
+    if runtime_ms is None:
+        return
+    history = _query_runtime_history.setdefault(
+        query, deque(maxlen=QUERY_RUNTIME_HISTORY_SIZE)
+    )
+    history.append(runtime_ms)
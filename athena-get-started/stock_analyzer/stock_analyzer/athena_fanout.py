@@ -0,0 +1,296 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from athena_executor import ATHENA_ACTIVE_STATES, SINGLE_FLIGHT_ATTEMPTS, QueryCancelled
+
+# BatchGetQueryExecution takes at most 50 query execution ids per call
+BATCH_GET_QUERY_EXECUTION_SIZE = 50
+
+
+class AthenaFanOut:
+    """Runs many Athena queries at once and resolves one Future per query.
+
+    submit() returns a concurrent.futures.Future right away; asyncio code
+    can await it with asyncio.wrap_future(). The queries are started in
+    parallel on a thread pool. A single poller thread tracks all running
+    queries with BatchGetQueryExecution, each query on its own backoff
+    schedule from AthenaQueryExecutor.poll_delays_ms(), so one call polls
+    every query that is due. The results of a finished query are fetched
+    on the thread pool while the others are still running, so a group of
+    queries takes about as long as the slowest of them, not their sum.
+
+    A future resolves to (query_execution, batches), batches being the
+    typed DataFrames of AthenaQueryExecutor.iter_batches(), or raises the
+    error of its query. A query still running at the Lambda deadline from
+    context or after its timeout_seconds raises TimeoutError. Queries with
+    a single_flight_claim follow AthenaQueryExecutor.execute: only the owner
+    of the claim stops the query, and a follower whose query was stopped
+    claims the key again and restarts it. Ids that BatchGetQueryExecution
+    leaves unprocessed back off and time out the same way, and an error of
+    the poller itself fails the futures of all running queries.
+    seconds_to_deadline() is the timeout for waiting on a future.
+
+    Use it as a context manager, so queries left running are stopped.
+    """
+
+    def __init__(self, executor, context=None, max_workers=8):
+        self.executor = executor
+        self.deadline = executor.deadline_from_context(context)
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        # Running queries by QueryExecutionId
+        self._running = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._poller = None
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(
+            self,
+            query,
+            parameters=None,
+            result_reuse_policy=None,
+            query_name=None,
+            timeout_seconds=None,
+            single_flight_claim=None
+    ):
+        future = Future()
+        deadline = self.deadline
+        if timeout_seconds is not None:
+            timeout_deadline = time.monotonic() + timeout_seconds
+            deadline = timeout_deadline if deadline is None else min(deadline, timeout_deadline)
+        self._pool.submit(self._start, future, {
+            'query': query,
+            'parameters': parameters,
+            'result_reuse_policy': result_reuse_policy,
+            'query_name': query_name or 'unnamed',
+            'single_flight_claim': single_flight_claim,
+            'attempt': 1,
+            'deadline': deadline,
+        })
+        return future
+
+    def submit_named(self, named_query, parameter_values, single_flight_claim=None):
+        """Submit a query_registry.NamedQuery with its reuse and timeout settings."""
+        return self.submit(
+            **self.executor.named_query_kwargs(named_query, parameter_values),
+            single_flight_claim=single_flight_claim
+        )
+
+    def seconds_to_deadline(self):
+        """Timeout for Future.result() that ends at the deadline, None without one."""
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.monotonic(), 0)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            running = list(self._running.items())
+            self._running.clear()
+        for query_execution_id, query in running:
+            self._stop(query_execution_id, query)
+            for future in query['futures']:
+                future.cancel()
+        self._wakeup.set()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def _start(self, future, query):
+        claim = query['single_flight_claim']
+        try:
+            started_at = time.monotonic()
+            query_execution_id = self.executor.start(
+                query['query'],
+                query['parameters'],
+                query['result_reuse_policy'],
+                claim.token if claim else None
+            )
+            start_ms = (time.monotonic() - started_at) * 1000
+        except Exception as e:
+            future.set_exception(e)
+            return
+        poll_delays_ms = self.executor.poll_delays_ms(query['query'])
+        now = time.monotonic()
+        query.update({
+            'futures': [future],
+            'start_ms': start_ms,
+            'started_at': now,
+            'poll_delays_ms': poll_delays_ms,
+            'next_poll_at': now + next(poll_delays_ms) / 1000,
+            'poll_count': 0,
+        })
+        with self._lock:
+            closed = self._closed
+            if query_execution_id in self._running:
+                # Same single-flight token as a running query, so the same execution
+                self._running[query_execution_id]['futures'].append(future)
+                return
+            if not closed:
+                self._running[query_execution_id] = query
+                if self._poller is None:
+                    self._poller = threading.Thread(target=self._poll, daemon=True)
+                    self._poller.start()
+        if closed:
+            # Started while closing, nobody waits for it anymore
+            self._stop(query_execution_id, query)
+            return
+        # The new query may be due before the poller would wake up
+        self._wakeup.set()
+
+    def _poll(self):
+        try:
+            self._poll_running()
+        except Exception as e:
+            # Without the poller nothing would resolve the futures of the running queries
+            print(f'Poller failed: {e}')
+            with self._lock:
+                failed = list(self._running.items())
+                self._running.clear()
+                self._poller = None
+            for query_execution_id, query in failed:
+                set_exception(query['futures'], e)
+                try:
+                    self._stop(query_execution_id, query)
+                except Exception as stop_error:
+                    print(f'Failed to stop query {query_execution_id}: {stop_error}')
+
+    def _poll_running(self):
+        while True:
+            with self._lock:
+                if not self._running:
+                    self._poller = None
+                    return
+                now = time.monotonic()
+                # Queries due within the shortest poll interval are polled early,
+                # so their schedules share BatchGetQueryExecution calls
+                poll_until = now + self.executor.min_poll_interval_ms / 1000
+                due_ids = [
+                    query_execution_id for query_execution_id, query in self._running.items()
+                    if query['next_poll_at'] <= poll_until
+                ]
+                if not due_ids:
+                    wait_seconds = min(query['next_poll_at'] for query in self._running.values()) - now
+            if not due_ids:
+                self._wakeup.wait(wait_seconds)
+                self._wakeup.clear()
+                continue
+            for i in range(0, len(due_ids), BATCH_GET_QUERY_EXECUTION_SIZE):
+                try:
+                    response = self.executor.athena_client.batch_get_query_execution(
+                        QueryExecutionIds=due_ids[i:i + BATCH_GET_QUERY_EXECUTION_SIZE]
+                    )
+                except Exception as e:
+                    self._fail(due_ids[i:i + BATCH_GET_QUERY_EXECUTION_SIZE], e)
+                    continue
+                for query_execution in response['QueryExecutions']:
+                    self._update(query_execution['QueryExecutionId'], query_execution)
+                for unprocessed in response.get('UnprocessedQueryExecutionIds', []):
+                    self._update(unprocessed['QueryExecutionId'])
+
+    def _update(self, query_execution_id, query_execution=None):
+        # query_execution is None for an id that BatchGetQueryExecution did not
+        # process. Its state is unknown, so it backs off like an active query
+        # and times out at its deadline
+        is_active = query_execution is None or query_execution['Status']['State'] in ATHENA_ACTIVE_STATES
+        now = time.monotonic()
+        with self._lock:
+            query = self._running.get(query_execution_id)
+            if query is None:
+                return
+            query['poll_count'] += 1
+            timed_out = is_active and query['deadline'] is not None and now >= query['deadline']
+            if is_active and not timed_out:
+                next_poll_at = now + next(query['poll_delays_ms']) / 1000
+                if query['deadline'] is not None:
+                    # Make the last poll land right on the deadline
+                    next_poll_at = min(next_poll_at, query['deadline'])
+                query['next_poll_at'] = next_poll_at
+                return
+            del self._running[query_execution_id]
+
+        # The query is no longer running, so only this call resolves its futures
+        try:
+            if timed_out:
+                set_exception(query['futures'], TimeoutError(
+                    f'Query {query_execution_id} did not finish before the deadline'
+                ))
+                self._stop(query_execution_id, query)
+            else:
+                self._finish(query_execution, query)
+        except Exception as e:
+            set_exception(query['futures'], e)
+
+    def _finish(self, query_execution, query):
+        futures = query['futures']
+        claim = query['single_flight_claim']
+        try:
+            query_execution = self.executor.finish_wait(
+                query_execution, query['query'], query['started_at'], query['poll_count']
+            )
+        except QueryCancelled as e:
+            if claim is not None and not claim.is_owner and query['attempt'] < SINGLE_FLIGHT_ATTEMPTS:
+                self._pool.submit(self._restart, futures, query)
+            else:
+                set_exception(futures, e)
+            return
+        except Exception as e:
+            if claim is not None:
+                claim.release()
+            set_exception(futures, e)
+            return
+        query_execution['ClientStatistics'].update({
+            'QueryName': query['query_name'],
+            'StartMillis': query['start_ms'],
+        })
+        self.executor.emit_query_metrics(query_execution)
+        self._pool.submit(self._fetch, futures, query_execution)
+
+    def _stop(self, query_execution_id, query):
+        # The claim goes first, so followers that see the query
+        # cancelled don't get the same token again
+        claim = query['single_flight_claim']
+        if claim is not None:
+            claim.release()
+        if claim is None or claim.is_owner:
+            self.executor.athena_client.stop_query_execution(QueryExecutionId=query_execution_id)
+
+    def _restart(self, futures, query):
+        # The single-flight owner stopped the shared query at its deadline
+        print(f'Query {query["query_name"]} was stopped by its single-flight owner, retrying')
+        try:
+            claim = query['single_flight_claim'].reclaim()
+        except Exception as e:
+            set_exception(futures, e)
+            return
+        for future in futures:
+            self._start(future, {**query, 'single_flight_claim': claim, 'attempt': query['attempt'] + 1})
+
+    def _fetch(self, futures, query_execution):
+        try:
+            batches = list(self.executor.iter_batches(query_execution))
+        except Exception as e:
+            set_exception(futures, e)
+            return
+        for future in futures:
+            if not future.done():
+                future.set_result((query_execution, batches))
+
+    def _fail(self, query_execution_ids, exception):
+        with self._lock:
+            failed = [self._running.pop(query_execution_id, None) for query_execution_id in query_execution_ids]
+        for query in failed:
+            if query is not None:
+                set_exception(query['futures'], exception)
+
+
+def set_exception(futures, exception):
+    # A future cancelled by close() can't be resolved anymore
+    for future in futures:
+        if not future.done():
+            future.set_exception(exception)
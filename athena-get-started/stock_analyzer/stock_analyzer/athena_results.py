@@ -0,0 +1,195 @@
+import json
+
+import pandas as pd
+
+ATHENA_STRING_TYPES = ["varchar", "char", "string", "array"]
+ATHENA_DATETIME_TYPES = ["timestamp", "date"]
+ATHENA_INTEGER_TYPES = ["int", "bigint", "integer", "smallint", "tinyint"]
+ATHENA_FLOAT_TYPES = ["double", "float", "decimal"]
+ATHENA_BOOLEAN_TYPES = ["boolean"]
+
+
+def athena_rows_to_df(column_info, rows) -> pd.DataFrame:
+    columns = [col['Name'] for col in column_info]
+    column_types = [col['Type'] for col in column_info]
+    # Gather the raw VarCharValue strings column by column, so each column
+    # type is resolved once and the whole column is converted in bulk
+    cells = [row['Data'] for row in rows]
+    data_typed = {
+        i: athena_column_parser(
+            column_type, [cell[i].get('VarCharValue', None) for cell in cells]
+        )
+        for i, column_type in enumerate(column_types)
+    }
+    df = pd.DataFrame(data_typed)
+    df.columns = columns
+    return df
+
+
+def athena_csv_to_batches(csv_file, column_info, batch_size=100_000, has_header=True):
+    """Yield typed DataFrames of batch_size rows from an Athena result CSV file.
+
+    Athena writes every value quoted and NULL as an empty unquoted field.
+    The CSV reader can't tell the two apart for strings,
+    so empty strings come back as missing values.
+    has_header False reads a part of the file after its header row.
+    """
+    columns = [col['Name'] for col in column_info]
+    column_types = [col['Type'] for col in column_info]
+    # Read every column as raw strings and convert them with the same
+    # column parsers as GetQueryResults pages, so both paths return the same types
+    csv_reader = pd.read_csv(
+        csv_file,
+        header=0 if has_header else None,
+        names=columns,
+        dtype=str,
+        keep_default_na=False,
+        na_values=[''],
+        chunksize=batch_size
+    )
+    with csv_reader:
+        for chunk in csv_reader:
+            data_typed = {
+                i: athena_column_parser(column_type, chunk.iloc[:, i])
+                for i, column_type in enumerate(column_types)
+            }
+            df = pd.DataFrame(data_typed)
+            df.columns = columns
+            yield df
+
+
+def read_athena_csv_rows(csv_file, max_rows, chunk_size=64 * 1024):
+    """Read up to max_rows rows from a binary Athena result CSV file.
+
+    Returns the bytes of the rows, so the next read can start after them.
+    Athena quotes every value and doubles the quotes inside values, so a row
+    ends at the first line break after an even number of quotes, even if a
+    value spans lines.
+    """
+    rows = []
+    pending = b''
+    row_count, quote_count = 0, 0
+    while row_count < max_rows:
+        chunk = csv_file.read(chunk_size)
+        if not chunk:
+            rows.append(pending)
+            break
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            rows.append(line + b'\n')
+            quote_count += line.count(b'"')
+            if quote_count % 2 == 0:
+                row_count += 1
+                if row_count == max_rows:
+                    break
+    return b''.join(rows)
+
+
+def athena_column_parser(column_type, values):
+    if column_type in ATHENA_STRING_TYPES:
+        # Missing values are None from both result pages and the CSV reader, which gives NaN
+        values = pd.Series(values, dtype=object)
+        return values.where(values.notna(), None).array
+    # 'string' dtype keeps missing values (None or NaN) as <NA>,
+    # so the conversions below produce nullable arrays
+    raw = pd.Series(values, dtype='string')
+    if column_type in ATHENA_DATETIME_TYPES:
+        return pd.to_datetime(raw).array
+    if column_type in ATHENA_INTEGER_TYPES:
+        return raw.astype('Int64').array
+    if column_type in ATHENA_FLOAT_TYPES:
+        return raw.astype('float64').array
+    if column_type in ATHENA_BOOLEAN_TYPES:
+        return (raw.str.lower() == 'true').array
+    raise Exception(f"Unknown Athena column type: {column_type}")
+
+
+def write_json_records(batches, out):
+    """Write DataFrame batches to out as a single JSON array of records."""
+    out.write('[')
+    is_first_batch = True
+    for batch in batches:
+        if batch.empty:
+            continue
+        if not is_first_batch:
+            out.write(',')
+        # Strip the enclosing brackets of the batch's own JSON array
+        out.write(batch.to_json(orient='records', date_format='iso')[1:-1])
+        is_first_batch = False
+    out.write(']')
+
+
+def write_ndjson_records(batches, out):
+    """Write DataFrame batches to out as newline-delimited JSON records."""
+    for batch in batches:
+        if batch.empty:
+            continue
+        out.write(batch.to_json(orient='records', lines=True, date_format='iso'))
+
+
+def write_json_grouped(batches, out, group_column, key_column, value_column):
+    """Write batches sorted by group_column to out as {group: {key: value}} JSON.
+
+    A group may continue in the next batch, so it is closed only when
+    the next group starts.
+    """
+    out.write('{')
+    current_group = None
+    for batch in batches:
+        if batch.empty:
+            continue
+        # Missing values become None, so they are encoded as null rather than NaN
+        values = batch[value_column].astype(object).where(batch[value_column].notna(), None)
+        for group, positions in batch.groupby(group_column, sort=False).indices.items():
+            group_items = dict(zip(batch[key_column].iloc[positions], values.iloc[positions]))
+            if group != current_group:
+                if current_group is not None:
+                    out.write('},')
+                out.write(f'{json.dumps(str(group))}:{{')
+                current_group = group
+            else:
+                out.write(',')
+            out.write(json.dumps(group_items, separators=(',', ':'))[1:-1])
+    if current_group is not None:
+        out.write('}')
+    out.write('}')
+
+
+def write_json_keyed(batches, out, key_column):
+    """Write DataFrame batches to out as {key: {column: value}} JSON, one entry per row."""
+    out.write('{')
+    is_first_batch = True
+    for batch in batches:
+        if batch.empty:
+            continue
+        if not is_first_batch:
+            out.write(',')
+        # Strip the enclosing braces of the batch's own JSON object
+        out.write(batch.set_index(key_column).to_json(orient='index', date_format='iso')[1:-1])
+        is_first_batch = False
+    out.write('}')
+
+
+def write_json_columnar(batches, out):
+    """Write DataFrame batches to out as one JSON object of columns, {column: [values]}.
+
+    Column names are written once instead of once per row. Every column
+    spans all batches, so the batches are concatenated first.
+    """
+    batches = list(batches)
+    dataframe = pd.concat(batches, ignore_index=True) if batches else pd.DataFrame()
+    out.write('{')
+    out.write(','.join(
+        f'{json.dumps(str(column))}:{dataframe[column].to_json(orient="values", date_format="iso")}'
+        for column in dataframe.columns
+    ))
+    out.write('}')
+
+
+def write_csv_records(batches, out):
+    """Write DataFrame batches to out as CSV with a header row."""
+    is_first_batch = True
+    for batch in batches:
+        batch.to_csv(out, index=False, header=is_first_batch)
+        is_first_batch = False
@@ -1,82 +1,438 @@
+import hashlib
+import json
 import os
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
 
 import yfinance as yf
 import boto3
+import numpy as np
 import pandas as pd
 
+from glue_partitions import (
+    TABLE_LOCK_KEY, default_s3_prefix, location_s3_prefix, partition_locations, register_partitions,
+    s3_location, table_lock
+)
+from parquet_storage import delete_s3_objects, save_df_as_parquet_partitions
+
 BUCKET_NAME = os.environ.get('BUCKET_NAME', None)
 CANDLE_S3_PREFIX = os.environ.get('CANDLE_S3_PREFIX', None)
+CACHE_S3_PREFIX = os.environ.get('CACHE_S3_PREFIX', None)
+DAILY_RETURNS_S3_PREFIX = os.environ.get('DAILY_RETURNS_S3_PREFIX', None)
+STATE_S3_PREFIX = os.environ.get('STATE_S3_PREFIX', None)
+DATABASE_NAME = os.environ.get('DATABASE_NAME', None)
+# Ticker universe: a text file in the bucket with one ticker per line,
+# or a comma separated TICKERS list, or the default tickers below
+TICKERS_S3_KEY = os.environ.get('TICKERS_S3_KEY', None)
+TICKERS = os.environ.get('TICKERS', None)
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', '1'))
+DOWNLOAD_CONCURRENCY = int(os.environ.get('DOWNLOAD_CONCURRENCY', '8'))
+DOWNLOAD_RATE_PER_SECOND = float(os.environ.get('DOWNLOAD_RATE_PER_SECOND', '4'))
+DOWNLOAD_TIMEOUT_SECONDS = int(os.environ.get('DOWNLOAD_TIMEOUT_SECONDS', '20'))
+PARQUET_ROW_GROUP_SIZE = int(os.environ.get('PARQUET_ROW_GROUP_SIZE', '100000'))
+# How long a run waits for parquet compactor to release the table lock
+TABLE_LOCK_WAIT_SECONDS = int(os.environ.get('TABLE_LOCK_WAIT_SECONDS', '300'))
+# Ticker names for Magnificent 7 and NASDAQ index (^IXIC)
+DEFAULT_TICKERS = [
+    'AAPL', 'MSFT', 'AMZN', 'GOOGL', 'META', 'TSLA', 'NVDA', '^IXIC'
+]
+YAHOO_PRICE_COLUMNS = ['Adj Close', 'Close', 'High', 'Low', 'Open', 'Volume']
 
 s3 = boto3.client('s3')
+glue = boto3.client('glue')
+lambda_client = boto3.client('lambda')
 
 
 def main(event, context):
     print(event)
-    # Ticker names for Magnificent 7 and NASDAQ index (^IXIC)
-    mag_seven_tickers = [
-        'AAPL', 'MSFT', 'AMZN', 'GOOGL', 'META', 'TSLA', 'NVDA', '^IXIC'
+    # 'incremental' (default) downloads only bars newer than the stored
+    # watermarks, 'full' re-downloads the whole history and replaces the dataset
+    mode = event.get('mode', 'incremental')
+    if mode not in ['incremental', 'full']:
+        raise ValueError(f'Unknown mode: {mode}')
+
+    # A shard invocation loads its part of the ticker universe
+    if 'shard' in event:
+        return load_shard(mode, event['shard'], event['shard_count'])
+
+    # The shards hold the lock of this run, it expires after they are done
+    lock_claim = claim_table_lock()
+    if mode == 'incremental' and not load_watermarks(s3, BUCKET_NAME, watermarks_s3_prefix()):
+        print('No watermarks found, falling back to a full load')
+        mode = 'full'
+    if mode == 'full':
+        # Shards clean up only their own files, so drop the data files written
+        # with any other shard layout first. Compacted files stay until the shards
+        # point their partitions back to the default location, then parquet
+        # compactor deletes them. All the watermarks go: a shard that fails
+        # reloads the whole history of its symbols on the next run
+        layout_suffix = f'-of-{SHARD_COUNT:03d}'
+        for s3_prefix in [CANDLE_S3_PREFIX, DAILY_RETURNS_S3_PREFIX]:
+            delete_s3_objects(
+                s3_client=s3,
+                bucket_name=BUCKET_NAME,
+                s3_prefix=s3_prefix,
+                should_delete=lambda key: (
+                    '/_compacted/' not in key and layout_suffix not in key.rsplit('/', 1)[-1]
+                )
+            )
+        delete_s3_objects(
+            s3_client=s3,
+            bucket_name=BUCKET_NAME,
+            s3_prefix=watermarks_s3_prefix(),
+            should_delete=lambda key: True
+        )
+
+    if SHARD_COUNT == 1:
+        try:
+            return load_shard(mode, 0, 1)
+        finally:
+            lock_claim.release()
+    # Fan the shards out to parallel asynchronous invocations of this function
+    for shard in range(SHARD_COUNT):
+        lambda_client.invoke(
+            FunctionName=context.invoked_function_arn,
+            InvocationType='Event',
+            Payload=json.dumps({'mode': mode, 'shard': shard, 'shard_count': SHARD_COUNT})
+        )
+    print(f'Started {SHARD_COUNT} shards')
+
+
+def claim_table_lock():
+    # Parquet compactor must not move a partition while a run adds files to it
+    lock = table_lock(s3, BUCKET_NAME, STATE_S3_PREFIX)
+    wait_until = time.monotonic() + TABLE_LOCK_WAIT_SECONDS
+    while True:
+        lock_claim = lock.claim(TABLE_LOCK_KEY, exclusive=True)
+        if lock_claim.is_owner:
+            return lock_claim
+        if time.monotonic() > wait_until:
+            raise Exception(f'Table lock is still held after {TABLE_LOCK_WAIT_SECONDS} s')
+        print('Waiting for parquet compactor to release the table lock')
+        time.sleep(10)
+
+
+def load_shard(mode, shard, shard_count):
+    started_at = time.monotonic()
+    shard_tag = f'shard-{shard:03d}-of-{shard_count:03d}'
+    tickers = [
+        ticker for ticker in load_ticker_universe()
+        if ticker_shard(ticker, shard_count) == shard
     ]
+    print(f'{shard_tag}: {len(tickers)} tickers')
 
-    # Download data from Yahoo!Finance as pandas dataframe
-    multi_ticker_yahoo_df = yf.download(
-        tickers=mag_seven_tickers,
-        period='max',
-        interval='1d'
-    )
+    # Watermark is the timestamp of the last stored candle per symbol
+    watermarks = {}
+    if mode == 'incremental':
+        watermarks = load_watermarks(s3, BUCKET_NAME, watermarks_s3_prefix())
+    watermarks = {ticker: watermarks[ticker] for ticker in tickers if ticker in watermarks}
 
-    # Transform Yahoo!Finance dataframe to candle dataframe
+    # Download data from Yahoo!Finance and transform it to candle dataframe
     # to make it inline with Glue table schema
-    candle_df = multi_ticker_yahoo_df_to_candle_df(multi_ticker_yahoo_df)
-
-    # Define the s3 key for the parquet file and save it to s3
-    candle_df_s3_key = f'{CANDLE_S3_PREFIX}/data.parquet'
-    save_df_as_parquet(
-        s3_client=s3,
-        bucket_name=BUCKET_NAME,
-        dataframe=candle_df,
-        s3_key=candle_df_s3_key,
-        parquet_file_path='/tmp/data.parquet'
+    candle_df, failed_tickers = download_candle_df(tickers, watermarks)
+
+    if candle_df is not None:
+        # Daily returns are computed before the already stored candles are
+        # filtered out, so the first new day still has its previous close
+        daily_returns_df = candle_df_to_daily_returns_df(candle_df)
+        candle_df = candle_df[is_after_watermark(candle_df, watermarks)]
+        daily_returns_df = daily_returns_df[is_after_watermark(daily_returns_df, watermarks)]
+
+    if candle_df is None or candle_df.empty:
+        print('No new candles')
+    else:
+        print(f'Writing {len(candle_df)} new candles')
+        # Every shard writes its own files
+        if mode == 'full':
+            file_name = f'{shard_tag}.parquet'
+        else:
+            file_name = incremental_file_name(shard_tag, watermarks)
+
+        # Save candles partitioned by year (<prefix>/year=YYYY/<file>),
+        # so queries filtered by year read only the matching files
+        candle_df = candle_df.assign(year=candle_df['timestamp'].dt.strftime('%Y'))
+        candle_s3_prefixes = partition_s3_prefixes(
+            mode, 'candle', CANDLE_S3_PREFIX, 'year', candle_df['year'].unique()
+        )
+        saved_s3_keys = save_df_as_parquet_partitions(
+            s3_client=s3,
+            bucket_name=BUCKET_NAME,
+            s3_prefix=CANDLE_S3_PREFIX,
+            dataframe=candle_df,
+            partition_key='year',
+            file_name=file_name,
+            row_group_size=PARQUET_ROW_GROUP_SIZE,
+            partition_s3_prefixes=candle_s3_prefixes
+        )
+        # Materialize daily returns, one partition per trading date.
+        # Only returns after the watermarks are written,
+        # so a nightly run appends just the new trading day.
+        # Its files are named like the candle files, so a symbol that lags
+        # behind doesn't make the next run overwrite the others' returns
+        print(f'Writing {daily_returns_df["trade_date"].nunique()} daily returns partitions')
+        daily_returns_s3_prefixes = partition_s3_prefixes(
+            mode, 'daily_returns', DAILY_RETURNS_S3_PREFIX, 'trade_date',
+            daily_returns_df['trade_date'].unique()
+        )
+        saved_s3_keys += save_df_as_parquet_partitions(
+            s3_client=s3,
+            bucket_name=BUCKET_NAME,
+            s3_prefix=DAILY_RETURNS_S3_PREFIX,
+            dataframe=daily_returns_df,
+            partition_key='trade_date',
+            file_name=file_name,
+            row_group_size=PARQUET_ROW_GROUP_SIZE,
+            partition_s3_prefixes=daily_returns_s3_prefixes
+        )
+        # New partitions become visible to Athena once their files are saved.
+        # A full load moves the partitions back to their default location
+        for table_name, s3_prefixes in [
+            ('candle', candle_s3_prefixes), ('daily_returns', daily_returns_s3_prefixes)
+        ]:
+            register_partitions(glue, DATABASE_NAME, table_name, {
+                value: s3_location(BUCKET_NAME, s3_prefix) for value, s3_prefix in s3_prefixes.items()
+            })
+        if mode == 'full':
+            # The full history of the shard is written now,
+            # so drop the other files of this shard
+            for s3_prefix in [CANDLE_S3_PREFIX, DAILY_RETURNS_S3_PREFIX]:
+                delete_s3_objects(
+                    s3_client=s3,
+                    bucket_name=BUCKET_NAME,
+                    s3_prefix=s3_prefix,
+                    should_delete=lambda key: (
+                        key.rsplit('/', 1)[-1].startswith(shard_tag) and key not in saved_s3_keys
+                    )
+                )
+
+        # Watermarks move only after all the data is saved,
+        # so a failed run is retried from the same watermarks
+        last_timestamps = candle_df.groupby('symbol', observed=True)['timestamp'].max()
+        watermarks.update({
+            symbol: timestamp.isoformat() for symbol, timestamp in last_timestamps.items()
+        })
+        save_watermarks(
+            s3, BUCKET_NAME, f'{watermarks_s3_prefix()}/{shard_tag}.json', watermarks
+        )
+
+        # Rewrite the cache generation marker with the load time. Its new ETag
+        # invalidates every cached daily returns response computed from old data
+        s3.put_object(
+            Bucket=BUCKET_NAME,
+            Key=f'{CACHE_S3_PREFIX}/candle-generation'.replace('//', '/'),
+            Body=datetime.now(timezone.utc).isoformat()
+        )
+
+    elapsed_seconds = time.monotonic() - started_at
+    report = {
+        'shard': shard_tag,
+        'mode': mode,
+        'symbols': len(tickers),
+        'failed_symbols': failed_tickers,
+        'candles': 0 if candle_df is None else len(candle_df),
+        'elapsed_seconds': round(elapsed_seconds, 1),
+        'symbols_per_minute': round(len(tickers) / elapsed_seconds * 60, 1),
+    }
+    print(json.dumps(report))
+    return report
+
+
+def incremental_file_name(shard_tag, watermarks):
+    # Named after all the watermarks the run started from: a re-run from the
+    # same watermarks overwrites its files instead of adding duplicates.
+    # Once any symbol moved on, the next run gets a new name, even while
+    # another symbol of the shard lags behind, e.g. after a failed download
+    since = min(watermarks.values(), default='0000-00-00')[:10]
+    digest = hashlib.sha256(json.dumps(watermarks, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    return f'{shard_tag}-since-{since}-{digest}.parquet'
+
+
+def partition_s3_prefixes(mode, table_name, s3_prefix, partition_key, partition_values):
+    # Returns {partition value: s3 prefix to save the partition's file to}.
+    # An incremental load adds its file to the current location of a partition,
+    # which parquet compactor may have moved. A full load writes every
+    # partition to its default location
+    s3_prefixes = {
+        value: default_s3_prefix(s3_prefix, partition_key, value) for value in partition_values
+    }
+    if mode == 'incremental':
+        locations = partition_locations(glue, DATABASE_NAME, table_name, s3_prefixes)
+        s3_prefixes.update({value: location_s3_prefix(location) for value, location in locations.items()})
+    return s3_prefixes
+
+
+def load_ticker_universe():
+    if TICKERS_S3_KEY:
+        try:
+            response = s3.get_object(Bucket=BUCKET_NAME, Key=TICKERS_S3_KEY)
+            lines = response['Body'].read().decode('utf-8').splitlines()
+            return [line.strip() for line in lines if line.strip()]
+        except s3.exceptions.NoSuchKey:
+            print(f'{TICKERS_S3_KEY} not found, using the default tickers')
+    if TICKERS:
+        return [ticker.strip() for ticker in TICKERS.split(',') if ticker.strip()]
+    return DEFAULT_TICKERS
+
+
+def ticker_shard(ticker, shard_count):
+    # crc32 is stable across invocations, unlike the built-in hash()
+    return zlib.crc32(ticker.encode('utf-8')) % shard_count
+
+
+class RateLimiter:
+    """Spaces out acquire() calls from all threads to at most rate_per_second."""
+
+    def __init__(self, rate_per_second):
+        self.interval = 1 / rate_per_second
+        self.next_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_at - now
+            self.next_at = max(self.next_at, now) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+def download_candle_df(tickers, watermarks):
+    """Download candles of every ticker in parallel.
+
+    Returns the candle dataframe (None if nothing was downloaded)
+    and the list of tickers that failed or returned no data.
+    A failing ticker is reported and does not stop the others.
+    """
+    rate_limiter = RateLimiter(DOWNLOAD_RATE_PER_SECOND)
+
+    def download(ticker):
+        rate_limiter.acquire()
+        # Symbols without a watermark need their whole history,
+        # the others only the bars from their watermark on
+        if ticker in watermarks:
+            yahoo_df = download_yahoo_df(ticker, start=watermarks[ticker][:10])
+        else:
+            yahoo_df = download_yahoo_df(ticker, period='max')
+        if yahoo_df is None:
+            return None
+        return multi_ticker_yahoo_df_to_candle_df(yahoo_df)
+
+    candle_dfs = []
+    failed_tickers = []
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_CONCURRENCY) as executor:
+        futures = {executor.submit(download, ticker): ticker for ticker in tickers}
+        for future in as_completed(futures):
+            ticker = futures[future]
+            try:
+                candle_df = future.result()
+            except Exception as e:
+                print(f'Failed to download {ticker}: {e}')
+                candle_df = None
+            if candle_df is None or candle_df.empty:
+                failed_tickers.append(ticker)
+            else:
+                candle_dfs.append(candle_df)
+    if not candle_dfs:
+        return None, failed_tickers
+    candle_df = pd.concat(candle_dfs, ignore_index=True)
+    # Concatenating categoricals with different categories gives strings
+    candle_df['symbol'] = candle_df['symbol'].astype('category')
+    return candle_df, failed_tickers
+
+
+def download_yahoo_df(ticker, **kwargs):
+    # yf.download shares module level state between calls, so it is not
+    # safe to call from several threads. Ticker.history is, and its result
+    # is reshaped to the multi-level columns layout of yf.download.
+    # end is exclusive, so today's bar is not downloaded: its session may
+    # still be open, e.g. on an Asian exchange at 02:00 UTC, and a stored
+    # partial bar would never be fetched again once the watermark passed it
+    history_df = yf.Ticker(ticker).history(
+        interval='1d',
+        auto_adjust=False,
+        actions=False,
+        timeout=DOWNLOAD_TIMEOUT_SECONDS,
+        end=datetime.now(timezone.utc).strftime('%Y-%m-%d'),
+        **kwargs
+    )
+    if history_df.empty:
+        return None
+    history_df.index = history_df.index.tz_localize(None)
+    return pd.concat({ticker: history_df[YAHOO_PRICE_COLUMNS]}, axis=1).swaplevel(axis=1)
+
+
+def is_after_watermark(dataframe, watermarks):
+    symbol_watermarks = pd.to_datetime(dataframe['symbol'].map(watermarks))
+    return symbol_watermarks.isna() | (dataframe['timestamp'] > symbol_watermarks)
+
+
+def watermarks_s3_prefix():
+    return f'{STATE_S3_PREFIX}/candle-watermarks'.replace('//', '/')
+
+
+def load_watermarks(s3_client, bucket_name, s3_prefix):
+    # Every shard keeps the watermarks of its symbols in its own file.
+    # All files are merged, so the watermarks survive a change of SHARD_COUNT
+    watermarks = {}
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=s3_prefix):
+        for obj in page.get('Contents', []):
+            response = s3_client.get_object(Bucket=bucket_name, Key=obj['Key'])
+            for symbol, timestamp in json.loads(response['Body'].read().decode('utf-8')).items():
+                watermarks[symbol] = max(timestamp, watermarks.get(symbol, timestamp))
+    return watermarks
+
+
+def save_watermarks(s3_client, bucket_name, s3_key, watermarks):
+    s3_client.put_object(
+        Bucket=bucket_name,
+        Key=s3_key,
+        Body=json.dumps(watermarks, indent=2, sort_keys=True)
     )
 
 
 def multi_ticker_yahoo_df_to_candle_df(yahoo_df):
-    candle_df = yahoo_df.copy(deep=True)
-    # yahoo_df has multi-level columns like ('Open', 'AAPL'), ('Open', 'MSFT').
-    # We need to extract symbol, which is at index = 1 in multi-level column
-    # and set it as a new column
-
-    candle_df = candle_df.stack(level=1)
-    candle_df = candle_df.rename_axis(['timestamp', 'symbol']).reset_index()
-    # Now we rename the columns to match the Glue table schema
-    candle_df.columns = [
-        'timestamp', 'symbol', 'adj close',
-        'close', 'high', 'low', 'open', 'volume'
-    ]
+    # yahoo_df has multi-level columns like ('Open', 'AAPL'), ('Open', 'MSFT'),
+    # so every field is a (dates x tickers) block. The blocks are flattened
+    # ticker by ticker straight into the columns of the long-format frame,
+    # without stacking or copying the whole wide frame.
+    # Columns are picked by name to match the Glue table schema,
+    # 'Adj Close' is not in the schema and is never read
+    tickers = yahoo_df['Close'].columns
+    n_dates = len(yahoo_df.index)
+
+    def field_values(field):
+        return yahoo_df[field].reindex(columns=tickers).to_numpy(dtype='float64').ravel(order='F')
 
-    # Drop the 'adj close' column since it is not in the Glue table schema
-    candle_df = candle_df.drop(columns=['adj close'])
-
-    # Convert the timestamp to datetime64[us]
-    # and volume to int to match the Glue table schema
-    candle_df['timestamp'] = pd.to_datetime(candle_df['timestamp'])
-    candle_df['timestamp'] = candle_df['timestamp'].astype('datetime64[us]')
-    candle_df['volume'] = candle_df['volume'].astype('int')
-
-    return candle_df
-
-
-def save_df_as_parquet(
-        s3_client,
-        bucket_name,
-        s3_key,
-        dataframe,
-        parquet_file_path
-):
-    if not bucket_name:
-        raise ValueError('bucket_name is not set')
-    if not s3_key:
-        raise ValueError('s3_key is not set')
-    _s3_key = s3_key.replace('//', '/')
-    dataframe.to_parquet(parquet_file_path, compression='snappy')
-    s3_client.upload_file(parquet_file_path, bucket_name, _s3_key)
+    close = field_values('Close')
+    # Tickers listed later than others have no bars for the earlier dates
+    has_candle = ~np.isnan(close)
+    # A bar can have a close but no volume, e.g. some indices. Casting NaN
+    # to int64 would store the minimum int64, so it is stored as 0
+    volume = np.nan_to_num(field_values('Volume')[has_candle], nan=0)
+    symbol_codes = np.repeat(np.arange(len(tickers), dtype='int32'), n_dates)
+    # copy=False keeps the arrays as they are instead of consolidating
+    # the float columns into one more 2D copy
+    return pd.DataFrame({
+        'timestamp': np.tile(yahoo_df.index.to_numpy(dtype='datetime64[us]'), len(tickers))[has_candle],
+        'symbol': pd.Categorical.from_codes(symbol_codes[has_candle], categories=tickers),
+        'close': close[has_candle],
+        'high': field_values('High')[has_candle],
+        'low': field_values('Low')[has_candle],
+        'open': field_values('Open')[has_candle],
+        'volume': volume.astype('int64'),
+    }, copy=False)
 
+
+def candle_df_to_daily_returns_df(candle_df):
+    daily_returns_df = candle_df[['symbol', 'timestamp', 'close']].sort_values(
+        ['symbol', 'timestamp']
+    )
+    daily_returns_df['daily_return'] = daily_returns_df.groupby('symbol', observed=True)['close'].pct_change(
+        fill_method=None
+    )
+    daily_returns_df['trade_date'] = daily_returns_df['timestamp'].dt.strftime('%Y-%m-%d')
+    return daily_returns_df[['symbol', 'timestamp', 'daily_return', 'trade_date']]
@@ -1,77 +1,343 @@
+import base64
+import gzip
+import hashlib
+import hmac
+import io
 import json
 import os
-import time
 import traceback
+from datetime import date as dt_date
+from functools import lru_cache, partial
+
 import jsonschema
 
 import boto3
-import pandas as pd
 
-athena_client = boto3.client('athena')
+from athena_executor import AthenaQueryExecutor
+from athena_results import (
+    write_csv_records, write_json_columnar,
+    write_json_grouped, write_json_records, write_ndjson_records
+)
+from query_registry import NAMED_QUERIES
+from result_cache import (
+    CacheGeneration, LruCache, S3Cache, TwoTierCache, result_cache_key
+)
+from single_flight import S3SingleFlight
+
 DATABASE_NAME = os.environ.get('DATABASE_NAME', None)
 WORKGROUP_NAME = os.environ.get('WORKGROUP_NAME', None)
+BUCKET_NAME = os.environ.get('BUCKET_NAME', None)
+CACHE_S3_PREFIX = os.environ.get('CACHE_S3_PREFIX', None)
+# Secret with the key that signs pagination cursors
+CURSOR_SECRET_ARN = os.environ.get('CURSOR_SECRET_ARN', None)
+
+s3 = boto3.client('s3')
+secretsmanager = boto3.client('secretsmanager')
+athena_executor = AthenaQueryExecutor(
+    athena_client=boto3.client('athena'),
+    database_name=DATABASE_NAME,
+    workgroup=WORKGROUP_NAME,
+    s3_client=s3
+)
+# Created at import time, so the in-process tier survives warm invocations
+result_cache = TwoTierCache(
+    memory_cache=LruCache(max_entries=256, max_bytes=64 * 1024 * 1024, ttl_seconds=3600),
+    shared_cache=S3Cache(s3, BUCKET_NAME, f'{CACHE_S3_PREFIX}/entries')
+)
+# Concurrent requests for the same query share one Athena execution
+single_flight = S3SingleFlight(s3, BUCKET_NAME, f'{CACHE_S3_PREFIX}/in-flight', ttl_seconds=60)
+candle_generation = CacheGeneration(
+    s3, BUCKET_NAME, f'{CACHE_S3_PREFIX}/candle-generation'.replace('//', '/')
+)
+# Format: (writer, content type)
+RESPONSE_WRITERS = {
+    'json': (write_json_records, 'application/json'),
+    'ndjson': (write_ndjson_records, 'application/x-ndjson'),
+    'columnar': (write_json_columnar, 'application/vnd.stock-analyzer.columnar+json'),
+    'csv': (write_csv_records, 'text/csv'),
+}
+# Multi-date JSON responses are grouped by date and then by symbol
+BATCH_RESPONSE_WRITERS = {
+    **RESPONSE_WRITERS,
+    'json': (
+        partial(
+            write_json_grouped,
+            group_column='trade_date',
+            key_column='symbol',
+            value_column='daily_return'
+        ),
+        'application/json'
+    ),
+}
+# Media types of the Accept header and the formats they select
+ACCEPTED_MEDIA_TYPES = {
+    'application/json': 'json',
+    'application/x-ndjson': 'ndjson',
+    'application/vnd.stock-analyzer.columnar+json': 'columnar',
+    'text/csv': 'csv',
+    'application/*': 'json',
+    '*/*': 'json',
+}
+MAX_DATES_PER_REQUEST = 366
+# Results longer than page_size rows are split into pages. The response
+# carries the cursor of the next page in the X-Next-Cursor header
+DEFAULT_PAGE_SIZE = 10_000
+MAX_PAGE_SIZE = 50_000
 daily_returns_input_schema = {
     'type': 'object',
     'properties': {
-        'date': {'type': 'string', 'pattern': '^[0-9]{4}-[0-9]{2}-[0-9]{2}$'}
+        'date': {'type': 'string', 'pattern': '^[0-9]{4}-[0-9]{2}-[0-9]{2}$'},
+        'start_date': {'type': 'string', 'pattern': '^[0-9]{4}-[0-9]{2}-[0-9]{2}$'},
+        'end_date': {'type': 'string', 'pattern': '^[0-9]{4}-[0-9]{2}-[0-9]{2}$'},
+        # Comma separated list of dates, e.g. 2024-01-02,2024-01-05
+        'dates': {
+            'type': 'string',
+            'pattern': '^[0-9]{4}-[0-9]{2}-[0-9]{2}(,[0-9]{4}-[0-9]{2}-[0-9]{2})*$'
+        },
+        # Overrides the Accept header
+        'format': {'type': 'string', 'enum': list(RESPONSE_WRITERS)},
+        'page_size': {'type': 'string', 'pattern': '^[1-9][0-9]{0,5}$'},
+        'cursor': {'type': 'string', 'pattern': '^[A-Za-z0-9_-]+=*\\.[A-Za-z0-9_-]+=*$'}
     },
-    'required': ['date']
+    'oneOf': [
+        {'required': ['date']},
+        {'required': ['start_date', 'end_date']},
+        {'required': ['dates']},
+        {'required': ['cursor']}
+    ]
 }
-daily_returns_query = '''
-WITH DailyReturnsInput AS (
-    SELECT 
-        symbol, 
-        timestamp,
-        close,
-        lag(close) over (PARTITION by symbol order by timestamp) as previous_close
-    FROM 
-        candle
-),
-DailyReturns AS (
-    SELECT 
-        symbol,
-        timestamp,
-        (close - previous_close) / previous_close as daily_return
-    FROM 
-        DailyReturnsInput
-)
-select * from DailyReturns
-where timestamp = cast(? as timestamp)
-'''
+
+# A cursor is signed, and is still checked like the request it continues
+cursor_schema = {
+    'type': 'object',
+    'properties': {
+        'query_name': {'enum': list(NAMED_QUERIES)},
+        'is_batch': {'type': 'boolean'},
+        'page_size': {'type': 'integer', 'minimum': 1, 'maximum': MAX_PAGE_SIZE},
+        'query_execution_id': {'type': 'string', 'pattern': '^[A-Za-z0-9-]+$'},
+        # GetQueryResults token, or byte offset in the result CSV
+        'next_token': {'type': ['string', 'integer'], 'minimum': 0}
+    },
+    'required': ['query_name', 'is_batch', 'page_size', 'query_execution_id', 'next_token']
+}
+
+
+class NotAcceptable(Exception):
+    pass
 
 
 def main(event, context):
     print(event)
-    # Step 1. Extract and validate input from request query string
+    # Step 1. Extract and validate input from request query string and headers
     try:
         query_string_params = event.get('queryStringParameters', None)
         if query_string_params is None:
             raise Exception('query string is required')
         jsonschema.validate(query_string_params, daily_returns_input_schema)
+        headers = event.get('headers') or {}
+        response_format = negotiate_response_format(query_string_params, headers)
+        use_gzip = accepts_gzip(headers)
+        if 'cursor' in query_string_params:
+            cursor = decode_cursor(query_string_params['cursor'])
+            named_query = NAMED_QUERIES[cursor['query_name']]
+            is_batch = cursor['is_batch']
+            page_size = cursor['page_size']
+        else:
+            cursor = None
+            named_query, parameter_values, is_batch = daily_returns_request(query_string_params)
+            page_size = int(query_string_params.get('page_size', DEFAULT_PAGE_SIZE))
+            if page_size > MAX_PAGE_SIZE:
+                raise Exception(f'page_size can\'t be larger than {MAX_PAGE_SIZE}')
+    except NotAcceptable as e:
+        return create_api_error(406, e)
     except Exception as e:
         return create_api_error(400, e)
 
-    # Step 2. Query Athena and return results
+    # Step 2. Query Athena, or resume the query of the cursor, and return results
     try:
-        date = query_string_params.get('date')
-        daily_returns_athena_out = get_athena_results(
-            athena_client=athena_client,
-            database_name=DATABASE_NAME,
-            query=daily_returns_query,
-            workgroup=WORKGROUP_NAME,
-            waiting_time_ms=100,
-            parameters=[f'\'{date}\''],
-        )
-        athena_results_as_df = athena_results_to_df(daily_returns_athena_out)
-        athena_results_as_json = athena_results_as_df.to_json(orient='records')
-        return create_api_response(athena_results_as_json)
+        response_writers = BATCH_RESPONSE_WRITERS if is_batch else RESPONSE_WRITERS
+        writer, content_type = response_writers[response_format]
+
+        if cursor is not None:
+            # The query has run already, only its next page is fetched
+            query_execution = athena_executor.get_query_execution(cursor['query_execution_id'])
+            daily_returns_batches, next_token = athena_executor.fetch_page(
+                query_execution, page_size, cursor['next_token'], query_name=named_query.name
+            )
+        else:
+            # Returns never change between two candle loads,
+            # so a cached first page is served without touching Athena
+            generation = candle_generation.current()
+            execution_parameters = named_query.execution_parameters(parameter_values)
+            cache_key = result_cache_key(
+                query=named_query.query_string,
+                parameters=execution_parameters + [response_format, page_size],
+                generation=generation
+            )
+            cached_page, cache_tier = result_cache.get(cache_key)
+            print(f'Cache stats: {result_cache.stats()}')
+            if cached_page is not None:
+                cached_page = json.loads(cached_page)
+                return create_api_response(
+                    cached_page['body'], content_type, cache_tier, cached_page['next_cursor'], use_gzip
+                )
+
+            # The execution is shared by every format and page size
+            single_flight_key = result_cache_key(
+                query=named_query.query_string,
+                parameters=execution_parameters,
+                generation=generation
+            )
+            query_execution = athena_executor.execute_named(
+                named_query=named_query,
+                parameter_values=parameter_values,
+                context=context,
+                single_flight_claim=single_flight.claim(single_flight_key)
+            )
+            daily_returns_batches, next_token = athena_executor.fetch_page(
+                query_execution, page_size, query_name=named_query.name
+            )
+
+        next_cursor = None
+        if next_token is not None:
+            next_cursor = encode_cursor({
+                'query_name': named_query.name,
+                'is_batch': is_batch,
+                'page_size': page_size,
+                'query_execution_id': query_execution['QueryExecutionId'],
+                'next_token': next_token,
+            })
+        body = io.StringIO()
+        writer(daily_returns_batches, body)
+        body = body.getvalue()
+        if cursor is None:
+            result_cache.put(cache_key, json.dumps({'body': body, 'next_cursor': next_cursor}))
+        return create_api_response(body, content_type, None, next_cursor, use_gzip)
+    except TimeoutError as e:
+        return create_api_error(504, e)
     except Exception as e:
         return create_api_error(500, e)
 
 
-def create_api_response(payload):
+def daily_returns_request(query_string_params):
+    """Pick the named query and its parameters for a single date, a date range or a list of dates.
+
+    Returns (named_query, parameter_values, is_batch).
+    """
+    if 'date' in query_string_params:
+        date = dt_date.fromisoformat(query_string_params['date'])
+        return NAMED_QUERIES['daily_returns_by_date'], {'date': date}, False
+
+    if 'start_date' in query_string_params:
+        start_date = dt_date.fromisoformat(query_string_params['start_date'])
+        end_date = dt_date.fromisoformat(query_string_params['end_date'])
+        if start_date > end_date:
+            raise Exception('start_date must not be after end_date')
+        if (end_date - start_date).days >= MAX_DATES_PER_REQUEST:
+            raise Exception(f'date range can\'t be longer than {MAX_DATES_PER_REQUEST} days')
+        parameter_values = {'start_date': start_date, 'end_date': end_date}
+        return NAMED_QUERIES['daily_returns_by_date_range'], parameter_values, True
+
+    dates = sorted({
+        dt_date.fromisoformat(date) for date in query_string_params['dates'].split(',')
+    })
+    if len(dates) > MAX_DATES_PER_REQUEST:
+        raise Exception(f'dates can\'t contain more than {MAX_DATES_PER_REQUEST} dates')
+    parameter_values = {'start_date': dates[0], 'end_date': dates[-1], 'dates': dates}
+    return NAMED_QUERIES['daily_returns_by_date_list'], parameter_values, True
+
+
+def negotiate_response_format(query_string_params, headers):
+    """Pick the response format from the format parameter or the Accept header."""
+    if 'format' in query_string_params:
+        response_format = query_string_params['format']
+    else:
+        accepted_formats = [
+            (quality, ACCEPTED_MEDIA_TYPES[media_type])
+            for media_type, quality in parse_header_values(headers.get('accept', '*/*'))
+            if media_type in ACCEPTED_MEDIA_TYPES and quality > 0
+        ]
+        if not accepted_formats:
+            raise NotAcceptable(f'Supported media types: {", ".join(ACCEPTED_MEDIA_TYPES)}')
+        # max keeps the first of equally preferred formats
+        _, response_format = max(accepted_formats, key=lambda accepted: accepted[0])
+    return response_format
+
+
+def accepts_gzip(headers):
+    return any(
+        coding in ['gzip', '*'] and quality > 0
+        for coding, quality in parse_header_values(headers.get('accept-encoding', ''))
+    )
+
+
+def parse_header_values(header):
+    """Parse 'a/b;q=0.5, c/d' into [('a/b', 0.5), ('c/d', 1.0)]."""
+    values = []
+    for item in header.split(','):
+        value, *value_params = [part.strip() for part in item.split(';')]
+        if not value:
+            continue
+        quality = 1.0
+        for value_param in value_params:
+            if value_param.startswith('q='):
+                try:
+                    quality = float(value_param[2:])
+                except ValueError:
+                    quality = 0.0
+        values.append((value.lower(), quality))
+    return values
+
+
+def encode_cursor(cursor):
+    # <payload>.<HMAC of payload>, so a client can't make up a cursor
+    # that reads the results of another query or pages of any size
+    payload = base64.urlsafe_b64encode(json.dumps(cursor).encode('utf-8'))
+    return (payload + b'.' + cursor_signature(payload)).decode('ascii')
+
+
+def decode_cursor(cursor):
+    payload, _, signature = cursor.encode('ascii').partition(b'.')
+    if not hmac.compare_digest(signature, cursor_signature(payload)):
+        raise Exception('cursor is not valid')
+    cursor = json.loads(base64.urlsafe_b64decode(payload))
+    jsonschema.validate(cursor, cursor_schema)
+    return cursor
+
+
+def cursor_signature(payload):
+    return base64.urlsafe_b64encode(hmac.new(cursor_signing_key(), payload, hashlib.sha256).digest())
+
+
+@lru_cache(maxsize=1)
+def cursor_signing_key():
+    # Read once per container
+    return secretsmanager.get_secret_value(SecretId=CURSOR_SECRET_ARN)['SecretString'].encode('utf-8')
+
+
+def create_api_response(
+        payload, content_type='application/json', cache_tier=None, next_cursor=None, use_gzip=False
+):
+    headers = {
+        'Content-Type': content_type,
+        'X-Cache': f'hit-{cache_tier}' if cache_tier else 'miss',
+        'Vary': 'Accept, Accept-Encoding',
+    }
+    if next_cursor is not None:
+        headers['X-Next-Cursor'] = next_cursor
+    if use_gzip:
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        payload = gzip.compress(payload, compresslevel=6)
+        headers['Content-Encoding'] = 'gzip'
+    # Function URLs return binary bodies base64 encoded
+    is_base64_encoded = isinstance(payload, bytes)
+    if is_base64_encoded:
+        payload = base64.b64encode(payload).decode('ascii')
     return {
         'statusCode': 200,
+        'headers': headers,
+        'isBase64Encoded': is_base64_encoded,
         'body': payload
     }
 
@@ -85,151 +351,3 @@ def create_api_error(code, exception):
         'statusCode': code,
         'body': json.dumps(error)
     }
-
-
-def get_athena_results(
-        athena_client,
-        database_name,
-        query,
-        parameters=None,
-        workgroup='primary',
-        catalog_id='AwsDataCatalog',
-        waiting_time_ms=100,
-        debug=False
-):
-    if debug:
-        print(f'Query: {query}')
-    response = athena_client.start_query_execution(
-        QueryString=query,
-        QueryExecutionContext={
-            'Catalog': catalog_id,
-            'Database': database_name
-        },
-        WorkGroup=workgroup,
-        ExecutionParameters=parameters
-    )
-    query_execution_id = response['QueryExecutionId']
-    print(f'QueryExecutionId: {query_execution_id}')
-    query_status = 'RUNNING'
-    while query_status in ['RUNNING', 'QUEUED']:
-        response = athena_client.get_query_execution(
-            QueryExecutionId=query_execution_id
-        )
-        query_status = response['QueryExecution']['Status']['State']
-        print(f'Query status: {query_status}')
-        if query_status in ['RUNNING', 'QUEUED']:
-            time.sleep(waiting_time_ms / 1000)
-    if query_status != 'SUCCEEDED':
-        reason = response['QueryExecution']['Status']['StateChangeReason']
-        raise Exception(f'Query status: {query_status}\n{reason}')
-
-    response_iterator = athena_client.get_paginator('get_query_results').paginate(
-        QueryExecutionId=query_execution_id
-    )
-    raw_rows = []
-    column_info = None
-    for page in response_iterator:
-        if not column_info:
-            column_info = page['ResultSet']['ResultSetMetadata']['ColumnInfo']
-        raw_rows.extend(page['ResultSet']['Rows'])
-    response = {
-        'ResultSet': {
-            'ResultSetMetadata': {
-                'ColumnInfo': column_info
-            },
-            'Rows': raw_rows
-        }
-    }
-    return response
-
-
-def get_athena_results_with_reuse(
-        athena_client,
-        database_name,
-        query,
-        parameters=None,
-        workgroup='primary',
-        catalog_id='AwsDataCatalog',
-        waiting_time_ms=100,
-        max_age_in_minutes=1,
-        debug=False
-):
-    if debug:
-        print(f'Query: {query}')
-    response = athena_client.start_query_execution(
-        QueryString=query,
-        QueryExecutionContext={
-            'Catalog': catalog_id,
-            'Database': database_name
-        },
-        WorkGroup=workgroup,
-        ResultReuseConfiguration={
-            'ResultReuseByAgeConfiguration': {
-                'Enabled': True,
-                'MaxAgeInMinutes': max_age_in_minutes
-            }
-        },
-        ExecutionParameters=parameters
-    )
-    query_execution_id = response['QueryExecutionId']
-    print(f'QueryExecutionId: {query_execution_id}')
-    query_status = 'RUNNING'
-    while query_status in ['RUNNING', 'QUEUED']:
-        response = athena_client.get_query_execution(
-            QueryExecutionId=query_execution_id
-        )
-        query_status = response['QueryExecution']['Status']['State']
-        print(f'Query status: {query_status}')
-        if query_status in ['RUNNING', 'QUEUED']:
-            time.sleep(waiting_time_ms / 1000)
-    if query_status != 'SUCCEEDED':
-        reason = response['QueryExecution']['Status']['StateChangeReason']
-        raise Exception(f'Query status: {query_status}\n{reason}')
-
-    response_iterator = athena_client.get_paginator('get_query_results').paginate(
-        QueryExecutionId=query_execution_id
-    )
-    raw_rows = []
-    column_info = None
-    for page in response_iterator:
-        if not column_info:
-            column_info = page['ResultSet']['ResultSetMetadata']['ColumnInfo']
-        raw_rows.extend(page['ResultSet']['Rows'])
-    response = {
-        'ResultSet': {
-            'ResultSetMetadata': {
-                'ColumnInfo': column_info
-            },
-            'Rows': raw_rows
-        }
-    }
-    return response
-
-
-def athena_results_to_df(athena_results) -> pd.DataFrame:
-    columns = [col['Name'] for col in athena_results['ResultSet']['ResultSetMetadata']['ColumnInfo']]
-    column_types = [col['Type'] for col in athena_results['ResultSet']['ResultSetMetadata']['ColumnInfo']]
-    rows = athena_results['ResultSet']['Rows'][1:]
-    data_typed = []
-    for i, row in enumerate(rows):
-        data_typed.append(tuple(
-            athena_value_parser(column_type, value.get('VarCharValue', None))
-            for column_type, value in zip(column_types, row['Data'])
-        ))
-
-    return pd.DataFrame(data_typed, columns=columns)
-
-
-def athena_value_parser(column_type, value):
-    if value is None:
-        return None
-    if column_type in ["varchar", "timestamp", "char", "string", "date", "array"]:
-        return value
-    if column_type in ["int", "bigint", "integer", "smallint", "tinyint"]:
-        return int(value)
-    if column_type in ["double", "float", "decimal"]:
-        return float(value)
-    if column_type in ["boolean"]:
-        return value.lower() == "true"
-    raise Exception(f"Unknown Athena column type: {column_type}")
-
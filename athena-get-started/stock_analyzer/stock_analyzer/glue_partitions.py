@@ -0,0 +1,136 @@
+import time
+
+from single_flight import S3SingleFlight
+
+# A partition of the candle and daily_returns tables is registered in the
+# Glue Data Catalog with the S3 location of its files. Candle loader adds
+# files to the current location of a partition. Parquet compactor writes
+# a partition's rows to a new location and points the partition to it
+# with a single UpdatePartition call, so a query reads either the old
+# files or the new ones, never both
+
+# BatchGetPartition takes at most 1000 partitions, the batch create
+# and update calls at most 100
+BATCH_GET_PARTITIONS = 1000
+BATCH_WRITE_PARTITIONS = 100
+# Candle loader and parquet compactor both move files and partitions around,
+# so each of them holds the table lock while it runs. The lock expires after
+# the longest Lambda run, in case its owner dies without releasing it
+TABLE_LOCK_KEY = 'glue-tables'
+TABLE_LOCK_TTL_SECONDS = 20 * 60
+
+
+def s3_location(bucket_name, s3_prefix):
+    return f's3://{bucket_name}/{s3_prefix.strip("/")}/'
+
+
+def location_s3_prefix(location):
+    # s3://bucket/a/b/ -> a/b
+    return location.split('/', 3)[3].strip('/')
+
+
+def default_s3_prefix(s3_prefix, partition_key, partition_value):
+    return f'{s3_prefix}/{partition_key}={partition_value}'.replace('//', '/')
+
+
+def table_lock(s3_client, bucket_name, state_s3_prefix):
+    return S3SingleFlight(
+        s3_client, bucket_name, f'{state_s3_prefix}/locks', ttl_seconds=TABLE_LOCK_TTL_SECONDS
+    )
+
+
+def partition_locations(glue_client, database_name, table_name, partition_values):
+    # Returns {partition value: S3 location} of the registered partitions
+    locations = {}
+    partition_values = list(partition_values)
+    for i in range(0, len(partition_values), BATCH_GET_PARTITIONS):
+        partitions_to_get = [{'Values': [value]} for value in partition_values[i:i + BATCH_GET_PARTITIONS]]
+        while partitions_to_get:
+            response = glue_client.batch_get_partition(
+                DatabaseName=database_name,
+                TableName=table_name,
+                PartitionsToGet=partitions_to_get
+            )
+            for partition in response['Partitions']:
+                locations[partition['Values'][0]] = partition['StorageDescriptor']['Location']
+            partitions_to_get = response.get('UnprocessedKeys', [])
+            if partitions_to_get:
+                time.sleep(0.5)
+    return locations
+
+
+def all_partition_locations(glue_client, database_name, table_name):
+    # Returns {partition value: S3 location} of all the registered partitions
+    locations = {}
+    paginator = glue_client.get_paginator('get_partitions')
+    for page in paginator.paginate(DatabaseName=database_name, TableName=table_name):
+        for partition in page['Partitions']:
+            locations[partition['Values'][0]] = partition['StorageDescriptor']['Location']
+    return locations
+
+
+def register_partitions(glue_client, database_name, table_name, locations):
+    # Creates the missing partitions of {partition value: S3 location}
+    # and points the registered ones to the given location
+    current_locations = partition_locations(glue_client, database_name, table_name, locations)
+    created = [value for value in locations if value not in current_locations]
+    moved = [
+        value for value in locations
+        if value in current_locations and current_locations[value] != locations[value]
+    ]
+    if not created and not moved:
+        return
+    storage_descriptor = table_storage_descriptor(glue_client, database_name, table_name)
+    for i in range(0, len(created), BATCH_WRITE_PARTITIONS):
+        response = glue_client.batch_create_partition(
+            DatabaseName=database_name,
+            TableName=table_name,
+            PartitionInputList=[
+                partition_input(storage_descriptor, value, locations[value])
+                for value in created[i:i + BATCH_WRITE_PARTITIONS]
+            ]
+        )
+        # Shards of a load register the same partitions at the same time
+        errors = [
+            error for error in response.get('Errors', [])
+            if error['ErrorDetail']['ErrorCode'] != 'AlreadyExistsException'
+        ]
+        if errors:
+            raise Exception(f'Failed to create partitions of {table_name}: {errors}')
+    for i in range(0, len(moved), BATCH_WRITE_PARTITIONS):
+        response = glue_client.batch_update_partition(
+            DatabaseName=database_name,
+            TableName=table_name,
+            Entries=[
+                {
+                    'PartitionValueList': [value],
+                    'PartitionInput': partition_input(storage_descriptor, value, locations[value])
+                }
+                for value in moved[i:i + BATCH_WRITE_PARTITIONS]
+            ]
+        )
+        if response.get('Errors'):
+            raise Exception(f'Failed to update partitions of {table_name}: {response["Errors"]}')
+    print(f'{table_name}: registered {len(created)} partitions, moved {len(moved)}')
+
+
+def switch_partition_location(glue_client, database_name, table_name, partition_value, location):
+    storage_descriptor = table_storage_descriptor(glue_client, database_name, table_name)
+    glue_client.update_partition(
+        DatabaseName=database_name,
+        TableName=table_name,
+        PartitionValueList=[partition_value],
+        PartitionInput=partition_input(storage_descriptor, partition_value, location)
+    )
+
+
+def table_storage_descriptor(glue_client, database_name, table_name):
+    # Partitions share the columns and formats of the table
+    return glue_client.get_table(DatabaseName=database_name, Name=table_name)['Table']['StorageDescriptor']
+
+
+def partition_input(storage_descriptor, partition_value, location):
+    return {
+        'Values': [partition_value],
+        'StorageDescriptor': {**storage_descriptor, 'Location': location}
+    }
@@ -0,0 +1,209 @@
+import json
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import boto3
+import pandas as pd
+
+from athena_executor import AthenaQueryExecutor
+from glue_partitions import (
+    TABLE_LOCK_KEY, all_partition_locations, location_s3_prefix, s3_location, switch_partition_location, table_lock
+)
+from parquet_storage import read_parquet_from_s3, save_df_as_parquet
+
+BUCKET_NAME = os.environ.get('BUCKET_NAME', None)
+CANDLE_S3_PREFIX = os.environ.get('CANDLE_S3_PREFIX', None)
+DAILY_RETURNS_S3_PREFIX = os.environ.get('DAILY_RETURNS_S3_PREFIX', None)
+STATE_S3_PREFIX = os.environ.get('STATE_S3_PREFIX', None)
+DATABASE_NAME = os.environ.get('DATABASE_NAME', None)
+WORKGROUP_NAME = os.environ.get('WORKGROUP_NAME', None)
+# Files below SMALL_FILE_BYTES are compacted once a partition has
+# at least MIN_SMALL_FILES of them, into files of about TARGET_FILE_BYTES
+SMALL_FILE_BYTES = int(os.environ.get('SMALL_FILE_BYTES', str(32 * 1024 * 1024)))
+MIN_SMALL_FILES = int(os.environ.get('MIN_SMALL_FILES', '4'))
+TARGET_FILE_BYTES = int(os.environ.get('TARGET_FILE_BYTES', str(128 * 1024 * 1024)))
+# Replaced files are deleted this long after the partitions are switched to
+# the compacted files, so queries planned before the switch can still read them.
+# Candle loader doesn't add files to partitions meanwhile, both hold the table lock
+DELETE_GRACE_SECONDS = int(os.environ.get('DELETE_GRACE_SECONDS', '60'))
+
+COMPACTED_TABLES = [
+    {'table_name': 'candle', 's3_prefix': CANDLE_S3_PREFIX, 'partition_key': 'year'},
+    {'table_name': 'daily_returns', 's3_prefix': DAILY_RETURNS_S3_PREFIX, 'partition_key': 'trade_date'},
+]
+
+s3 = boto3.client('s3')
+glue = boto3.client('glue')
+athena_executor = AthenaQueryExecutor(
+    athena_client=boto3.client('athena'),
+    database_name=DATABASE_NAME,
+    workgroup=WORKGROUP_NAME
+)
+
+
+def main(event, context):
+    print(event)
+    lock_claim = table_lock(s3, BUCKET_NAME, STATE_S3_PREFIX).claim(TABLE_LOCK_KEY, exclusive=True)
+    if not lock_claim.is_owner:
+        # The next scheduled run compacts the files the loader is adding now
+        print('Candle loader holds the table lock, skipping the run')
+        return []
+    try:
+        report = compact_tables()
+    finally:
+        lock_claim.release()
+    print(json.dumps(report))
+    return report
+
+
+def compact_tables():
+    started_at = datetime.now(timezone.utc)
+    run_id = started_at.strftime('%Y%m%dT%H%M%S')
+    replaced_s3_keys = []
+    report = []
+    for table in COMPACTED_TABLES:
+        locations = all_partition_locations(glue, DATABASE_NAME, table['table_name'])
+        partitions, stale_s3_keys = list_partition_files(s3, BUCKET_NAME, table, locations, started_at)
+        # Files left at an old location by a run that failed before deleting them
+        replaced_s3_keys += stale_s3_keys
+        files_before = sum(len(files) for files in partitions.values())
+        compacted_partitions = {
+            partition_value: files for partition_value, files in partitions.items()
+            if sum(obj['Size'] < SMALL_FILE_BYTES for obj in files) >= MIN_SMALL_FILES
+        }
+        if not compacted_partitions:
+            report.append({
+                'table': table['table_name'],
+                'files_before': files_before,
+                'files_after': files_before,
+                'stale_files': len(stale_s3_keys),
+            })
+            continue
+
+        # Latency of the partition with the most files is measured before and after
+        probe_partition = max(compacted_partitions, key=lambda p: len(compacted_partitions[p]))
+        latency_before_ms = probe_query_latency_ms(table, probe_partition)
+
+        # All the files of a partition are merged into files at a new location,
+        # then the partition is pointed to it in one step. A query reads either
+        # the old files or the compacted ones, so rows are never missing or twice
+        files_after = files_before
+        for partition_value, files in compacted_partitions.items():
+            s3_prefix = f'{table["s3_prefix"]}/_compacted/{table["partition_key"]}={partition_value}/{run_id}'
+            s3_prefix = s3_prefix.replace('//', '/')
+            written_s3_keys = compact_partition(s3, BUCKET_NAME, s3_prefix, files)
+            switch_partition_location(
+                glue, DATABASE_NAME, table['table_name'], partition_value, s3_location(BUCKET_NAME, s3_prefix)
+            )
+            replaced_s3_keys += [obj['Key'] for obj in files]
+            files_after += len(written_s3_keys) - len(files)
+
+        report.append({
+            'table': table['table_name'],
+            'compacted_partitions': len(compacted_partitions),
+            'files_before': files_before,
+            'files_after': files_after,
+            'stale_files': len(stale_s3_keys),
+            'probe_partition': probe_partition,
+            'latency_before_ms': latency_before_ms,
+        })
+
+    if replaced_s3_keys:
+        print(f'Deleting {len(replaced_s3_keys)} replaced files in {DELETE_GRACE_SECONDS} s')
+        time.sleep(DELETE_GRACE_SECONDS)
+        delete_s3_keys(s3, BUCKET_NAME, replaced_s3_keys)
+        for table_report in report:
+            if 'probe_partition' in table_report:
+                table = next(t for t in COMPACTED_TABLES if t['table_name'] == table_report['table'])
+                table_report['latency_after_ms'] = probe_query_latency_ms(
+                    table, table_report['probe_partition']
+                )
+    return report
+
+
+def list_partition_files(s3_client, bucket_name, table, locations, started_at):
+    # Returns ({partition value: [{'Key': ..., 'Size': ..., 'LastModified': ...}]}
+    # of the files at the current location of each partition,
+    # [s3 keys of the files at an old location of a registered partition])
+    partition_values = {location_s3_prefix(location): value for value, location in locations.items()}
+    partition_segment = f'{table["partition_key"]}='
+    stale_before = started_at - timedelta(seconds=DELETE_GRACE_SECONDS)
+    partitions = {}
+    stale_s3_keys = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=f'{table["s3_prefix"]}/'.replace('//', '/')):
+        for obj in page.get('Contents', []):
+            s3_prefix, _ = obj['Key'].rsplit('/', 1)
+            if s3_prefix in partition_values:
+                partitions.setdefault(partition_values[s3_prefix], []).append(
+                    {'Key': obj['Key'], 'Size': obj['Size'], 'LastModified': obj['LastModified']}
+                )
+                continue
+            # e.g. <prefix>/_compacted/year=2024/<run id>/ of an earlier run.
+            # Files of a partition that is not registered yet are kept
+            partition_value = next(
+                (segment[len(partition_segment):] for segment in s3_prefix.split('/')
+                 if segment.startswith(partition_segment)),
+                None
+            )
+            if partition_value in locations and obj['LastModified'] < stale_before:
+                stale_s3_keys.append(obj['Key'])
+    return partitions, stale_s3_keys
+
+
+def compact_partition(s3_client, bucket_name, s3_prefix, files):
+    # Returns the s3 keys of the compacted files
+    # Files are read oldest first, so the last copy of a bar is the newest
+    files = sorted(files, key=lambda obj: obj['LastModified'])
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        dataframes = list(executor.map(
+            lambda obj: read_parquet_from_s3(s3_client, bucket_name, obj['Key']),
+            files
+        ))
+    partition_df = pd.concat(dataframes, ignore_index=True)
+    # A loader re-run or a full load over an incremental one stores a bar twice
+    rows_before = len(partition_df)
+    partition_df = partition_df.drop_duplicates(['symbol', 'timestamp'], keep='last')
+    partition_df['symbol'] = partition_df['symbol'].astype('category')
+    partition_df = partition_df.sort_values(['symbol', 'timestamp'], ignore_index=True)
+
+    # Merged and sorted rows compress at least as well as the inputs,
+    # so sizing by the input bytes keeps files at most TARGET_FILE_BYTES
+    file_count = math.ceil(sum(obj['Size'] for obj in files) / TARGET_FILE_BYTES)
+    rows_per_file = math.ceil(len(partition_df) / file_count)
+    compacted_s3_keys = []
+    for i in range(file_count):
+        s3_key = f'{s3_prefix}/compacted-{i:03d}.parquet'
+        save_df_as_parquet(
+            s3_client=s3_client,
+            bucket_name=bucket_name,
+            s3_key=s3_key,
+            dataframe=partition_df.iloc[i * rows_per_file:(i + 1) * rows_per_file].reset_index(drop=True)
+        )
+        compacted_s3_keys.append(s3_key)
+    print(
+        f'Compacted {len(files)} files into {file_count} at {s3_prefix}, '
+        f'dropped {rows_before - len(partition_df)} duplicate rows'
+    )
+    return compacted_s3_keys
+
+
+def delete_s3_keys(s3_client, bucket_name, s3_keys):
+    # DeleteObjects takes at most 1000 keys
+    for i in range(0, len(s3_keys), 1000):
+        s3_client.delete_objects(
+            Bucket=bucket_name,
+            Delete={'Objects': [{'Key': key} for key in s3_keys[i:i + 1000]]}
+        )
+
+
+def probe_query_latency_ms(table, partition_value):
+    # Reads every row of the partition, so it opens every file in it
+    query = f'SELECT count(*), max(timestamp) FROM {table["table_name"]} WHERE {table["partition_key"]} = ?'
+    query_execution = athena_executor.execute(
+        query, [f'\'{partition_value}\''], query_name=f'compaction_probe_{table["table_name"]}'
+    )
+    return query_execution['Statistics']['TotalExecutionTimeInMillis']
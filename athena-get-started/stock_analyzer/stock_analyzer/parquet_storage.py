@@ -0,0 +1,110 @@
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+
+def save_df_as_parquet_partitions(
+        s3_client,
+        bucket_name,
+        s3_prefix,
+        dataframe,
+        partition_key,
+        file_name='data.parquet',
+        row_group_size=100_000,
+        max_workers=16,
+        partition_s3_prefixes=None
+):
+    # Hive style layout: <s3_prefix>/<partition_key>=<value>/<file_name>,
+    # or <partition_s3_prefixes[value]>/<file_name> for a partition that
+    # was moved. The partition column itself is not stored in the files.
+    # Returns the s3 keys of the saved files
+    partition_s3_prefixes = partition_s3_prefixes or {}
+
+    def save_partition(partition):
+        partition_value, partition_df = partition
+        partition_s3_prefix = partition_s3_prefixes.get(
+            partition_value, f'{s3_prefix}/{partition_key}={partition_value}'
+        )
+        s3_key = f'{partition_s3_prefix}/{file_name}'.replace('//', '/')
+        size_bytes = save_df_as_parquet(
+            s3_client=s3_client,
+            bucket_name=bucket_name,
+            dataframe=partition_df.drop(columns=[partition_key]),
+            s3_key=s3_key,
+            sort_by=['symbol', 'timestamp'],
+            row_group_size=row_group_size
+        )
+        return s3_key, size_bytes
+
+    started_at = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        saved_files = list(executor.map(save_partition, dataframe.groupby(partition_key)))
+    elapsed_ms = (time.monotonic() - started_at) * 1000
+    print(
+        f'Saved {len(saved_files)} files ({sum(size for _, size in saved_files)} bytes) '
+        f'to {s3_prefix} in {elapsed_ms:.0f} ms'
+    )
+    return [s3_key for s3_key, _ in saved_files]
+
+
+def delete_s3_objects(s3_client, bucket_name, s3_prefix, should_delete):
+    _s3_prefix = f'{s3_prefix}/'.replace('//', '/')
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=_s3_prefix):
+        # A page has at most 1000 keys, which is the DeleteObjects limit
+        s3_keys = [obj['Key'] for obj in page.get('Contents', []) if should_delete(obj['Key'])]
+        if s3_keys:
+            s3_client.delete_objects(
+                Bucket=bucket_name,
+                Delete={'Objects': [{'Key': key} for key in s3_keys]}
+            )
+
+
+class ParquetBuffer(io.BytesIO):
+    """In-memory file for fastparquet, which closes the file it has written."""
+
+    def close(self):
+        pass
+
+
+def read_parquet_from_s3(s3_client, bucket_name, s3_key):
+    body = s3_client.get_object(Bucket=bucket_name, Key=s3_key)['Body'].read()
+    return pd.read_parquet(io.BytesIO(body), engine='fastparquet')
+
+
+def save_df_as_parquet(
+        s3_client,
+        bucket_name,
+        s3_key,
+        dataframe,
+        sort_by=None,
+        row_group_size=100_000
+):
+    # Serializes the dataframe in memory and uploads it, no file in /tmp.
+    # Returns the size of the saved file in bytes
+    if not bucket_name:
+        raise ValueError('bucket_name is not set')
+    if not s3_key:
+        raise ValueError('s3_key is not set')
+    _s3_key = s3_key.replace('//', '/')
+    if sort_by:
+        # Sorted rows give every row group narrow min/max statistics,
+        # so Athena skips the row groups that can't match a filter
+        dataframe = dataframe.sort_values(sort_by, ignore_index=True)
+    buffer = ParquetBuffer()
+    dataframe.to_parquet(
+        _s3_key,
+        engine='fastparquet',
+        compression='snappy',
+        row_group_offsets=row_group_size,
+        # Statistics for all columns: by default fastparquet skips strings
+        stats=True,
+        open_with=lambda path, mode: buffer
+    )
+    size_bytes = buffer.getbuffer().nbytes
+    buffer.seek(0)
+    # upload_fileobj switches to a multipart upload for large files
+    s3_client.upload_fileobj(buffer, bucket_name, _s3_key)
+    return size_bytes
@@ -0,0 +1,61 @@
+import json
+import time
+
+# Athena SQL queries are billed by data scanned, at least 10 MB per query
+ATHENA_PRICE_PER_TB_USD = 5.0
+ATHENA_MIN_BILLED_BYTES = 10 * 1024 * 1024
+
+# Statistics of GetQueryExecution reported as metrics, with their units
+ATHENA_STATISTICS_UNITS = {
+    'DataScannedInBytes': 'Bytes',
+    'EngineExecutionTimeInMillis': 'Milliseconds',
+    'QueryQueueTimeInMillis': 'Milliseconds',
+    'ServicePreProcessingTimeInMillis': 'Milliseconds',
+    'QueryPlanningTimeInMillis': 'Milliseconds',
+    'ServiceProcessingTimeInMillis': 'Milliseconds',
+    'TotalExecutionTimeInMillis': 'Milliseconds',
+}
+
+
+def emit_metrics(namespace, dimensions, metrics, properties=None):
+    """Print one CloudWatch Embedded Metric Format (EMF) log line.
+
+    dimensions is a dict of dimension names to values, metrics is a dict of
+    metric names to (value, unit) and properties are logged without becoming
+    metrics. CloudWatch Logs extracts the metrics from the Lambda log,
+    so no PutMetricData call is made.
+    """
+    print(json.dumps({
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': namespace,
+                'Dimensions': [list(dimensions)],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in metrics.items()],
+            }],
+        },
+        **dimensions,
+        **{name: value for name, (value, _) in metrics.items()},
+        **(properties or {}),
+    }))
+
+
+def athena_query_metrics(query_execution):
+    """Metrics of a finished query from its QueryExecution."""
+    query_statistics = query_execution.get('Statistics', {})
+    metrics = {
+        name: (query_statistics[name], unit)
+        for name, unit in ATHENA_STATISTICS_UNITS.items()
+        if name in query_statistics
+    }
+    result_reused = query_statistics.get('ResultReuseInformation', {}).get('ReusedPreviousResult', False)
+    metrics['ResultReused'] = (int(result_reused), 'Count')
+    metrics['EstimatedCostUSD'] = (athena_query_cost_usd(query_statistics, result_reused), 'None')
+    return metrics
+
+
+def athena_query_cost_usd(query_statistics, result_reused=False):
+    if result_reused:
+        return 0.0
+    billed_bytes = max(query_statistics.get('DataScannedInBytes', 0), ATHENA_MIN_BILLED_BYTES)
+    return billed_bytes / 1024 ** 4 * ATHENA_PRICE_PER_TB_USD
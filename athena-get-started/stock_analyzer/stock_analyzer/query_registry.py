@@ -0,0 +1,189 @@
+from datetime import date as dt_date
+
+# Formatters of typed parameter values into ExecutionParameters literals.
+# Partition columns like trade_date are strings, so dates are sent as strings
+PARAMETER_FORMATTERS = {
+    'string': lambda value: "'" + str(value).replace("'", "''") + "'",
+    'date': lambda value: f"'{dt_date.fromisoformat(str(value))}'",
+    'date_list': lambda value: "'" + ','.join(str(dt_date.fromisoformat(str(v))) for v in value) + "'",
+    'bigint': lambda value: str(int(value)),
+    'double': lambda value: repr(float(value)),
+}
+
+
+class NamedQuery:
+    """A query defined once and created as an Athena prepared statement.
+
+    StockAnalyzerStack creates one prepared statement per NAMED_QUERIES entry
+    in the workgroup of the function that runs it, so a request only sends
+    'EXECUTE <name>' and the parameter values.
+    parameters is a list of (name, type) in the order of the '?' placeholders.
+    result_reuse_max_age_minutes None disables Athena result reuse.
+    """
+
+    def __init__(
+            self,
+            name,
+            query_string,
+            parameters,
+            result_reuse_max_age_minutes=None,
+            timeout_seconds=None,
+            description=''
+    ):
+        self.name = name
+        self.query_string = query_string
+        self.parameters = parameters
+        self.result_reuse_max_age_minutes = result_reuse_max_age_minutes
+        self.timeout_seconds = timeout_seconds
+        self.description = description
+
+    @property
+    def execute_statement(self):
+        return f'EXECUTE {self.name}'
+
+    def execution_parameters(self, parameter_values):
+        """Format a {name: value} dict into ExecutionParameters."""
+        missing = [name for name, _ in self.parameters if name not in parameter_values]
+        if missing:
+            raise ValueError(f'{self.name} is missing parameters: {", ".join(missing)}')
+        return [
+            PARAMETER_FORMATTERS[parameter_type](parameter_values[name])
+            for name, parameter_type in self.parameters
+        ]
+
+
+# Daily returns are materialized by candle loader into a table
+# partitioned by trade_date, so the query reads a single partition.
+# Responses of these queries are cached under the candle generation, see
+# result_cache.py. Athena result reuse stays off: a result computed before
+# a candle load could be reused after it and cached under the new generation
+daily_returns_by_date = NamedQuery(
+    name='daily_returns_by_date',
+    query_string='''
+SELECT
+    symbol,
+    timestamp,
+    daily_return
+FROM
+    daily_returns
+WHERE
+    trade_date = ?
+''',
+    parameters=[('date', 'date')],
+    timeout_seconds=20,
+    description='Daily returns of all symbols on one date'
+)
+# Multi-date queries answer all requested dates with one execution
+daily_returns_by_date_range = NamedQuery(
+    name='daily_returns_by_date_range',
+    query_string='''
+SELECT
+    trade_date,
+    symbol,
+    timestamp,
+    daily_return
+FROM
+    daily_returns
+WHERE
+    trade_date BETWEEN ? AND ?
+ORDER BY
+    trade_date, symbol
+''',
+    parameters=[('start_date', 'date'), ('end_date', 'date')],
+    timeout_seconds=25,
+    description='Daily returns of all symbols between two dates'
+)
+# The BETWEEN bounds limit the partitions read,
+# the list keeps only the requested dates within them
+daily_returns_by_date_list = NamedQuery(
+    name='daily_returns_by_date_list',
+    query_string='''
+SELECT
+    trade_date,
+    symbol,
+    timestamp,
+    daily_return
+FROM
+    daily_returns
+WHERE
+    trade_date BETWEEN ? AND ?
+    AND contains(split(?, ','), trade_date)
+ORDER BY
+    trade_date, symbol
+''',
+    parameters=[('start_date', 'date'), ('end_date', 'date'), ('dates', 'date_list')],
+    timeout_seconds=25,
+    description='Daily returns of all symbols on a list of dates'
+)
+# Queries of the stock summary, run concurrently with daily_returns_by_date_range
+volatility_by_date_range = NamedQuery(
+    name='volatility_by_date_range',
+    query_string='''
+SELECT
+    symbol,
+    count(*) AS trading_days,
+    avg(daily_return) AS mean_return,
+    stddev_samp(daily_return) AS volatility
+FROM (
+    SELECT
+        symbol,
+        timestamp,
+        daily_return
+    FROM
+        daily_returns
+    WHERE
+        trade_date BETWEEN ? AND ?
+)
+GROUP BY
+    symbol
+ORDER BY
+    symbol
+''',
+    parameters=[('start_date', 'date'), ('end_date', 'date')],
+    timeout_seconds=25,
+    description='Mean and standard deviation of daily returns of all symbols between two dates'
+)
+# The year bounds limit the candle partitions read
+volume_stats_by_date_range = NamedQuery(
+    name='volume_stats_by_date_range',
+    query_string='''
+SELECT
+    symbol,
+    avg(volume) AS mean_volume,
+    min(volume) AS min_volume,
+    max(volume) AS max_volume,
+    sum(volume) AS total_volume
+FROM (
+    SELECT
+        symbol,
+        timestamp,
+        volume
+    FROM
+        candle
+    WHERE
+        year BETWEEN ? AND ?
+        AND CAST(timestamp AS date) BETWEEN CAST(? AS date) AND CAST(? AS date)
+)
+GROUP BY
+    symbol
+ORDER BY
+    symbol
+''',
+    parameters=[
+        ('start_year', 'string'), ('end_year', 'string'),
+        ('start_date', 'date'), ('end_date', 'date')
+    ],
+    timeout_seconds=25,
+    description='Volume statistics of all symbols between two dates'
+)
+
+NAMED_QUERIES = {
+    named_query.name: named_query
+    for named_query in [
+        daily_returns_by_date,
+        daily_returns_by_date_range,
+        daily_returns_by_date_list,
+        volatility_by_date_range,
+        volume_stats_by_date_range,
+    ]
+}
@@ -0,0 +1,158 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+
+from botocore.exceptions import ClientError
+
+
+class LruCache:
+    """In-process cache bounded by number of entries, total size and entry age.
+
+    Values are strings, their size is counted in UTF-8 encoded bytes.
+    Lambda keeps module-level objects between warm invocations,
+    so an instance created at import time acts as a warm-container cache.
+    """
+
+    def __init__(self, max_entries=256, max_bytes=64 * 1024 * 1024, ttl_seconds=3600):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.size_bytes = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, _, expires_at = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        # Characters outside ASCII take more than one byte
+        size_bytes = len(value.encode('utf-8'))
+        if size_bytes > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (value, size_bytes, time.monotonic() + self.ttl_seconds)
+        self.size_bytes += size_bytes
+        while len(self._entries) > self.max_entries or self.size_bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        _, size_bytes, _ = self._entries.pop(key)
+        self.size_bytes -= size_bytes
+
+
+class S3Cache:
+    """Cache shared by all containers, one S3 object per entry."""
+
+    def __init__(self, s3_client, bucket_name, prefix):
+        if not bucket_name:
+            raise ValueError('bucket_name is not set')
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+
+    def get(self, key):
+        try:
+            response = self.s3_client.get_object(
+                Bucket=self.bucket_name, Key=self._s3_key(key)
+            )
+        except self.s3_client.exceptions.NoSuchKey:
+            return None
+        return response['Body'].read().decode('utf-8')
+
+    def put(self, key, value):
+        self.s3_client.put_object(
+            Bucket=self.bucket_name, Key=self._s3_key(key), Body=value
+        )
+
+    def _s3_key(self, key):
+        return f'{self.prefix}/{key}'.replace('//', '/')
+
+
+class TwoTierCache:
+    """Looks up the in-process tier first, then the shared tier.
+
+    A shared tier hit is copied into the in-process tier. Hits and misses
+    are counted per tier and are available from stats().
+    """
+
+    def __init__(self, memory_cache, shared_cache):
+        self.memory_cache = memory_cache
+        self.shared_cache = shared_cache
+        self.counters = {'memory_hits': 0, 'shared_hits': 0, 'misses': 0}
+
+    def get(self, key):
+        """Return (value, tier) where tier is 'memory', 'shared' or None on a miss."""
+        value = self.memory_cache.get(key)
+        if value is not None:
+            self.counters['memory_hits'] += 1
+            return value, 'memory'
+        value = self.shared_cache.get(key)
+        if value is not None:
+            self.counters['shared_hits'] += 1
+            self.memory_cache.put(key, value)
+            return value, 'shared'
+        self.counters['misses'] += 1
+        return None, None
+
+    def put(self, key, value):
+        self.memory_cache.put(key, value)
+        self.shared_cache.put(key, value)
+
+    def stats(self):
+        return {
+            **self.counters,
+            'memory_entries': len(self.memory_cache),
+            'memory_bytes': self.memory_cache.size_bytes,
+        }
+
+
+class CacheGeneration:
+    """Tracks the generation marker that candle_loader rewrites after each load.
+
+    The marker's ETag changes on every write and is part of every cache key,
+    so entries computed from an older data.parquet are never looked up again.
+    The marker is re-checked at most once per check_interval_seconds.
+    """
+
+    def __init__(self, s3_client, bucket_name, s3_key, check_interval_seconds=30):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.s3_key = s3_key
+        self.check_interval_seconds = check_interval_seconds
+        self._generation = None
+        self._checked_at = None
+
+    def current(self):
+        now = time.monotonic()
+        if self._checked_at is None or now - self._checked_at > self.check_interval_seconds:
+            try:
+                response = self.s3_client.head_object(
+                    Bucket=self.bucket_name, Key=self.s3_key
+                )
+                self._generation = response['ETag'].strip('"')
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ['404', 'NoSuchKey']:
+                    raise e
+                # candle_loader has not run yet
+                self._generation = 'initial'
+            self._checked_at = now
+        return self._generation
+
+
+def result_cache_key(query, parameters, generation):
+    # Whitespace is normalized so reformatting the SQL keeps the same key
+    normalized_query = ' '.join(query.split())
+    key_source = json.dumps([normalized_query, parameters, generation])
+    return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
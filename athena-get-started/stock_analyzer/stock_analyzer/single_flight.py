@@ -0,0 +1,101 @@
+import hashlib
+import json
+import time
+import uuid
+
+from botocore.exceptions import ClientError
+
+
+class S3SingleFlight:
+    """Coalesces identical concurrent queries from all Lambda containers into one execution.
+
+    The first caller for a key claims it with a conditional S3 write
+    (If-None-Match: *) of a fresh ClientRequestToken and owns the claim.
+    Callers that lose the claim follow it with the owner's token.
+    StartQueryExecution is idempotent per ClientRequestToken, so every caller
+    with the same token gets the same QueryExecutionId and only one query
+    runs, no matter who calls Athena first. A claim expires after ttl_seconds,
+    then the next caller claims a new token.
+
+    Only the owner stops the query at its deadline, after it deleted the
+    claim. A follower that finds the query cancelled claims the key again,
+    see AthenaQueryExecutor.execute. Conditional writes need boto3 1.35.10 or newer.
+
+    An exclusive claim is a lock: it has one owner at most, and a caller that
+    can't tell who owns the key raises instead of becoming an owner of its own.
+    """
+
+    def __init__(self, s3_client, bucket_name, prefix, ttl_seconds=60):
+        if not bucket_name:
+            raise ValueError('bucket_name is not set')
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.ttl_seconds = ttl_seconds
+
+    def claim(self, key, exclusive=False):
+        s3_key = self.s3_key(key)
+        for _ in range(3):
+            token = new_client_request_token()
+            try:
+                self.s3_client.put_object(
+                    Bucket=self.bucket_name,
+                    Key=s3_key,
+                    Body=json.dumps({'token': token, 'claimed_at': time.time()}),
+                    IfNoneMatch='*'
+                )
+                print(f'Single-flight owner of {key}')
+                return SingleFlightClaim(self, key, token, is_owner=True)
+            except ClientError as e:
+                # 409 is a conflict with a concurrent conditional write
+                if e.response['Error']['Code'] not in ['PreconditionFailed', 'ConditionalRequestConflict']:
+                    raise e
+            claim = self.read_claim(s3_key)
+            if claim is None:
+                # The claim expired or was released in between, claim again
+                continue
+            if time.time() - claim['claimed_at'] <= self.ttl_seconds:
+                print(f'Single-flight follower of {key}')
+                return SingleFlightClaim(self, key, claim['token'], is_owner=False)
+            self.s3_client.delete_object(Bucket=self.bucket_name, Key=s3_key)
+        if exclusive:
+            raise Exception(f'Could not claim {key}, its claims keep changing')
+        # Claims keep changing under us, run a query of our own
+        return SingleFlightClaim(self, key, new_client_request_token(), is_owner=True)
+
+    def release(self, key, token):
+        # Another owner may have claimed the key since, its claim stays
+        s3_key = self.s3_key(key)
+        claim = self.read_claim(s3_key)
+        if claim is not None and claim['token'] == token:
+            self.s3_client.delete_object(Bucket=self.bucket_name, Key=s3_key)
+
+    def read_claim(self, s3_key):
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=s3_key)
+        except self.s3_client.exceptions.NoSuchKey:
+            return None
+        return json.loads(response['Body'].read().decode('utf-8'))
+
+    def s3_key(self, key):
+        return f'{self.prefix}/{key}'.replace('//', '/')
+
+
+class SingleFlightClaim:
+    def __init__(self, single_flight, key, token, is_owner):
+        self.single_flight = single_flight
+        self.key = key
+        self.token = token
+        self.is_owner = is_owner
+
+    def release(self):
+        if self.is_owner:
+            self.single_flight.release(self.key, self.token)
+
+    def reclaim(self):
+        return self.single_flight.claim(self.key)
+
+
+def new_client_request_token():
+    # ClientRequestToken has to be 32 to 128 characters long
+    return hashlib.sha256(uuid.uuid4().bytes).hexdigest()
@@ -1,6 +1,8 @@
 import aws_cdk as cdk
 from constructs import Construct
 
+from stock_analyzer.query_registry import NAMED_QUERIES
+
 
 def parquet_table_storage(
         columns, s3_location
@@ -61,9 +63,21 @@ class StockAnalyzerStack(cdk.Stack):
         lambda_layer = self.lambda_layer()
         self.candle_loader(
             bucket=bucket,
+            glue_database=glue_database,
+            layer=lambda_layer
+        )
+        athena_workgroup = self.daily_returns_by_date(
+            bucket=bucket,
+            glue_database=glue_database,
             layer=lambda_layer
         )
-        self.daily_returns_by_date(
+        self.stock_summary(
+            bucket=bucket,
+            glue_database=glue_database,
+            layer=lambda_layer,
+            athena_workgroup=athena_workgroup
+        )
+        self.parquet_compactor(
             bucket=bucket,
             glue_database=glue_database,
             layer=lambda_layer
@@ -72,7 +86,19 @@ class StockAnalyzerStack(cdk.Stack):
     def data_layer(self) -> tuple[cdk.aws_s3.Bucket, cdk.aws_glue.CfnDatabase]:
         # Step 1: Create an S3 bucket
         bucket = cdk.aws_s3.Bucket(
-            self, 'stock-analyzer-bucket'
+            self, 'stock-analyzer-bucket',
+            lifecycle_rules=[
+                # Cached responses of older candle loads are never read again
+                cdk.aws_s3.LifecycleRule(
+                    prefix='cache/entries/',
+                    expiration=cdk.Duration.days(2)
+                ),
+                # Single-flight claims are stale after a minute, old ones are removed daily
+                cdk.aws_s3.LifecycleRule(
+                    prefix='cache/in-flight/',
+                    expiration=cdk.Duration.days(1)
+                )
+            ]
         )
         # Step 2: Create a Glue database
         glue_database_name = 'stock_analyzer'
@@ -85,7 +111,9 @@ class StockAnalyzerStack(cdk.Stack):
             catalog_id=cdk.Aws.ACCOUNT_ID,
             database_input=glue_database_input
         )
-        # Step 3: Create a Glue table
+        # Step 3: Create a Glue table for candles partitioned by year.
+        # Candle loader registers the partitions it writes, and parquet
+        # compactor moves a partition to its compacted files, see glue_partitions.py
         parquet_storage = parquet_table_storage(
             columns=[
                 ('timestamp', 'timestamp'), ('symbol', 'string'),
@@ -98,9 +126,27 @@ class StockAnalyzerStack(cdk.Stack):
         candle_table = self.glue_table(
             database_name=glue_database.database_input.name,
             table_name='candle',
-            storage_descriptor=parquet_storage
+            storage_descriptor=parquet_storage,
+            partition_keys=[('year', 'string')]
         )
         candle_table.add_dependency(glue_database)
+
+        # Step 4: Create a Glue table for daily returns materialized by candle loader,
+        # partitioned by trade_date and registered like the candle partitions
+        daily_returns_storage = parquet_table_storage(
+            columns=[
+                ('symbol', 'string'), ('timestamp', 'timestamp'),
+                ('daily_return', 'double')
+            ],
+            s3_location=f's3://{bucket.bucket_name}/glue-db/daily_returns/'
+        )
+        daily_returns_table = self.glue_table(
+            database_name=glue_database.database_input.name,
+            table_name='daily_returns',
+            storage_descriptor=daily_returns_storage,
+            partition_keys=[('trade_date', 'string')]
+        )
+        daily_returns_table.add_dependency(glue_database)
         return bucket, glue_database
 
     def glue_table(
@@ -108,6 +154,7 @@ class StockAnalyzerStack(cdk.Stack):
             database_name,
             table_name,
             storage_descriptor,
+            partition_keys=None,
             catalog_id=cdk.Aws.ACCOUNT_ID
     ) -> cdk.aws_glue.CfnTable:
         if '-' in table_name:
@@ -116,6 +163,10 @@ class StockAnalyzerStack(cdk.Stack):
         table_input = cdk.aws_glue.CfnTable.TableInputProperty(
             name=table_name,
             storage_descriptor=storage_descriptor,
+            partition_keys=[
+                cdk.aws_glue.CfnTable.ColumnProperty(name=col_name, type=col_type)
+                for col_name, col_type in partition_keys
+            ] if partition_keys else None,
         )
         table_id = f'table-{table_name.replace("_", "-")}'
         return cdk.aws_glue.CfnTable(
@@ -145,35 +196,110 @@ class StockAnalyzerStack(cdk.Stack):
             self, 'stock-analyzer-lambda-layer',
             code=layer_code,
             compatible_runtimes=[cdk.aws_lambda.Runtime.PYTHON_3_12],
-            description='yfinance, fastparquet, numpy, urllib3, jsonschema for Python 3.12',
+            description='yfinance, fastparquet, numpy, urllib3, jsonschema, boto3 for Python 3.12',
             removal_policy=cdk.RemovalPolicy.RETAIN,
         )
 
-    def candle_loader(self, bucket, layer) -> None:
+    def candle_loader(self, bucket, glue_database, layer) -> None:
         lambda_function = cdk.aws_lambda.Function(
             self, 'candle-loader',
             runtime=cdk.aws_lambda.Runtime.PYTHON_3_12,
             code=cdk.aws_lambda.Code.from_asset(
                 path='stock_analyzer',
-                exclude=['*', '!candle_loader.py'],
+                exclude=[
+                    '*', '!candle_loader.py', '!parquet_storage.py', '!glue_partitions.py', '!single_flight.py'
+                ],
             ),
             handler='candle_loader.main',
             environment={
                 'BUCKET_NAME': bucket.bucket_name,
-                'CANDLE_S3_PREFIX': 'glue-db/candle/'
+                'CANDLE_S3_PREFIX': 'glue-db/candle/',
+                'CACHE_S3_PREFIX': 'cache',
+                'DAILY_RETURNS_S3_PREFIX': 'glue-db/daily_returns/',
+                'STATE_S3_PREFIX': 'state',
+                'DATABASE_NAME': glue_database.database_input.name,
+                # One ticker per line. Without the file the default tickers are loaded
+                'TICKERS_S3_KEY': 'config/tickers.txt',
+                # Above 1 the function invokes itself once per shard
+                'SHARD_COUNT': '1',
+                'DOWNLOAD_CONCURRENCY': '8',
+                'DOWNLOAD_RATE_PER_SECOND': '4'
             },
             layers=[layer],
             timeout=cdk.Duration.minutes(15),
-            memory_size=2048
+            memory_size=2048,
+            # A retried shard could still run after the table lock expired.
+            # The next nightly run loads what a failed run missed
+            retry_attempts=0
+        )
+        lambda_function.add_to_role_policy(
+            statement=cdk.aws_iam.PolicyStatement(
+                actions=[
+                    's3:PutObject',
+                    's3:DeleteObject'
+                ],
+                resources=[
+                    f'{bucket.bucket_arn}/glue-db/candle/*',
+                    f'{bucket.bucket_arn}/glue-db/daily_returns/*',
+                    f'{bucket.bucket_arn}/cache/candle-generation'
+                ]
+            )
+        )
+        lambda_function.add_to_role_policy(
+            statement=cdk.aws_iam.PolicyStatement(
+                actions=[
+                    's3:GetObject',
+                    's3:PutObject',
+                    's3:DeleteObject'
+                ],
+                resources=[f'{bucket.bucket_arn}/state/*']
+            )
+        )
+        lambda_function.add_to_role_policy(
+            statement=cdk.aws_iam.PolicyStatement(
+                actions=[
+                    's3:GetObject'
+                ],
+                resources=[f'{bucket.bucket_arn}/config/*']
+            )
+        )
+        # The function invokes itself to fan out the shards. Its ARN would
+        # make the role depend on the function, so the name pattern is used
+        lambda_function.add_to_role_policy(
+            statement=cdk.aws_iam.PolicyStatement(
+                actions=[
+                    'lambda:InvokeFunction'
+                ],
+                resources=[
+                    self.format_arn(
+                        service='lambda',
+                        resource='function',
+                        resource_name=f'{self.stack_name}-candleloader*',
+                        arn_format=cdk.ArnFormat.COLON_RESOURCE_NAME
+                    )
+                ]
+            )
         )
         lambda_function.add_to_role_policy(
             statement=cdk.aws_iam.PolicyStatement(
                 actions=[
-                    's3:PutObject'
+                    's3:ListBucket'
                 ],
-                resources=[f'{bucket.bucket_arn}/glue-db/candle/*']
+                resources=[bucket.bucket_arn]
             )
         )
+        lambda_function.add_to_role_policy(cdk.aws_iam.PolicyStatement(
+            actions=[
+                'glue:GetTable', 'glue:BatchGetPartition',
+                'glue:BatchCreatePartition', 'glue:BatchUpdatePartition'
+            ],
+            resources=[
+                f'arn:aws:glue:{self.region}:{self.account}:catalog',
+                f'arn:aws:glue:{self.region}:{self.account}:database/{glue_database.database_input.name}',
+                f'arn:aws:glue:{self.region}:{self.account}:table/{glue_database.database_input.name}/candle',
+                f'arn:aws:glue:{self.region}:{self.account}:table/{glue_database.database_input.name}/daily_returns'
+            ]
+        ))
         daily_schedule_rule = cdk.aws_events.Rule(
             self, 'candle-loader-schedule',
             enabled=False,
@@ -186,7 +312,7 @@ class StockAnalyzerStack(cdk.Stack):
             cdk.aws_events_targets.LambdaFunction(lambda_function)
         )
 
-    def daily_returns_by_date(self, bucket, glue_database, layer) -> None:
+    def daily_returns_by_date(self, bucket, glue_database, layer) -> cdk.aws_athena.CfnWorkGroup:
         # Athena Workgroup to control the costs of Athena queries
         # made by "Daily Returns By Date" function
         athena_workgroup = cdk.aws_athena.CfnWorkGroup(
@@ -207,6 +333,27 @@ class StockAnalyzerStack(cdk.Stack):
         )
         athena_workgroup.apply_removal_policy(cdk.RemovalPolicy.RETAIN)
 
+        # Queries of query_registry are prepared once in the workgroup,
+        # the function runs them with EXECUTE <name>
+        for named_query in NAMED_QUERIES.values():
+            prepared_statement = cdk.aws_athena.CfnPreparedStatement(
+                self, f'{named_query.name}-prepared-statement',
+                statement_name=named_query.name,
+                work_group=athena_workgroup.name,
+                query_statement=named_query.query_string,
+                description=named_query.description
+            )
+            prepared_statement.add_dependency(athena_workgroup)
+
+        # Key of the HMAC that signs the pagination cursors
+        cursor_signing_secret = cdk.aws_secretsmanager.Secret(
+            self, 'daily-returns-cursor-signing-key',
+            generate_secret_string=cdk.aws_secretsmanager.SecretStringGenerator(
+                password_length=64,
+                exclude_punctuation=True
+            )
+        )
+
         # The lambda function that computes the Daily Returns By Date
         # and its permissions
         lambda_function = cdk.aws_lambda.Function(
@@ -214,32 +361,51 @@ class StockAnalyzerStack(cdk.Stack):
             runtime=cdk.aws_lambda.Runtime.PYTHON_3_12,
             code=cdk.aws_lambda.Code.from_asset(
                 path='stock_analyzer',
-                exclude=['*', '!daily_returns_by_date.py'],
+                exclude=[
+                    '*',
+                    '!daily_returns_by_date.py',
+                    '!athena_executor.py',
+                    '!athena_results.py',
+                    '!query_metrics.py',
+                    '!query_registry.py',
+                    '!result_cache.py',
+                    '!single_flight.py',
+                ],
             ),
             handler='daily_returns_by_date.main',
             environment={
                 'DATABASE_NAME': glue_database.database_input.name,
                 'WORKGROUP_NAME': athena_workgroup.name,
+                'BUCKET_NAME': bucket.bucket_name,
+                'CACHE_S3_PREFIX': 'cache',
+                'CURSOR_SECRET_ARN': cursor_signing_secret.secret_arn,
             },
             timeout=cdk.Duration.seconds(30),
             memory_size=512,
             layers=[layer]
         )
+        cursor_signing_secret.grant_read(lambda_function)
         lambda_function.add_to_role_policy(cdk.aws_iam.PolicyStatement(
             actions=[
                 'athena:StartQueryExecution',
                 'athena:GetQueryExecution',
                 'athena:GetQueryResults',
+                'athena:StopQueryExecution',
                 'athena:GetWorkGroup',
+                'athena:GetPreparedStatement',
             ],
             resources=[f'arn:aws:athena:{self.region}:{self.account}:workgroup/{athena_workgroup.name}'],
         ))
         lambda_function.add_to_role_policy(cdk.aws_iam.PolicyStatement(
-            actions=['glue:GetTable', 'glue:GetDatabase', 'glue:GetTableVersions', 'glue:GetTableVersion'],
+            actions=[
+                'glue:GetTable', 'glue:GetDatabase', 'glue:GetTableVersions', 'glue:GetTableVersion',
+                'glue:GetPartition', 'glue:GetPartitions', 'glue:BatchGetPartition'
+            ],
             resources=[
                 f'arn:aws:glue:{self.region}:{self.account}:catalog',
                 f'arn:aws:glue:{self.region}:{self.account}:database/{glue_database.database_input.name}',
-                f'arn:aws:glue:{self.region}:{self.account}:table/{glue_database.database_input.name}/candle'
+                f'arn:aws:glue:{self.region}:{self.account}:table/{glue_database.database_input.name}/candle',
+                f'arn:aws:glue:{self.region}:{self.account}:table/{glue_database.database_input.name}/daily_returns'
             ]
         ))
         lambda_function.add_to_role_policy(cdk.aws_iam.PolicyStatement(
@@ -255,6 +421,10 @@ class StockAnalyzerStack(cdk.Stack):
                 f'arn:aws:s3:::{bucket.bucket_name}/*'
             ]
         ))
+        lambda_function.add_to_role_policy(cdk.aws_iam.PolicyStatement(
+            actions=['s3:DeleteObject'],
+            resources=[f'{bucket.bucket_arn}/cache/in-flight/*']
+        ))
 
         # Expose the lambda function via the Function URL
         function_url = lambda_function.add_function_url(
@@ -265,3 +435,201 @@ class StockAnalyzerStack(cdk.Stack):
             self, 'DailyReturnsByDateUrl',
             value=function_url.url
         )
+        return athena_workgroup
+
+    def stock_summary(self, bucket, glue_database, layer, athena_workgroup) -> None:
+        # The lambda function that returns daily returns, volatility and
+        # volume statistics of a date range. It runs the prepared statements
+        # of the "Daily Returns By Date" workgroup concurrently
+        lambda_function = cdk.aws_lambda.Function(
+            self, 'stock-summary',
+            runtime=cdk.aws_lambda.Runtime.PYTHON_3_12,
+            code=cdk.aws_lambda.Code.from_asset(
+                path='stock_analyzer',
+                exclude=[
+                    '*',
+                    '!stock_summary.py',
+                    '!athena_executor.py',
+                    '!athena_fanout.py',
+                    '!athena_results.py',
+                    '!query_metrics.py',
+                    '!query_registry.py',
+                    '!result_cache.py',
+                    '!single_flight.py',
+                ],
+            ),
+            handler='stock_summary.main',
+            environment={
+                'DATABASE_NAME': glue_database.database_input.name,
+                'WORKGROUP_NAME': athena_workgroup.name,
+                'BUCKET_NAME': bucket.bucket_name,
+                'CACHE_S3_PREFIX': 'cache',
+            },
+            timeout=cdk.Duration.seconds(30),
+            memory_size=1024,
+            layers=[layer]
+        )
+        lambda_function.add_to_role_policy(cdk.aws_iam.PolicyStatement(
+            actions=[
+                'athena:StartQueryExecution',
+                'athena:GetQueryExecution',
+                'athena:BatchGetQueryExecution',
+                'athena:GetQueryResults',
+                'athena:StopQueryExecution',
+                'athena:GetWorkGroup',
+                'athena:GetPreparedStatement',
+            ],
+            resources=[f'arn:aws:athena:{self.region}:{self.account}:workgroup/{athena_workgroup.name}'],
+        ))
+        lambda_function.add_to_role_policy(cdk.aws_iam.PolicyStatement(
+            actions=[
+                'glue:GetTable', 'glue:GetDatabase', 'glue:GetTableVersions', 'glue:GetTableVersion',
+                'glue:GetPartition', 'glue:GetPartitions', 'glue:BatchGetPartition'
+            ],
+            resources=[
+                f'arn:aws:glue:{self.region}:{self.account}:catalog',
+                f'arn:aws:glue:{self.region}:{self.account}:database/{glue_database.database_input.name}',
+                f'arn:aws:glue:{self.region}:{self.account}:table/{glue_database.database_input.name}/candle',
+                f'arn:aws:glue:{self.region}:{self.account}:table/{glue_database.database_input.name}/daily_returns'
+            ]
+        ))
+        lambda_function.add_to_role_policy(cdk.aws_iam.PolicyStatement(
+            actions=[
+                's3:GetObject',
+                's3:GetObjectVersion',
+                's3:ListBucket',
+                's3:GetBucketLocation',
+                's3:PutObject',
+            ],
+            resources=[
+                f'arn:aws:s3:::{bucket.bucket_name}',
+                f'arn:aws:s3:::{bucket.bucket_name}/*'
+            ]
+        ))
+        lambda_function.add_to_role_policy(cdk.aws_iam.PolicyStatement(
+            actions=['s3:DeleteObject'],
+            resources=[f'{bucket.bucket_arn}/cache/in-flight/*']
+        ))
+
+        function_url = lambda_function.add_function_url(
+            auth_type=cdk.aws_lambda.FunctionUrlAuthType.NONE,
+            cors=cdk.aws_lambda.FunctionUrlCorsOptions(allowed_origins=['*'])
+        )
+        cdk.CfnOutput(
+            self, 'StockSummaryUrl',
+            value=function_url.url
+        )
+
+    def parquet_compactor(self, bucket, glue_database, layer) -> None:
+        # Athena Workgroup for the probe queries that measure
+        # the query latency before and after compaction
+        athena_workgroup = cdk.aws_athena.CfnWorkGroup(
+            self, 'parquet-compactor-athena-workgroup',
+            name='com.my-company.stock-analyzer.parquet-compactor',
+            state='ENABLED',
+            work_group_configuration=cdk.aws_athena.CfnWorkGroup.WorkGroupConfigurationProperty(
+                result_configuration=cdk.aws_athena.CfnWorkGroup.ResultConfigurationProperty(
+                    output_location=f's3://{bucket.bucket_name}/athena/'
+                )
+            ),
+            tags=[
+                cdk.CfnTag(key='Environment', value='dev'),
+                cdk.CfnTag(key='Company', value='my-company'),
+                cdk.CfnTag(key='Product', value='stock-analyzer'),
+                cdk.CfnTag(key='Component', value='parquet-compactor'),
+            ]
+        )
+        athena_workgroup.apply_removal_policy(cdk.RemovalPolicy.RETAIN)
+
+        # The lambda function that merges small Parquet files
+        # of the candle and daily_returns tables
+        lambda_function = cdk.aws_lambda.Function(
+            self, 'parquet-compactor',
+            runtime=cdk.aws_lambda.Runtime.PYTHON_3_12,
+            code=cdk.aws_lambda.Code.from_asset(
+                path='stock_analyzer',
+                exclude=[
+                    '*',
+                    '!parquet_compactor.py',
+                    '!parquet_storage.py',
+                    '!glue_partitions.py',
+                    '!single_flight.py',
+                    '!athena_executor.py',
+                    '!athena_results.py',
+                    '!query_metrics.py',
+                ],
+            ),
+            handler='parquet_compactor.main',
+            environment={
+                'BUCKET_NAME': bucket.bucket_name,
+                'CANDLE_S3_PREFIX': 'glue-db/candle/',
+                'DAILY_RETURNS_S3_PREFIX': 'glue-db/daily_returns/',
+                'STATE_S3_PREFIX': 'state',
+                'DATABASE_NAME': glue_database.database_input.name,
+                'WORKGROUP_NAME': athena_workgroup.name,
+            },
+            layers=[layer],
+            timeout=cdk.Duration.minutes(15),
+            memory_size=2048
+        )
+        lambda_function.add_to_role_policy(
+            statement=cdk.aws_iam.PolicyStatement(
+                actions=[
+                    's3:GetObject',
+                    's3:PutObject',
+                    's3:DeleteObject'
+                ],
+                resources=[
+                    f'{bucket.bucket_arn}/glue-db/candle/*',
+                    f'{bucket.bucket_arn}/glue-db/daily_returns/*',
+                    # The table lock shared with the candle loader
+                    f'{bucket.bucket_arn}/state/locks/*'
+                ]
+            )
+        )
+        lambda_function.add_to_role_policy(cdk.aws_iam.PolicyStatement(
+            actions=[
+                'athena:StartQueryExecution',
+                'athena:GetQueryExecution',
+                'athena:GetQueryResults',
+                'athena:StopQueryExecution',
+                'athena:GetWorkGroup',
+            ],
+            resources=[f'arn:aws:athena:{self.region}:{self.account}:workgroup/{athena_workgroup.name}'],
+        ))
+        lambda_function.add_to_role_policy(cdk.aws_iam.PolicyStatement(
+            actions=[
+                'glue:GetTable', 'glue:GetDatabase',
+                'glue:GetPartition', 'glue:GetPartitions', 'glue:BatchGetPartition', 'glue:UpdatePartition'
+            ],
+            resources=[
+                f'arn:aws:glue:{self.region}:{self.account}:catalog',
+                f'arn:aws:glue:{self.region}:{self.account}:database/{glue_database.database_input.name}',
+                f'arn:aws:glue:{self.region}:{self.account}:table/{glue_database.database_input.name}/candle',
+                f'arn:aws:glue:{self.region}:{self.account}:table/{glue_database.database_input.name}/daily_returns'
+            ]
+        ))
+        lambda_function.add_to_role_policy(cdk.aws_iam.PolicyStatement(
+            actions=[
+                's3:GetObject',
+                's3:PutObject',
+                's3:GetBucketLocation',
+                's3:ListBucket',
+            ],
+            resources=[
+                bucket.bucket_arn,
+                f'{bucket.bucket_arn}/athena/*'
+            ]
+        ))
+        # Runs an hour after the candle loader, so the day's files are compacted
+        daily_schedule_rule = cdk.aws_events.Rule(
+            self, 'parquet-compactor-schedule',
+            enabled=False,
+            schedule=cdk.aws_events.Schedule.cron(
+                minute='0',
+                hour='3'
+            )
+        )
+        daily_schedule_rule.add_target(
+            cdk.aws_events_targets.LambdaFunction(lambda_function)
+        )
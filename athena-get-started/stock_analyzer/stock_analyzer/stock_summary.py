@@ -0,0 +1,159 @@
+import io
+import json
+import os
+import traceback
+from datetime import date as dt_date
+from functools import partial
+
+import jsonschema
+
+import boto3
+
+from athena_executor import AthenaQueryExecutor
+from athena_fanout import AthenaFanOut
+from athena_results import write_json_grouped, write_json_keyed
+from query_registry import NAMED_QUERIES
+from result_cache import (
+    CacheGeneration, LruCache, S3Cache, TwoTierCache, result_cache_key
+)
+from single_flight import S3SingleFlight
+
+DATABASE_NAME = os.environ.get('DATABASE_NAME', None)
+WORKGROUP_NAME = os.environ.get('WORKGROUP_NAME', None)
+BUCKET_NAME = os.environ.get('BUCKET_NAME', None)
+CACHE_S3_PREFIX = os.environ.get('CACHE_S3_PREFIX', None)
+
+s3 = boto3.client('s3')
+athena_executor = AthenaQueryExecutor(
+    athena_client=boto3.client('athena'),
+    database_name=DATABASE_NAME,
+    workgroup=WORKGROUP_NAME,
+    s3_client=s3
+)
+# The caches are shared with daily_returns_by_date, the keys never collide
+result_cache = TwoTierCache(
+    memory_cache=LruCache(max_entries=64, max_bytes=64 * 1024 * 1024, ttl_seconds=3600),
+    shared_cache=S3Cache(s3, BUCKET_NAME, f'{CACHE_S3_PREFIX}/entries')
+)
+single_flight = S3SingleFlight(s3, BUCKET_NAME, f'{CACHE_S3_PREFIX}/in-flight', ttl_seconds=60)
+candle_generation = CacheGeneration(
+    s3, BUCKET_NAME, f'{CACHE_S3_PREFIX}/candle-generation'.replace('//', '/')
+)
+# Sections of the summary: (named query, writer of its results)
+SUMMARY_SECTIONS = {
+    'returns': (
+        NAMED_QUERIES['daily_returns_by_date_range'],
+        partial(
+            write_json_grouped,
+            group_column='trade_date',
+            key_column='symbol',
+            value_column='daily_return'
+        )
+    ),
+    'volatility': (
+        NAMED_QUERIES['volatility_by_date_range'],
+        partial(write_json_keyed, key_column='symbol')
+    ),
+    'volume': (
+        NAMED_QUERIES['volume_stats_by_date_range'],
+        partial(write_json_keyed, key_column='symbol')
+    ),
+}
+MAX_DAYS_PER_REQUEST = 366
+stock_summary_input_schema = {
+    'type': 'object',
+    'properties': {
+        'start_date': {'type': 'string', 'pattern': '^[0-9]{4}-[0-9]{2}-[0-9]{2}$'},
+        'end_date': {'type': 'string', 'pattern': '^[0-9]{4}-[0-9]{2}-[0-9]{2}$'},
+    },
+    'required': ['start_date', 'end_date']
+}
+
+
+def main(event, context):
+    print(event)
+    # Step 1. Extract and validate input from request query string
+    try:
+        query_string_params = event.get('queryStringParameters', None)
+        if query_string_params is None:
+            raise Exception('query string is required')
+        jsonschema.validate(query_string_params, stock_summary_input_schema)
+        start_date = dt_date.fromisoformat(query_string_params['start_date'])
+        end_date = dt_date.fromisoformat(query_string_params['end_date'])
+        if start_date > end_date:
+            raise Exception('start_date must not be after end_date')
+        if (end_date - start_date).days >= MAX_DAYS_PER_REQUEST:
+            raise Exception(f'date range can\'t be longer than {MAX_DAYS_PER_REQUEST} days')
+        parameter_values = {
+            'start_date': start_date,
+            'end_date': end_date,
+            'start_year': str(start_date.year),
+            'end_year': str(end_date.year),
+        }
+    except Exception as e:
+        return create_api_error(400, e)
+
+    # Step 2. Run the queries of all sections at once and return their results
+    try:
+        generation = candle_generation.current()
+        cache_key = result_cache_key(
+            query='stock_summary',
+            parameters=[str(start_date), str(end_date)],
+            generation=generation
+        )
+        cached_body, cache_tier = result_cache.get(cache_key)
+        if cached_body is not None:
+            return create_api_response(cached_body, cache_tier)
+
+        with AthenaFanOut(athena_executor, context) as fan_out:
+            futures = {}
+            for section, (named_query, _) in SUMMARY_SECTIONS.items():
+                single_flight_key = result_cache_key(
+                    query=named_query.query_string,
+                    parameters=named_query.execution_parameters(parameter_values),
+                    generation=generation
+                )
+                futures[section] = fan_out.submit_named(
+                    named_query=named_query,
+                    parameter_values=parameter_values,
+                    single_flight_claim=single_flight.claim(single_flight_key)
+                )
+            body = io.StringIO()
+            body.write('{')
+            for i, (section, (_, writer)) in enumerate(SUMMARY_SECTIONS.items()):
+                # Raises TimeoutError at the deadline, also if a result is never set
+                _, batches = futures[section].result(timeout=fan_out.seconds_to_deadline())
+                if i > 0:
+                    body.write(',')
+                body.write(f'{json.dumps(section)}:')
+                writer(batches, body)
+            body.write('}')
+        body = body.getvalue()
+        result_cache.put(cache_key, body)
+        return create_api_response(body)
+    except TimeoutError as e:
+        return create_api_error(504, e)
+    except Exception as e:
+        return create_api_error(500, e)
+
+
+def create_api_response(payload, cache_tier=None):
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Content-Type': 'application/json',
+            'X-Cache': f'hit-{cache_tier}' if cache_tier else 'miss',
+        },
+        'body': payload
+    }
+
+
+def create_api_error(code, exception):
+    error = {
+        'message': str(exception),
+        'stack': traceback.format_exc()
+    }
+    return {
+        'statusCode': code,
+        'body': json.dumps(error)
+    }
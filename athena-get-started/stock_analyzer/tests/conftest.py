@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Lambda handlers import their sibling modules by name, as in the Lambda runtime
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'stock_analyzer'))
@@ -0,0 +1,140 @@
+import io
+import os
+import random
+import time
+
+import pandas as pd
+import pytest
+
+from athena_results import (
+    ATHENA_BOOLEAN_TYPES, ATHENA_DATETIME_TYPES, ATHENA_FLOAT_TYPES, ATHENA_INTEGER_TYPES,
+    ATHENA_STRING_TYPES, athena_csv_to_batches, athena_rows_to_df, read_athena_csv_rows
+)
+
+COLUMN_INFO = [
+    {'Name': 'symbol', 'Type': 'varchar'},
+    {'Name': 'timestamp', 'Type': 'timestamp'},
+    {'Name': 'volume', 'Type': 'bigint'},
+    {'Name': 'close', 'Type': 'double'},
+    {'Name': 'is_up', 'Type': 'boolean'},
+]
+
+
+def reference_value_parser(column_type, value):
+    # The per-value decoder the column decoder replaced
+    if value is None:
+        return None
+    if column_type in ATHENA_STRING_TYPES + ATHENA_DATETIME_TYPES:
+        return value
+    if column_type in ATHENA_INTEGER_TYPES:
+        return int(value)
+    if column_type in ATHENA_FLOAT_TYPES:
+        return float(value)
+    if column_type in ATHENA_BOOLEAN_TYPES:
+        return value.lower() == 'true'
+    raise Exception(f'Unknown Athena column type: {column_type}')
+
+
+def reference_rows_to_records(column_info, rows):
+    return [
+        {
+            col['Name']: reference_value_parser(col['Type'], cell.get('VarCharValue', None))
+            for col, cell in zip(column_info, row['Data'])
+        }
+        for row in rows
+    ]
+
+
+def random_rows(count, seed=0):
+    rng = random.Random(seed)
+    rows = []
+    for i in range(count):
+        values = [
+            rng.choice(['AAPL', 'MSFT', '^IXIC']),
+            f'2024-01-{i % 28 + 1:02d} 00:00:00.000',
+            str(rng.randint(0, 10 ** 9)),
+            repr(rng.uniform(1, 500)),
+            rng.choice(['true', 'false']),
+        ]
+        # Every column has some NULLs, which Athena sends without VarCharValue
+        rows.append({'Data': [{} if rng.random() < 0.1 else {'VarCharValue': value} for value in values]})
+    return rows
+
+
+def assert_same_as_reference(df, records):
+    assert list(df.columns) == [col['Name'] for col in COLUMN_INFO]
+    assert len(df) == len(records)
+    for record, (_, row) in zip(records, df.iterrows()):
+        for col in COLUMN_INFO:
+            expected, actual = record[col['Name']], row[col['Name']]
+            if expected is None:
+                assert pd.isna(actual)
+            elif col['Type'] in ATHENA_DATETIME_TYPES:
+                assert actual == pd.Timestamp(expected)
+            else:
+                assert actual == expected
+
+
+def test_rows_to_df_matches_per_value_decoder():
+    rows = random_rows(2000)
+    df = athena_rows_to_df(COLUMN_INFO, rows)
+    assert_same_as_reference(df, reference_rows_to_records(COLUMN_INFO, rows))
+    assert str(df['volume'].dtype) == 'Int64'
+    assert str(df['close'].dtype) == 'float64'
+    assert str(df['timestamp'].dtype) == 'datetime64[ns]'
+
+
+def athena_csv(rows):
+    # Athena CSV: every value quoted, quotes in values doubled, NULL as an empty unquoted field
+    lines = [','.join(f'"{col["Name"]}"' for col in COLUMN_INFO)]
+    for row in rows:
+        lines.append(','.join(
+            '"' + cell['VarCharValue'].replace('"', '""') + '"' if 'VarCharValue' in cell else ''
+            for cell in row['Data']
+        ))
+    return '\n'.join(lines) + '\n'
+
+
+def test_csv_batches_match_rows_to_df():
+    rows = random_rows(1000, seed=1)
+    csv_file = io.StringIO(athena_csv(rows))
+    batches = list(athena_csv_to_batches(csv_file, COLUMN_INFO, batch_size=300))
+    assert [len(batch) for batch in batches] == [300, 300, 300, 100]
+    pd.testing.assert_frame_equal(
+        pd.concat(batches, ignore_index=True), athena_rows_to_df(COLUMN_INFO, rows)
+    )
+
+
+def test_csv_pages_match_rows_to_df():
+    rows = random_rows(1000, seed=2)
+    # Values with quotes and line breaks in them
+    rows[10]['Data'][0] = {'VarCharValue': 'BRK "B"'}
+    rows[11]['Data'][0] = {'VarCharValue': 'multi\nline'}
+    csv_bytes = athena_csv(rows).encode('utf-8')
+    pages = []
+    offset = 0
+    while offset < len(csv_bytes):
+        # A ranged GET from the offset of the page
+        page_csv = read_athena_csv_rows(io.BytesIO(csv_bytes[offset:]), 300 + int(offset == 0), chunk_size=1000)
+        pages.append(pd.concat(
+            athena_csv_to_batches(io.BytesIO(page_csv), COLUMN_INFO, has_header=offset == 0), ignore_index=True
+        ))
+        offset += len(page_csv)
+    assert [len(page) for page in pages] == [300, 300, 300, 100]
+    pd.testing.assert_frame_equal(
+        pd.concat(pages, ignore_index=True), athena_rows_to_df(COLUMN_INFO, rows)
+    )
+
+
+@pytest.mark.skipif(not os.environ.get('RUN_BENCHMARKS'), reason='set RUN_BENCHMARKS=1 to run')
+@pytest.mark.parametrize('row_count', [10_000, 100_000, 1_000_000])
+def test_benchmark_column_decoder(row_count):
+    rows = random_rows(row_count)
+    started_at = time.perf_counter()
+    pd.DataFrame(reference_rows_to_records(COLUMN_INFO, rows))
+    reference_seconds = time.perf_counter() - started_at
+    started_at = time.perf_counter()
+    athena_rows_to_df(COLUMN_INFO, rows)
+    column_seconds = time.perf_counter() - started_at
+    print(f'{row_count} rows: per value {reference_seconds:.2f}s, per column {column_seconds:.2f}s')
+    assert column_seconds < reference_seconds
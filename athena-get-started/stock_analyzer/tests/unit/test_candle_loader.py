@@ -0,0 +1,166 @@
+import io
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from botocore.exceptions import ClientError
+
+pytest.importorskip('yfinance')
+# The module creates its boto3 clients at import time
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import candle_loader  # noqa: E402
+from parquet_storage import read_parquet_from_s3  # noqa: E402
+
+BUCKET_NAME = 'stock-analyzer-test'
+TRADING_DAYS = ['2024-01-02', '2024-01-03', '2024-01-04', '2024-01-05']
+
+
+class NoSuchKey(Exception):
+    pass
+
+
+class FakeS3:
+    """The S3 calls of candle_loader, over a dict of objects."""
+
+    class exceptions:
+        NoSuchKey = NoSuchKey
+
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, IfNoneMatch=None):
+        if IfNoneMatch == '*' and Key in self.objects:
+            raise ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'PutObject')
+        self.objects[Key] = Body.encode('utf-8') if isinstance(Body, str) else Body
+
+    def upload_fileobj(self, fileobj, bucket_name, s3_key):
+        self.objects[s3_key] = fileobj.read()
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise NoSuchKey(Key)
+        return {'Body': io.BytesIO(self.objects[Key])}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+    def delete_objects(self, Bucket, Delete):
+        for obj in Delete['Objects']:
+            self.objects.pop(obj['Key'], None)
+
+    def get_paginator(self, operation_name):
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        yield {'Contents': [
+            {'Key': key, 'Size': len(body)} for key, body in sorted(self.objects.items()) if key.startswith(Prefix)
+        ]}
+
+
+def yahoo_df(ticker, trading_days):
+    # The multi-level columns layout of candle_loader.download_yahoo_df
+    closes = np.arange(1, len(trading_days) + 1) * 10.0 + (100 if ticker == 'MSFT' else 0)
+    history_df = pd.DataFrame({
+        'Adj Close': closes,
+        'Close': closes,
+        'High': closes + 1,
+        'Low': closes - 1,
+        'Open': closes,
+        'Volume': np.full(len(trading_days), 1000.0),
+    }, index=pd.DatetimeIndex(trading_days))
+    return pd.concat({ticker: history_df}, axis=1).swaplevel(axis=1)
+
+
+@pytest.fixture
+def fake_s3(monkeypatch):
+    s3 = FakeS3()
+    monkeypatch.setattr(candle_loader, 's3', s3)
+    monkeypatch.setattr(candle_loader, 'BUCKET_NAME', BUCKET_NAME)
+    monkeypatch.setattr(candle_loader, 'CANDLE_S3_PREFIX', 'glue-db/candle/')
+    monkeypatch.setattr(candle_loader, 'DAILY_RETURNS_S3_PREFIX', 'glue-db/daily_returns/')
+    monkeypatch.setattr(candle_loader, 'STATE_S3_PREFIX', 'state')
+    monkeypatch.setattr(candle_loader, 'CACHE_S3_PREFIX', 'cache')
+    monkeypatch.setattr(candle_loader, 'DOWNLOAD_RATE_PER_SECOND', 1000)
+    monkeypatch.setattr(candle_loader, 'load_ticker_universe', lambda: ['AAPL', 'MSFT'])
+    # Partitions stay at their default locations
+    monkeypatch.setattr(candle_loader, 'partition_locations', lambda *args: {})
+    monkeypatch.setattr(candle_loader, 'register_partitions', lambda *args: None)
+    return s3
+
+
+def load_night(monkeypatch, mode, last_day, failed_tickers=()):
+    # A nightly run that sees the bars up to last_day
+    def download_yahoo_df(ticker, start=None, period=None):
+        if ticker in failed_tickers:
+            raise Exception(f'{ticker} timed out')
+        return yahoo_df(ticker, [day for day in TRADING_DAYS if (start is None or day >= start) and day <= last_day])
+
+    monkeypatch.setattr(candle_loader, 'download_yahoo_df', download_yahoo_df)
+    return candle_loader.load_shard(mode, 0, 1)
+
+
+def stored_rows(s3, s3_prefix):
+    return pd.concat([
+        read_parquet_from_s3(s3, BUCKET_NAME, key) for key in s3.objects
+        if key.startswith(s3_prefix) and key.endswith('.parquet')
+    ], ignore_index=True)
+
+
+def test_lagging_ticker_keeps_the_candles_of_the_others(fake_s3, monkeypatch):
+    load_night(monkeypatch, 'full', '2024-01-03')
+    # MSFT fails for a night, so the shard's earliest watermark stays put
+    report = load_night(monkeypatch, 'incremental', '2024-01-04', failed_tickers=['MSFT'])
+    assert report['failed_symbols'] == ['MSFT']
+    load_night(monkeypatch, 'incremental', '2024-01-05')
+
+    candle_df = stored_rows(fake_s3, 'glue-db/candle/')
+    stored = sorted(zip(candle_df['symbol'].astype(str), candle_df['timestamp'].dt.strftime('%Y-%m-%d')))
+    assert stored == sorted((symbol, day) for symbol in ['AAPL', 'MSFT'] for day in TRADING_DAYS)
+
+
+def test_lagging_ticker_keeps_the_daily_returns_of_the_others(fake_s3, monkeypatch):
+    load_night(monkeypatch, 'full', '2024-01-03')
+    load_night(monkeypatch, 'incremental', '2024-01-04', failed_tickers=['MSFT'])
+    load_night(monkeypatch, 'incremental', '2024-01-05')
+
+    daily_returns_df = stored_rows(fake_s3, 'glue-db/daily_returns/')
+    stored = sorted(zip(
+        daily_returns_df['symbol'].astype(str), daily_returns_df['timestamp'].dt.strftime('%Y-%m-%d')
+    ))
+    assert stored == sorted((symbol, day) for symbol in ['AAPL', 'MSFT'] for day in TRADING_DAYS)
+    # Only the first day of a symbol has no previous close
+    assert daily_returns_df['daily_return'].isna().sum() == 2
+
+
+def test_full_load_keeps_compacted_files(fake_s3, monkeypatch):
+    # Glue points the partition to them until the shards move it back
+    compacted_s3_key = 'glue-db/candle/_compacted/year=2024/20240102T030000/compacted-000.parquet'
+    fake_s3.objects[compacted_s3_key] = b'...'
+    fake_s3.objects['glue-db/candle/year=2024/shard-000-of-004.parquet'] = b'...'
+    fake_s3.objects['state/candle-watermarks/shard-000-of-004.json'] = b'{}'
+    monkeypatch.setattr(candle_loader, 'download_yahoo_df', lambda ticker, **kwargs: yahoo_df(ticker, TRADING_DAYS))
+    candle_loader.main({'mode': 'full'}, None)
+
+    assert compacted_s3_key in fake_s3.objects
+    assert 'glue-db/candle/year=2024/shard-000-of-004.parquet' not in fake_s3.objects
+    assert 'state/candle-watermarks/shard-000-of-004.json' not in fake_s3.objects
+    # The run released the table lock
+    assert not [key for key in fake_s3.objects if key.startswith('state/locks/')]
+
+
+def test_full_load_fails_while_the_table_lock_is_held(fake_s3, monkeypatch):
+    monkeypatch.setattr(candle_loader, 'TABLE_LOCK_WAIT_SECONDS', 0)
+    compactor_claim = candle_loader.table_lock(fake_s3, BUCKET_NAME, 'state').claim('glue-tables', exclusive=True)
+    assert compactor_claim.is_owner
+    with pytest.raises(Exception, match='Table lock'):
+        candle_loader.main({'mode': 'full'}, None)
+    assert not [key for key in fake_s3.objects if key.startswith('glue-db/')]
+
+
+def test_missing_volume_is_stored_as_zero():
+    yahoo_price_df = yahoo_df('^IXIC', TRADING_DAYS[:2])
+    yahoo_price_df[('Volume', '^IXIC')] = [np.nan, 5.0]
+    candle_df = candle_loader.multi_ticker_yahoo_df_to_candle_df(yahoo_price_df)
+    assert candle_df['volume'].tolist() == [0, 5]
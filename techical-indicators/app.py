@@ -21,7 +21,20 @@ class MyStack(cdk.Stack):
             self, 'TALibLayerArn',
             value=talib_layer.layer_version_arn
         )
-        lambda_function_url = self.render_mfi_chart(layers=[talib_layer])
+        # Shared layer of the candle cache, see src/candle_cache.py
+        candle_cache_bucket = cdk.aws_s3.Bucket(self, 'candle-cache-bucket')
+        # Bucket of the stock analyzer with the Glue candle table, see src/candle_sources.py.
+        # Without it candles are downloaded from Yahoo
+        candle_table_bucket_name = self.node.try_get_context('candleTableBucket')
+        candle_table_bucket = cdk.aws_s3.Bucket.from_bucket_name(
+            self, 'candle-table-bucket',
+            bucket_name=candle_table_bucket_name
+        ) if candle_table_bucket_name else None
+        lambda_function_url = self.render_mfi_chart(
+            layers=[talib_layer],
+            candle_cache_bucket=candle_cache_bucket,
+            candle_table_bucket=candle_table_bucket
+        )
         cdk.CfnOutput(
             self, 'RenderMFIChartFunctionUrl',
             value=lambda_function_url.url
@@ -53,7 +66,7 @@ class MyStack(cdk.Stack):
             removal_policy=cdk.RemovalPolicy.RETAIN
         )
 
-    def render_mfi_chart(self, layers):
+    def render_mfi_chart(self, layers, candle_cache_bucket, candle_table_bucket=None):
         lambda_function = cdk.aws_lambda.Function(
             self, 'RenderMFIChartFunction',
             runtime=cdk.aws_lambda.Runtime.PYTHON_3_11,
@@ -62,8 +75,27 @@ class MyStack(cdk.Stack):
             code=cdk.aws_lambda.Code.from_asset('src'),
             layers=layers,
             memory_size=512,
-            timeout=cdk.Duration.seconds(30)
+            timeout=cdk.Duration.seconds(30),
+            environment={
+                'CANDLE_CACHE_BUCKET': candle_cache_bucket.bucket_name,
+                'CANDLE_CACHE_PREFIX': 'candle-cache',
+            }
         )
+        candle_cache_bucket.grant_read_write(lambda_function)
+        if candle_table_bucket:
+            lambda_function.add_environment('CANDLE_TABLE_BUCKET', candle_table_bucket.bucket_name)
+            lambda_function.add_environment('CANDLE_TABLE_PREFIX', 'glue-db/candle')
+            candle_table_bucket.grant_read(lambda_function, 'glue-db/candle/*')
+            # The compactor moves candle partitions, the Glue database has their locations
+            lambda_function.add_environment('CANDLE_TABLE_DATABASE', 'stock_analyzer')
+            lambda_function.add_to_role_policy(cdk.aws_iam.PolicyStatement(
+                actions=['glue:GetPartition'],
+                resources=[
+                    self.format_arn(service='glue', resource='catalog'),
+                    self.format_arn(service='glue', resource='database', resource_name='stock_analyzer'),
+                    self.format_arn(service='glue', resource='table', resource_name='stock_analyzer/candle'),
+                ]
+            ))
         url = lambda_function.add_function_url(
             auth_type=cdk.aws_lambda.FunctionUrlAuthType.NONE,
             cors=cdk.aws_lambda.FunctionUrlCorsOptions(allowed_origins=['*'])
@@ -0,0 +1,283 @@
+import io
+import os
+import time
+from collections import OrderedDict
+from datetime import date as dt_date, datetime, timezone
+
+import boto3
+import numpy as np
+import pandas as pd
+
+from candle_sources import CANDLE_COLUMNS, default_candle_source
+
+CANDLE_CACHE_BUCKET = os.environ.get('CANDLE_CACHE_BUCKET', None)
+CANDLE_CACHE_PREFIX = os.environ.get('CANDLE_CACHE_PREFIX', 'candle-cache')
+CANDLE_CACHE_DIR = os.environ.get('CANDLE_CACHE_DIR', '/tmp/candle-cache')
+# A gap this short without bars is most likely a weekend or a holiday, but
+# may also be a failed download, so it only counts as covered for
+# EMPTY_GAP_TTL_SECONDS. A longer gap without bars is not remembered
+MAX_EMPTY_GAP_DAYS = 6
+EMPTY_GAP_TTL_SECONDS = int(os.environ.get('CANDLE_CACHE_EMPTY_GAP_TTL_SECONDS', str(6 * 3600)))
+# Candles from today on are downloaded again once they are older than this
+INTRADAY_TTL_SECONDS = int(os.environ.get('CANDLE_CACHE_INTRADAY_TTL_SECONDS', '900'))
+
+
+class S3CandleStore:
+    # Files are named by symbol, or by a path like indicators/<symbol>/<indicator>
+
+    def __init__(self, s3_client, bucket_name, prefix):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+
+    def load(self, name):
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self._s3_key(name))
+        except self.s3_client.exceptions.NoSuchKey:
+            return None
+        return response['Body'].read()
+
+    def save(self, name, data):
+        self.s3_client.put_object(Bucket=self.bucket_name, Key=self._s3_key(name), Body=data)
+
+    def _s3_key(self, name):
+        return f'{self.prefix}/{name}.npz'.replace('//', '/')
+
+
+class LocalCandleStore:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def load(self, name):
+        try:
+            with open(self._path(name), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def save(self, name, data):
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write and rename, so a concurrent reader never sees half a file
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _path(self, name):
+        return os.path.join(self.directory, f'{name}.npz')
+
+
+class CandleCache:
+    """Daily OHLCV candles per symbol, downloaded from source only once.
+
+    Each symbol keeps its candles and the date ranges already downloaded,
+    including the days without bars. A request downloads only the parts
+    of its range that are not covered yet. Short ranges without bars are
+    only covered for EMPTY_GAP_TTL_SECONDS, as the download may have failed. Candles live in an in-process
+    LRU of max_symbols symbols, which survives warm Lambda invocations,
+    and in shared_store as one compressed NumPy .npz file of columns per
+    symbol. Dates from today on are only covered for INTRADAY_TTL_SECONDS,
+    as today's candle keeps changing until the market closes.
+    """
+
+    def __init__(self, shared_store, source, max_symbols=64):
+        self.shared_store = shared_store
+        # Anything with download(symbols, start_date, end_date), see candle_sources.py
+        self.source = source
+        self.max_symbols = max_symbols
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_candles(self, symbols, start_date, end_date):
+        """Return {symbol: DataFrame of CANDLE_COLUMNS} for start_date <= date < end_date."""
+        start_date = dt_date.fromisoformat(str(start_date))
+        end_date = dt_date.fromisoformat(str(end_date))
+        today = datetime.now(timezone.utc).date()
+        entries = {}
+        # Symbols missing the same date range are downloaded together
+        symbols_by_gap = {}
+        for symbol in symbols:
+            entry, is_loaded = self._entry(symbol)
+            gaps = missing_ranges(covered_ranges(entry, today), start_date, end_date)
+            if gaps and not is_loaded:
+                # Another container may have downloaded the range already
+                entry = self._reload(symbol, entry)
+                gaps = missing_ranges(covered_ranges(entry, today), start_date, end_date)
+            entries[symbol] = entry
+            if gaps:
+                self.misses += 1
+            else:
+                self.hits += 1
+            for gap in gaps:
+                symbols_by_gap.setdefault(gap, []).append(symbol)
+
+        updated_symbols = set()
+        for (gap_start, gap_end), gap_symbols in symbols_by_gap.items():
+            downloaded = self.source.download(gap_symbols, gap_start, gap_end)
+            covered_end = min(gap_end, today)
+            for symbol in gap_symbols:
+                candle_df = downloaded.get(symbol)
+                entry = entries[symbol]
+                if candle_df is not None and not candle_df.empty:
+                    entry['candles'] = merge_candles(entry['candles'], candle_df)
+                    if gap_start < covered_end:
+                        entry['covered'] = merge_ranges(entry['covered'] + [(gap_start, covered_end)])
+                elif (gap_end - gap_start).days > MAX_EMPTY_GAP_DAYS:
+                    print(f'No candles of {symbol} between {gap_start} and {gap_end}')
+                    continue
+                elif gap_start < covered_end:
+                    entry['empty_ranges'] = live_empty_ranges(entry) + [
+                        (gap_start, covered_end, time.time() + EMPTY_GAP_TTL_SECONDS)
+                    ]
+                if gap_end > today:
+                    entry['intraday_refreshed_at'] = time.time()
+                updated_symbols.add(symbol)
+
+        for symbol in updated_symbols:
+            # Symbols without any candles, e.g. unknown ones, get no file
+            if not entries[symbol]['candles'].empty:
+                self.shared_store.save(symbol, encode_entry(entries[symbol]))
+        print(f'Candle cache: {self.hits} hits, {self.misses} misses, downloaded {sorted(updated_symbols)}')
+
+        start, end = pd.Timestamp(start_date), pd.Timestamp(end_date)
+        return {
+            symbol: entry['candles'][(entry['candles'].index >= start) & (entry['candles'].index < end)]
+            for symbol, entry in entries.items()
+        }
+
+    def _entry(self, symbol):
+        # Returns (entry, whether it was just loaded from shared_store)
+        entry = self._entries.get(symbol)
+        is_loaded = entry is None
+        if is_loaded:
+            data = self.shared_store.load(symbol)
+            entry = decode_entry(data) if data is not None else empty_entry()
+            self._entries[symbol] = entry
+            if len(self._entries) > self.max_symbols:
+                self._entries.popitem(last=False)
+        self._entries.move_to_end(symbol)
+        return entry, is_loaded
+
+    def _reload(self, symbol, entry):
+        data = self.shared_store.load(symbol)
+        if data is not None:
+            shared_entry = decode_entry(data)
+            entry = {
+                'candles': merge_candles(shared_entry['candles'], entry['candles']),
+                'covered': merge_ranges(shared_entry['covered'] + entry['covered']),
+                'empty_ranges': live_empty_ranges(shared_entry) + live_empty_ranges(entry),
+                'intraday_refreshed_at': max(
+                    shared_entry['intraday_refreshed_at'], entry['intraday_refreshed_at']
+                ),
+            }
+            self._entries[symbol] = entry
+        return entry
+
+
+def default_candle_cache():
+    if CANDLE_CACHE_BUCKET:
+        shared_store = S3CandleStore(boto3.client('s3'), CANDLE_CACHE_BUCKET, CANDLE_CACHE_PREFIX)
+    else:
+        shared_store = LocalCandleStore(CANDLE_CACHE_DIR)
+    return CandleCache(shared_store, default_candle_source())
+
+
+def empty_entry():
+    candles = pd.DataFrame(
+        {column: np.array([], dtype='float64') for column in CANDLE_COLUMNS},
+        index=pd.DatetimeIndex([], name='Date')
+    )
+    return {'candles': candles, 'covered': [], 'empty_ranges': [], 'intraday_refreshed_at': 0.0}
+
+
+def merge_candles(candles, new_candles):
+    # Downloaded candles replace cached ones of the same date
+    merged = pd.concat([candles, new_candles])
+    merged = merged[~merged.index.duplicated(keep='last')]
+    return merged.sort_index()
+
+
+def encode_entry(entry):
+    candles = entry['candles']
+    out = io.BytesIO()
+    np.savez_compressed(
+        out,
+        date=candles.index.values.astype('datetime64[D]').astype('int64'),
+        covered=np.array(
+            [[start.toordinal(), end.toordinal()] for start, end in entry['covered']], dtype='int64'
+        ).reshape(-1, 2),
+        empty_ranges=np.array(
+            [[start.toordinal(), end.toordinal()] for start, end, _ in entry['empty_ranges']], dtype='int64'
+        ).reshape(-1, 2),
+        empty_expires_at=np.array([expires_at for _, _, expires_at in entry['empty_ranges']], dtype='float64'),
+        intraday_refreshed_at=np.float64(entry['intraday_refreshed_at']),
+        **{column: candles[column].to_numpy() for column in CANDLE_COLUMNS}
+    )
+    return out.getvalue()
+
+
+def decode_entry(data):
+    with np.load(io.BytesIO(data)) as arrays:
+        index = pd.DatetimeIndex(arrays['date'].astype('datetime64[D]').astype('datetime64[ns]'), name='Date')
+        candles = pd.DataFrame({column: arrays[column] for column in CANDLE_COLUMNS}, index=index)
+        covered = [
+            (dt_date.fromordinal(int(start)), dt_date.fromordinal(int(end)))
+            for start, end in arrays['covered']
+        ]
+        # Files saved before empty ranges expired have none
+        empty_ranges = [
+            (dt_date.fromordinal(int(start)), dt_date.fromordinal(int(end)), float(expires_at))
+            for (start, end), expires_at in zip(arrays['empty_ranges'], arrays['empty_expires_at'])
+        ] if 'empty_ranges' in arrays.files else []
+        intraday_refreshed_at = float(arrays['intraday_refreshed_at'])
+    return {
+        'candles': candles,
+        'covered': covered,
+        'empty_ranges': empty_ranges,
+        'intraday_refreshed_at': intraday_refreshed_at,
+    }
+
+
+def covered_ranges(entry, today):
+    covered = entry['covered'] + [(start, end) for start, end, _ in live_empty_ranges(entry)]
+    # Dates from today on count as covered for a while after they were downloaded
+    if time.time() - entry['intraday_refreshed_at'] < INTRADAY_TTL_SECONDS:
+        covered.append((today, dt_date.max))
+    return merge_ranges(covered)
+
+
+def live_empty_ranges(entry):
+    # [(start, end, expires_at)] of the ranges without bars that are still covered
+    now = time.time()
+    return [empty_range for empty_range in entry['empty_ranges'] if empty_range[2] > now]
+
+
+def missing_ranges(covered, start_date, end_date):
+    """Return the parts of [start_date, end_date) not in the sorted, merged covered ranges."""
+    gaps = []
+    cursor = start_date
+    for covered_start, covered_end in covered:
+        if covered_end <= cursor:
+            continue
+        if covered_start >= end_date:
+            break
+        if covered_start > cursor:
+            gaps.append((cursor, covered_start))
+        cursor = covered_end
+        if cursor >= end_date:
+            break
+    if cursor < end_date:
+        gaps.append((cursor, end_date))
+    return gaps
+
+
+def merge_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
@@ -0,0 +1,245 @@
+import io
+import os
+from datetime import timedelta
+
+import boto3
+import numpy as np
+import pandas as pd
+import yfinance as yf
+
+try:
+    import fastparquet
+except ImportError:
+    # Layers built before fastparquet was added only have the Yahoo source
+    fastparquet = None
+
+# Candle table of the stock analyzer's candle loader: Parquet files in
+# <prefix>/year=YYYY/, sorted by symbol and timestamp, see parquet_storage.py.
+# Its compactor moves a partition's files elsewhere and registers the new
+# location in the Glue database, see glue_partitions.py
+CANDLE_TABLE_BUCKET = os.environ.get('CANDLE_TABLE_BUCKET', None)
+CANDLE_TABLE_PREFIX = os.environ.get('CANDLE_TABLE_PREFIX', 'glue-db/candle')
+CANDLE_TABLE_DATABASE = os.environ.get('CANDLE_TABLE_DATABASE', None)
+CANDLE_TABLE_DIR = os.environ.get('CANDLE_TABLE_DIR', None)
+CANDLE_COLUMNS = ['open', 'high', 'low', 'close', 'volume']
+# Ranged GETs of a Parquet file read at least this many bytes
+S3_READ_BUFFER_BYTES = 64 * 1024
+
+
+class YahooCandleSource:
+    def download(self, symbols, start_date, end_date):
+        # Returns {symbol: DataFrame of CANDLE_COLUMNS indexed by date}
+        data = yf.download(
+            symbols, start=str(start_date), end=str(end_date), group_by='ticker', progress=False
+        )
+        candles = {}
+        for symbol in symbols:
+            if data.empty:
+                continue
+            # A single symbol comes back without the ticker column level
+            symbol_df = data[symbol] if isinstance(data.columns, pd.MultiIndex) else data
+            symbol_df = symbol_df.rename(columns=str.lower)[CANDLE_COLUMNS].astype('float64')
+            # Rows of the other symbols' trading days are all NaN
+            symbol_df = symbol_df.dropna(how='all')
+            symbol_df.index = pd.DatetimeIndex(symbol_df.index).tz_localize(None).normalize()
+            symbol_df.index.name = 'Date'
+            candles[symbol] = symbol_df
+        return candles
+
+
+class ParquetCandleSource:
+    """Candles from the Parquet files of the Glue candle table.
+
+    Only the files of the requested years are opened, and of those only
+    the candle columns of the row groups whose symbol and timestamp
+    statistics match the request are read.
+    """
+
+    def __init__(self, files):
+        self.files = files
+
+    def download(self, symbols, start_date, end_date):
+        # Returns {symbol: DataFrame of CANDLE_COLUMNS indexed by date}
+        filters = [
+            ('symbol', 'in', list(symbols)),
+            ('timestamp', '>=', pd.Timestamp(start_date)),
+            ('timestamp', '<', pd.Timestamp(end_date)),
+        ]
+        frames = []
+        file_count, row_groups_read, row_groups_total = 0, 0, 0
+        for year in range(start_date.year, (end_date - timedelta(days=1)).year + 1):
+            for name, size in self.files.list_files(year):
+                with self.files.open(name, size) as f:
+                    parquet_file = fastparquet.ParquetFile(f)
+                    row_groups = fastparquet.api.filter_row_groups(parquet_file, filters)
+                    file_count += 1
+                    row_groups_read += len(row_groups)
+                    row_groups_total += len(parquet_file.row_groups)
+                    if row_groups:
+                        frames.append(parquet_file.to_pandas(columns=['timestamp', 'symbol'] + CANDLE_COLUMNS,
+                                                             filters=filters))
+        print(f'Candle table: read {row_groups_read} of {row_groups_total} row groups in {file_count} files')
+
+        candles = {}
+        if not frames:
+            return candles
+        candle_df = pd.concat(frames, ignore_index=True)
+        # Row groups also hold other symbols and dates
+        candle_df = candle_df[
+            candle_df['symbol'].astype(str).isin(symbols)
+            & (candle_df['timestamp'] >= pd.Timestamp(start_date))
+            & (candle_df['timestamp'] < pd.Timestamp(end_date))
+        ]
+        for symbol, symbol_df in candle_df.groupby(candle_df['symbol'].astype(str)):
+            index = pd.DatetimeIndex(symbol_df['timestamp']).tz_localize(None).normalize()
+            symbol_df = pd.DataFrame(
+                {column: symbol_df[column].to_numpy(dtype='float64') for column in CANDLE_COLUMNS},
+                index=pd.DatetimeIndex(index, name='Date')
+            ).sort_index()
+            # Candles of a day may be in more than one file after a re-run of the loader
+            candles[symbol] = symbol_df[~symbol_df.index.duplicated(keep='last')]
+        return candles
+
+
+class FallbackCandleSource:
+    """Candles from primary, and from fallback where primary has none.
+
+    Symbols missing from primary and the days after their last candle in
+    primary, e.g. today before the candle loader has run, come from fallback.
+    """
+
+    def __init__(self, primary, fallback):
+        self.primary = primary
+        self.fallback = fallback
+
+    def download(self, symbols, start_date, end_date):
+        candles = self.primary.download(symbols, start_date, end_date)
+        # Symbols missing the same date range are downloaded together
+        symbols_by_range = {}
+        for symbol in symbols:
+            candle_df = candles.get(symbol)
+            range_start = start_date if candle_df is None or candle_df.empty \
+                else candle_df.index[-1].date() + timedelta(days=1)
+            # A range of weekend days has no candles to look for
+            if range_start < end_date and np.busday_count(range_start, end_date) > 0:
+                symbols_by_range.setdefault((range_start, end_date), []).append(symbol)
+        for (range_start, range_end), range_symbols in symbols_by_range.items():
+            print(f'Candles of {range_symbols} between {range_start} and {range_end} from the fallback source')
+            for symbol, candle_df in self.fallback.download(range_symbols, range_start, range_end).items():
+                candles[symbol] = pd.concat([candles[symbol], candle_df]) if symbol in candles else candle_df
+        return candles
+
+
+class S3ParquetFiles:
+    def __init__(self, s3_client, bucket_name, prefix, glue_client=None, database_name=None):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.glue_client = glue_client
+        self.database_name = database_name
+
+    def list_files(self, year):
+        # Returns [(s3 key, size in bytes)] of the year's partition
+        s3_prefix = self.partition_s3_prefix(year)
+        if s3_prefix is None:
+            return []
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        return [
+            (obj['Key'], obj['Size'])
+            for page in paginator.paginate(Bucket=self.bucket_name, Prefix=s3_prefix)
+            for obj in page.get('Contents', [])
+            if obj['Key'].endswith('.parquet')
+        ]
+
+    def partition_s3_prefix(self, year):
+        # Without the Glue database the files are looked for at the default location
+        if self.glue_client is None:
+            return f'{self.prefix}/year={year}/'.replace('//', '/')
+        try:
+            partition = self.glue_client.get_partition(
+                DatabaseName=self.database_name, TableName='candle', PartitionValues=[str(year)]
+            )['Partition']
+        except self.glue_client.exceptions.EntityNotFoundException:
+            return None
+        # s3://bucket/a/b/ -> a/b/
+        return partition['StorageDescriptor']['Location'].split('/', 3)[3].rstrip('/') + '/'
+
+    def open(self, s3_key, size):
+        return io.BufferedReader(
+            S3RangeReader(self.s3_client, self.bucket_name, s3_key, size), buffer_size=S3_READ_BUFFER_BYTES
+        )
+
+
+class LocalParquetFiles:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def list_files(self, year):
+        partition_dir = os.path.join(self.directory, f'year={year}')
+        if not os.path.isdir(partition_dir):
+            return []
+        return [
+            (os.path.join(partition_dir, file_name), None)
+            for file_name in sorted(os.listdir(partition_dir)) if file_name.endswith('.parquet')
+        ]
+
+    def open(self, path, size):
+        return open(path, 'rb')
+
+
+class S3RangeReader(io.RawIOBase):
+    """Seekable S3 object, read with a ranged GET per read."""
+
+    def __init__(self, s3_client, bucket_name, s3_key, size):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.s3_key = s3_key
+        self.size = size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        else:
+            self.position = self.size + offset
+        return self.position
+
+    def readinto(self, buffer):
+        end = min(self.position + len(buffer), self.size)
+        if end <= self.position:
+            return 0
+        response = self.s3_client.get_object(
+            Bucket=self.bucket_name, Key=self.s3_key, Range=f'bytes={self.position}-{end - 1}'
+        )
+        data = response['Body'].read()
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+def default_candle_source():
+    if not CANDLE_TABLE_BUCKET and not CANDLE_TABLE_DIR:
+        return YahooCandleSource()
+    if fastparquet is None:
+        print('fastparquet is not installed, candles come from Yahoo')
+        return YahooCandleSource()
+    if CANDLE_TABLE_BUCKET:
+        files = S3ParquetFiles(
+            boto3.client('s3'), CANDLE_TABLE_BUCKET, CANDLE_TABLE_PREFIX,
+            glue_client=boto3.client('glue') if CANDLE_TABLE_DATABASE else None,
+            database_name=CANDLE_TABLE_DATABASE
+        )
+    else:
+        files = LocalParquetFiles(CANDLE_TABLE_DIR)
+    return FallbackCandleSource(ParquetCandleSource(files), YahooCandleSource())
@@ -0,0 +1,61 @@
+import math
+
+import numpy as np
+
+# Values of a dataset keep this many significant digits of its largest value
+FLOAT_SIGNIFICANT_DIGITS = 4
+
+
+def lttb_indices(values, target):
+    """Return the indices of at most target points that keep the shape of values.
+
+    Largest-Triangle-Three-Buckets: the first and the last point are kept,
+    the points between them are split into target - 2 buckets, and each
+    bucket keeps the point that makes the largest triangle with the point
+    kept from the previous bucket and the mean of the next bucket.
+    """
+    if target < 3:
+        raise ValueError(f'target must be at least 3, got {target}')
+    n = len(values)
+    if target >= n:
+        return np.arange(n)
+    # NaN, e.g. a day without a bar of the ticker, counts as 0
+    y = np.nan_to_num(np.asarray(values, dtype='float64'))
+    x = np.arange(n, dtype='float64')
+    edges = np.linspace(1, n - 1, target - 1).astype('int64')
+    indices = np.empty(target, dtype='int64')
+    indices[0], indices[-1] = 0, n - 1
+    kept = 0
+    for i in range(target - 2):
+        start, end = edges[i], edges[i + 1]
+        if i == target - 3:
+            next_x, next_y = x[n - 1], y[n - 1]
+        else:
+            next_x, next_y = x[end:edges[i + 2]].mean(), y[end:edges[i + 2]].mean()
+        areas = np.abs(
+            (x[kept] - next_x) * (y[start:end] - y[kept]) - (x[kept] - x[start:end]) * (next_y - y[kept])
+        )
+        kept = start + int(np.argmax(areas))
+        indices[i + 1] = kept
+    return indices
+
+
+def compact_labels(dates):
+    """Return (first date, day offsets from it) of a DatetimeIndex.
+
+    Offsets are much shorter than a date string per label.
+    """
+    if len(dates) == 0:
+        return None, []
+    days = dates.values.astype('datetime64[D]').astype('int64')
+    return str(dates[0].date()), (days - days[0]).tolist()
+
+
+def compact_values(values, significant_digits=FLOAT_SIGNIFICANT_DIGITS):
+    """Return values rounded for a chart as a JSON-ready list, with None for NaN."""
+    values = np.asarray(values, dtype='float64')
+    largest = np.nanmax(np.abs(values)) if not np.isnan(values).all() else 0.0
+    if largest > 0:
+        # e.g. 2 decimals for MFI of 0..100, thousands for OBV of millions
+        values = np.round(values, significant_digits - 1 - math.floor(math.log10(largest)))
+    return [None if math.isnan(value) else value for value in values.tolist()]
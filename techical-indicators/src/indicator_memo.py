@@ -0,0 +1,96 @@
+import os
+from collections import OrderedDict
+from datetime import date as dt_date, datetime, timezone
+
+import pandas as pd
+
+INDICATOR_MEMO_MAX_BYTES = int(os.environ.get('INDICATOR_MEMO_MAX_BYTES', str(64 * 1024 * 1024)))
+
+
+class IndicatorMemo:
+    """Computed indicator series per symbol and spec, kept in process.
+
+    Each entry holds the series over the widest final date range requested
+    so far. A request inside that range is served by slicing it, a request
+    that reaches past it only computes the uncovered edges. compute returns
+    the series for a date range computed from the spec's series_start_date.
+    Windowed indicators only depend on their warm-up. The recursive averages
+    of RSI, MACD and ATR depend on every earlier bar, but after their warm-up
+    only up to CONVERGENCE_TOLERANCE. OBV is a running total, so it is always
+    computed from HISTORY_START_DATE. Either way a slice or an edge has the
+    same values as one computation over the whole range, up to that tolerance,
+    as long as the candles don't change.
+
+    Bars from today on are not final, so they are computed on every request
+    and not kept. Entries are evicted in LRU order once their series take
+    more than max_bytes.
+    """
+
+    def __init__(self, max_bytes=INDICATOR_MEMO_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.extensions = 0
+        self.misses = 0
+
+    def get_series(self, symbol, spec, start_date, end_date, compute):
+        """Return a DataFrame of the spec's outputs for start_date <= date < end_date.
+
+        compute(start_date, end_date) returns that DataFrame for any range.
+        """
+        start_date = dt_date.fromisoformat(str(start_date))
+        end_date = dt_date.fromisoformat(str(end_date))
+        today = datetime.now(timezone.utc).date()
+        final_end_date = min(end_date, today)
+        key = (symbol, spec.key)
+
+        parts = []
+        if start_date < final_end_date:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            if entry is None or start_date > entry['end_date'] or final_end_date < entry['start_date']:
+                self.misses += 1
+                entry = {'start_date': start_date, 'end_date': final_end_date,
+                         'series': compute(start_date, final_end_date)}
+            elif start_date < entry['start_date'] or final_end_date > entry['end_date']:
+                self.extensions += 1
+                series = [entry['series']]
+                if start_date < entry['start_date']:
+                    series.insert(0, compute(start_date, entry['start_date']))
+                if final_end_date > entry['end_date']:
+                    series.append(compute(entry['end_date'], final_end_date))
+                entry = {'start_date': min(start_date, entry['start_date']),
+                         'end_date': max(final_end_date, entry['end_date']),
+                         'series': pd.concat(series)}
+            else:
+                self.hits += 1
+            self._put(key, entry)
+            parts.append(slice_series(entry['series'], start_date, final_end_date))
+        if end_date > final_end_date or not parts:
+            parts.append(compute(max(start_date, final_end_date), end_date))
+
+        total = self.hits + self.extensions + self.misses
+        print(f'Indicator memo: {self.hits} hits, {self.extensions} extended, {self.misses} misses, '
+              f'hit rate {self.hits / total if total else 0:.2f}, {len(self._entries)} series in {self.bytes} bytes')
+        return pd.concat(parts) if len(parts) > 1 else parts[0]
+
+    def _put(self, key, entry):
+        old_entry = self._entries.get(key)
+        if old_entry is entry:
+            return
+        if old_entry is not None:
+            self.bytes -= old_entry['bytes']
+        entry['bytes'] = int(entry['series'].memory_usage(deep=True).sum())
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        self.bytes += entry['bytes']
+        # Keep the entry just put, even if it alone is over max_bytes
+        while self.bytes > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self.bytes -= evicted['bytes']
+
+
+def slice_series(series_df, start_date, end_date):
+    return series_df[(series_df.index >= pd.Timestamp(start_date)) & (series_df.index < pd.Timestamp(end_date))]
@@ -0,0 +1,232 @@
+import math
+import re
+from datetime import date as dt_date, timedelta
+
+import numpy as np
+from talib import abstract
+
+# Indicators a request can ask for, by name in the query string
+SUPPORTED_INDICATORS = ['mfi', 'rsi', 'macd', 'obv', 'bbands', 'atr']
+MAX_INDICATORS_PER_REQUEST = 8
+# Query string format: name or name(param=value,...) separated by semicolons,
+# e.g. mfi;rsi(timeperiod=7);macd(fastperiod=8,slowperiod=21)
+INDICATORS_PATTERN = r'^[a-z]+(\([a-z]+=[0-9.]+(,[a-z]+=[0-9.]+)*\))?(;[a-z]+(\([a-z]+=[0-9.]+(,[a-z]+=[0-9.]+)*\))?)*$'
+INDICATOR_SPEC_REGEX = re.compile(r'([a-z]+)(?:\(([^)]*)\))?')
+# OBV is a running total, it never forgets its first bar. It is computed
+# from here whatever the requested range is, so its values don't depend on
+# the range. For a symbol listed earlier it is the total from this date on
+HISTORY_START_DATE = dt_date(1970, 1, 1)
+# Recursive averages, e.g. of RSI, ATR and MACD, never forget their first bar
+# either, but its weight decays as exp(-bars since / time constant). After
+# CONVERGENCE_TIME_CONSTANTS time constants it is below CONVERGENCE_TOLERANCE,
+# so a series that starts there agrees with one that starts at the first
+# candle up to CONVERGENCE_TOLERANCE of the scale of its values
+CONVERGENCE_TOLERANCE = 1e-9
+CONVERGENCE_TIME_CONSTANTS = -math.log(CONVERGENCE_TOLERANCE)
+# Time constant of the average of each matype over timeperiod n bars,
+# an EMA over n bars has (n + 1) / 2. Windowed averages have none
+MA_TIME_CONSTANTS = {
+    0: lambda n: 0,  # SMA
+    1: lambda n: (n + 1) / 2,  # EMA
+    2: lambda n: 0,  # WMA
+    3: lambda n: n + 1,  # DEMA, of 2 EMAs
+    4: lambda n: 3 * (n + 1) / 2,  # TEMA, of 3 EMAs
+    5: lambda n: 0,  # TRIMA
+    6: lambda n: (31 / 2) ** 2,  # KAMA, its slowest smoothing is (2 / 31) ** 2
+    7: lambda n: 20,  # MAMA, its slowest smoothing is 0.05
+    8: lambda n: 3 * (n + 1),  # T3, of 6 EMAs
+}
+CANDLE_MATRIX_COLUMNS = ['open', 'high', 'low', 'close', 'volume']
+# TA-Lib takes periods up to 100000 bars, but the warm-up of such a
+# period reaches centuries back, before any candle and any valid date
+MAX_PERIOD = 1000
+# TA-Lib's (minimum, maximum) of the parameters, see ta_func/ta_<NAME>.c
+PARAMETER_BOUNDS = {
+    'timeperiod': (2, MAX_PERIOD),
+    'fastperiod': (2, MAX_PERIOD),
+    'slowperiod': (2, MAX_PERIOD),
+    'signalperiod': (1, MAX_PERIOD),
+    'nbdevup': (-3e37, 3e37),
+    'nbdevdn': (-3e37, 3e37),
+    # SMA, EMA, WMA, DEMA, TEMA, TRIMA, KAMA, MAMA, T3
+    'matype': (0, 8),
+}
+# ATR over one bar is the true range
+INDICATOR_PARAMETER_BOUNDS = {'atr': {'timeperiod': (1, MAX_PERIOD)}}
+
+
+class IndicatorSpec:
+    """A TA-Lib indicator and its parameters, e.g. MACD with fastperiod=8.
+
+    Parameters that are not given keep the TA-Lib defaults.
+    """
+
+    def __init__(self, name, parameters=None):
+        if name not in SUPPORTED_INDICATORS:
+            raise Exception(f'Unknown indicator {name}, supported: {", ".join(SUPPORTED_INDICATORS)}')
+        self.name = name
+        defaults = abstract.Function(name).parameters
+        parameters = parameters or {}
+        unknown = [param for param in parameters if param not in defaults]
+        if unknown:
+            raise Exception(f'Unknown parameters of {name}: {", ".join(unknown)}')
+        # Values take the type of the default, e.g. timeperiod is an int
+        self.parameters = {
+            param: type(default)(parameters.get(param, default))
+            for param, default in defaults.items()
+        }
+        # TA-Lib rejects a value out of its bounds with an empty result,
+        # the streaming indicators with an error
+        for param, value in self.parameters.items():
+            minimum, maximum = INDICATOR_PARAMETER_BOUNDS.get(name, {}).get(param, PARAMETER_BOUNDS[param])
+            if not minimum <= value <= maximum:
+                raise Exception(f'{param} of {name} must be between {minimum} and {maximum}')
+        if name == 'macd' and self.parameters['fastperiod'] >= self.parameters['slowperiod']:
+            raise Exception('fastperiod of macd must be less than slowperiod')
+
+    @property
+    def label(self):
+        if not self.parameters:
+            return self.name.upper()
+        return f'{self.name.upper()}({",".join(str(value) for value in self.parameters.values())})'
+
+    @property
+    def output_names(self):
+        return abstract.Function(self.name).output_names
+
+    @property
+    def lookback(self):
+        """Number of leading bars without a value."""
+        function = abstract.Function(self.name)
+        function.set_parameters(self.parameters)
+        return function.lookback
+
+    @property
+    def key(self):
+        return '-'.join([self.name] + [str(value) for value in self.parameters.values()])
+
+    @property
+    def is_cumulative(self):
+        """Whether a value depends on every earlier bar with the same weight, like the running total of OBV."""
+        return self.name == 'obv'
+
+    @property
+    def time_constant(self):
+        """Time constant of the recursive averages in bars, 0 for windowed indicators."""
+        if self.name in ['rsi', 'atr']:
+            # Wilder's smoothing, an EMA with a weight of 1 / timeperiod
+            return self.parameters['timeperiod']
+        if self.name == 'macd':
+            # The signal line averages the MACD line, so their decays add up
+            return (self.parameters['slowperiod'] + 1) / 2 + (self.parameters['signalperiod'] + 1) / 2
+        if self.name == 'bbands':
+            return MA_TIME_CONSTANTS[self.parameters['matype']](self.parameters['timeperiod'])
+        return 0
+
+    @property
+    def warmup_bars(self):
+        """Bars before the first requested one that its value depends on, up to CONVERGENCE_TOLERANCE."""
+        return self.lookback + math.ceil(self.time_constant * CONVERGENCE_TIME_CONSTANTS)
+
+    def warmup_start_date(self, start_date):
+        """A date at least warmup_bars trading days before start_date."""
+        # 5 trading days a week, plus a week of holidays
+        return start_date - timedelta(days=math.ceil(self.warmup_bars * 7 / 5) + 7)
+
+    def series_start_date(self, start_date):
+        """The date to compute the series from for the values from start_date on.
+
+        Indicators over averages only need their warm-up, then the values
+        from start_date on don't depend on where the series starts, up to
+        CONVERGENCE_TOLERANCE. OBV starts at HISTORY_START_DATE whatever
+        start_date is, so any slice of its series has the same values.
+        """
+        if self.is_cumulative:
+            return HISTORY_START_DATE
+        return self.warmup_start_date(start_date)
+
+
+def parse_indicator_specs(indicators):
+    """Parse the indicators query string parameter into IndicatorSpecs."""
+    specs = []
+    for name, parameters in INDICATOR_SPEC_REGEX.findall(indicators):
+        parameters = dict(param.split('=') for param in parameters.split(',')) if parameters else {}
+        specs.append(IndicatorSpec(name, parameters))
+    if len(specs) > MAX_INDICATORS_PER_REQUEST:
+        raise Exception(f'indicators can\'t contain more than {MAX_INDICATORS_PER_REQUEST} indicators')
+    return specs
+
+
+def price_arrays(candle_df):
+    """Return the OHLCV columns as contiguous float64 arrays for TA-Lib.
+
+    Columns of a float64 DataFrame are already contiguous float64, so the
+    arrays are views of the DataFrame and no data is copied.
+    """
+    return {
+        column: np.ascontiguousarray(candle_df[column].to_numpy(dtype='float64', copy=False))
+        for column in ['open', 'high', 'low', 'close', 'volume']
+    }
+
+
+def compute_indicators(candle_df, specs):
+    """Run every spec over the same price arrays.
+
+    Returns a list of (spec, output name, values), one per indicator output,
+    e.g. MACD has the macd, macdsignal and macdhist outputs.
+    """
+    inputs = price_arrays(candle_df)
+    results = []
+    for spec in specs:
+        outputs = abstract.Function(spec.name)(inputs, **spec.parameters)
+        # Indicators with one output return an array, others a list of arrays
+        if isinstance(outputs, np.ndarray):
+            outputs = [outputs]
+        results += [
+            (spec, output_name, values)
+            for output_name, values in zip(spec.output_names, outputs)
+        ]
+    return results
+
+
+def candle_matrix(candle_dfs):
+    """Align the candles of several symbols into symbols × dates arrays.
+
+    Returns (dates, {column: 2D float64 array}) over the union of the dates
+    of all symbols. A symbol without a bar on a date has NaN there, e.g. a
+    holiday of its exchange or a day before its listing.
+    """
+    dates = candle_dfs[0].index
+    for candle_df in candle_dfs[1:]:
+        dates = dates.union(candle_df.index)
+    matrix = {column: np.full((len(candle_dfs), len(dates)), np.nan) for column in CANDLE_MATRIX_COLUMNS}
+    for row, candle_df in enumerate(candle_dfs):
+        positions = dates.get_indexer(candle_df.index)
+        for column in CANDLE_MATRIX_COLUMNS:
+            matrix[column][row, positions] = candle_df[column].to_numpy(dtype='float64')
+    return dates, matrix
+
+
+def compute_indicator_matrix(matrix, spec):
+    """Run spec over every row of a candle_matrix.
+
+    Returns a list of (output name, symbols × dates array). Each row is
+    computed over its own bars only, as if the dates where it has no bar
+    did not exist, and has NaN on those dates. TA-Lib's C loop over one row
+    is faster than NumPy operations over the whole matrix, so rows are
+    dispatched to TA-Lib one by one.
+    """
+    mask = ~np.isnan(matrix['close'])
+    results = [np.full(mask.shape, np.nan) for _ in spec.output_names]
+    function = abstract.Function(spec.name)
+    for row in range(mask.shape[0]):
+        row_mask = mask[row]
+        if not row_mask.any():
+            continue
+        inputs = {column: values[row, row_mask] for column, values in matrix.items()}
+        outputs = function(inputs, **spec.parameters)
+        if isinstance(outputs, np.ndarray):
+            outputs = [outputs]
+        for result, values in zip(results, outputs):
+            result[row, row_mask] = values
+    return list(zip(spec.output_names, results))
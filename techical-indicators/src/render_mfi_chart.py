@@ -1,86 +1,259 @@
+import base64
+import functools
+import gzip
+import html
 import traceback
+from datetime import date as dt_date
 
-import yfinance as yf
-from talib import abstract
+import numpy as np
+import pandas as pd
 import json
 import jsonschema
 
+from candle_cache import default_candle_cache
+from chart_payload import compact_labels, compact_values, lttb_indices
+from indicator_memo import IndicatorMemo, slice_series
+from indicators import (
+    INDICATORS_PATTERN, candle_matrix, compute_indicator_matrix, compute_indicators,
+    parse_indicator_specs
+)
+from streaming_indicators import IndicatorStreams, is_streamable
+
+# Yahoo tickers like AAPL, BRK-B, ^IXIC or EURUSD=X. Symbols end up in cache
+# file names and in the page, so nothing else, not even a leading dot, is allowed
+TICKER_PATTERN = '[A-Za-z0-9^=-][A-Za-z0-9.^=-]{0,19}'
 compute_mfi_schema = {
     'type': 'object',
     'properties': {
-        'symbol': {'type': 'string'},
+        'symbol': {'type': 'string', 'pattern': f'^{TICKER_PATTERN}$'},
+        # Comma separated symbols to compare, instead of symbol
+        'symbols': {'type': 'string', 'pattern': f'^{TICKER_PATTERN}(,{TICKER_PATTERN})*$'},
         'start_date': {'type': 'string', 'pattern': '^[0-9]{4}-[0-9]{2}-[0-9]{2}$'},
-        'end_date': {'type': 'string', 'pattern': '^[0-9]{4}-[0-9]{2}-[0-9]{2}$'}
+        'end_date': {'type': 'string', 'pattern': '^[0-9]{4}-[0-9]{2}-[0-9]{2}$'},
+        # e.g. mfi;rsi(timeperiod=7);macd, see indicators.py. Defaults to mfi
+        'indicators': {'type': 'string', 'pattern': INDICATORS_PATTERN},
+        # Downsample each dataset to this many dates, keeping the shape of the first one.
+        # LTTB keeps the first and the last date and one per bucket, so at least 3
+        'max_points': {'type': 'string', 'pattern': '^([3-9]|[1-9][0-9]+)$'},
+        # json returns the chart data without the HTML page around it
+        'format': {'type': 'string', 'enum': ['html', 'json']}
     },
-    'required': ['symbol', 'start_date', 'end_date']
+    'required': ['start_date', 'end_date'],
+    'anyOf': [{'required': ['symbol']}, {'required': ['symbols']}]
 }
+MAX_SYMBOLS_PER_REQUEST = 50
+INDEX_TICKER = {'ticker': '^IXIC', 'color': 'rgb(192,192,192)'}
+# Created at import time, so the cached candles survive warm invocations
+candle_cache = default_candle_cache()
+# Series of streamable indicators, stored next to the candles
+indicator_streams = IndicatorStreams(candle_cache)
+# Series computed by earlier requests, sliced for requests inside their range
+indicator_memo = IndicatorMemo()
+# Dash patterns that tell apart the indicators of the same ticker
+BORDER_DASHES = [[], [6, 3], [2, 2], [8, 3, 2, 3], [12, 4]]
+# Smaller responses are not worth compressing
+GZIP_MIN_BYTES = 1024
+
+
+def compute_indicator_series(ticker, specs, start_date, end_date):
+    """Return {spec key: DataFrame of its outputs} for start_date <= date < end_date.
+
+    All specs are computed in one compute_indicators call, over the candles
+    from the earliest series_start_date of them on, so the first bars of each
+    spec have values.
+    """
+    series_start_date = min(spec.series_start_date(start_date) for spec in specs)
+    candle_df = candle_cache.get_candles([ticker], series_start_date, end_date)[ticker]
+    columns = {spec.key: {} for spec in specs}
+    for spec, output_name, values in compute_indicators(candle_df, specs):
+        columns[spec.key][output_name] = values
+    return {
+        key: slice_series(pd.DataFrame(outputs, index=candle_df.index), start_date, end_date)
+        for key, outputs in columns.items()
+    }
+
 
+def ticker_indicators(ticker, candle_df, specs, start_date, end_date):
+    """Return (spec, output name, values) of each spec on the dates of candle_df.
+
+    Series come from indicator_memo when an earlier request covered the range.
+    Otherwise streamable indicators only compute the bars added since the last
+    request, the others are computed together, once per missing date range.
+    """
+    batch_specs = [spec for spec in specs if not is_streamable(spec)]
+    # {(start_date, end_date): {spec key: series}} of the ranges computed for batch_specs
+    batches = {}
 
-def compute_mfi(stock_data_df):
-    stock_data_df.columns = [
-        'open', 'high', 'low', 'close', 'adj close', 'volume'
-    ]
-    stock_data_df.drop(columns=['adj close'], inplace=True)
-    mfi = abstract.Function('mfi')
-    result = mfi(stock_data_df, timeperiod=14)
-    return result
+    def compute_batch(spec, range_start, range_end):
+        if (range_start, range_end) not in batches:
+            batches[(range_start, range_end)] = compute_indicator_series(ticker, batch_specs, range_start, range_end)
+        return batches[(range_start, range_end)][spec.key]
+
+    results = []
+    for spec in specs:
+        if is_streamable(spec):
+            compute = functools.partial(indicator_streams.get_series, ticker, spec)
+        else:
+            compute = functools.partial(compute_batch, spec)
+        series_df = indicator_memo.get_series(ticker, spec, start_date, end_date, compute)
+        series_df = series_df.reindex(candle_df.index)
+        results += [(spec, output_name, series_df[output_name].to_numpy()) for output_name in spec.output_names]
+    return results
+
+
+def batch_indicators(tickers, specs, start_date, end_date):
+    """Return (dates, {ticker: [(spec, output name, values)]}) of many tickers at once.
+
+    Series come from indicator_memo per ticker, as in ticker_indicators.
+    A spec that misses for a ticker is computed for all tickers at once:
+    their candles from the spec's warm-up on are fetched in one call,
+    aligned on one tickers × dates matrix and the spec is computed for all
+    rows of it. Cumulative indicators like OBV start at HISTORY_START_DATE,
+    so they come from indicator_streams, which only compute the new bars.
+    """
+    candles = candle_cache.get_candles(tickers, start_date, end_date)
+    dates, _ = candle_matrix([candles[ticker] for ticker in tickers])
+    # {spec key: {ticker: DataFrame of the spec's outputs on the dates of the ticker}}
+    matrix_series = {}
+
+    def compute_matrix(spec, ticker, range_start, range_end):
+        if spec.key not in matrix_series:
+            series_start_date = spec.series_start_date(dt_date.fromisoformat(start_date))
+            series_candles = candle_cache.get_candles(tickers, series_start_date, end_date)
+            series_dates, matrix = candle_matrix([series_candles[ticker] for ticker in tickers])
+            has_bar = ~np.isnan(matrix['close'])
+            outputs = compute_indicator_matrix(matrix, spec)
+            matrix_series[spec.key] = {
+                ticker: pd.DataFrame(
+                    {output_name: values[row, has_bar[row]] for output_name, values in outputs},
+                    index=series_dates[has_bar[row]]
+                )
+                for row, ticker in enumerate(tickers)
+            }
+        return slice_series(matrix_series[spec.key][ticker], range_start, range_end)
+
+    results = {ticker: [] for ticker in tickers}
+    for spec in specs:
+        for ticker in tickers:
+            if spec.is_cumulative:
+                compute = functools.partial(indicator_streams.get_series, ticker, spec)
+            else:
+                compute = functools.partial(compute_matrix, spec, ticker)
+            series_df = indicator_memo.get_series(ticker, spec, start_date, end_date, compute)
+            series_df = series_df.reindex(dates)
+            results[ticker] += [
+                (spec, output_name, series_df[output_name].to_numpy()) for output_name in spec.output_names
+            ]
+    return dates, results
 
 
 def main(event, context):
     print(event)
+    create_error = create_json_error if (event.get('queryStringParameters') or {}).get('format') == 'json' \
+        else create_html_error
     # Step 1. Extract and validate input from request query string
     try:
         query_string_params = event.get('queryStringParameters', None)
         if query_string_params is None:
             raise Exception('query string is required')
         jsonschema.validate(query_string_params, compute_mfi_schema)
+        indicator_specs = parse_indicator_specs(query_string_params.get('indicators', 'mfi'))
+        symbols = query_string_params['symbols'].split(',') if 'symbols' in query_string_params else None
+        if symbols is not None and len(symbols) > MAX_SYMBOLS_PER_REQUEST:
+            raise Exception(f'symbols can\'t contain more than {MAX_SYMBOLS_PER_REQUEST} symbols')
     except Exception as e:
-        return create_html_error(400, e)
+        return create_error(400, e)
 
     try:
-        # Step 2. Download Ticker
-        symbol = query_string_params.get('symbol')
-        tickers = [{'ticker': symbol, 'color': 'rgb(34,139,34)'}, {'ticker': '^IXIC', 'color': 'rgb(192,192,192)'}]
         start_date = query_string_params.get('start_date')
         end_date = query_string_params.get('end_date')
+        if symbols is None:
+            tickers = [{'ticker': query_string_params.get('symbol'), 'color': 'rgb(34,139,34)'}, INDEX_TICKER]
+        else:
+            # Colors spread around the color wheel, one per symbol
+            tickers = [
+                {'ticker': symbol, 'color': f'hsl({i * 360 // len(symbols)},70%,40%)'}
+                for i, symbol in enumerate(dict.fromkeys(symbols)) if symbol != INDEX_TICKER['ticker']
+            ] + [INDEX_TICKER]
 
-        datasets = []
-        data = yf.download([item['ticker'] for item in tickers], start=start_date, end=end_date, group_by='ticker')
+        # Step 2. Get candles of the tickers, downloading only what is not cached yet,
+        # and compute all requested indicators of each ticker
+        if symbols is None:
+            candles = candle_cache.get_candles([item['ticker'] for item in tickers], start_date, end_date)
+            # One column level per ticker, on the dates of all tickers
+            data = pd.concat(candles, axis=1)
+            dates = data.index
+            indicator_results = {
+                item['ticker']: ticker_indicators(
+                    item['ticker'], data[item['ticker']], indicator_specs, start_date, end_date
+                )
+                for item in tickers
+            }
+        else:
+            dates, indicator_results = batch_indicators(
+                [item['ticker'] for item in tickers], indicator_specs, start_date, end_date
+            )
 
-        # Step 3. Compute Money Flow Index
+        datasets = []
         for item in tickers:
-            mfi = compute_mfi(data[item['ticker']])
+            # Prepare dataset for each output of each indicator. Indicators have
+            # different ranges, e.g. MFI is 0..100 and OBV is millions, so each has its own axis
+            for i, (spec, output_name, values) in enumerate(indicator_results[item['ticker']]):
+                output_label = spec.label if len(spec.output_names) == 1 else f'{spec.label} {output_name}'
+                datasets.append({
+                    "label": f"{item['ticker']} {output_label}",
+                    "data": values,
+                    "fill": False,
+                    "borderColor": f"{item['color']}",
+                    "borderDash": BORDER_DASHES[i % len(BORDER_DASHES)],
+                    "pointStyle": False,
+                    "yAxisID": spec.label
+                })
 
-            # Prepare dataset for each stock's MFI
-            datasets.append({
-                "label": item['ticker'] + " MFI",
-                "data": mfi.tolist(),
-                "fill": False,
-                "borderColor": f"{item['color']}",
-                "pointStyle": False
-            })
+        # Step 3. Downsample and round the datasets, and label dates by their day offset
+        max_points = query_string_params.get('max_points')
+        if max_points is not None:
+            indices = lttb_indices(datasets[0]['data'], int(max_points))
+            dates = dates[indices]
+            for dataset in datasets:
+                dataset['data'] = dataset['data'][indices]
+        for dataset in datasets:
+            dataset['data'] = compact_values(dataset['data'])
+        labels_start, labels = compact_labels(dates)
 
         # Step 4. Prepare chart.js chart data object
         chart_data = {
             "type": "line",
             "data": {
-                "labels": [str(date.date()) for date in data.index],
+                # Day offsets from labelsStart, turned into dates by the page
+                "labelsStart": labels_start,
+                "labels": labels,
                 "datasets": datasets
             },
             "options": {
                 "title": {
                     "display": True,
-                    "text": 'Money Flow Index (MFI) of Stocks'
+                    "text": f'{", ".join(spec.label for spec in indicator_specs)} of Stocks'
                 },
+                "scales": {
+                    spec.label: {
+                        "type": "linear",
+                        "position": "left" if i == 0 else "right",
+                        "title": {"display": True, "text": spec.label}
+                    }
+                    for i, spec in enumerate(indicator_specs)
+                }
             }
         }
-        return create_html_response(chart_data)
+        if query_string_params.get('format') == 'json':
+            return create_json_response(chart_data, event)
+        return create_html_response(chart_data, event)
     except Exception as e:
         print(e)
-        return create_html_error(500, e)
+        return create_error(500, e)
 
 
-def create_html_response(chart_data):
+def create_html_response(chart_data, event):
     html_content = f"""
     <div>
         <canvas id="stockChart"></canvas>
@@ -88,25 +261,54 @@ def create_html_response(chart_data):
     <script src="https://cdn.jsdelivr.net/npm/chart.js"></script>
     <script>
         var ctx = document.getElementById('stockChart').getContext('2d');
-        var chartData = {json.dumps(chart_data)};
+        var chartData = {script_json(chart_data)};
+        var labelsStart = Date.parse(chartData.data.labelsStart);
+        chartData.data.labels = chartData.data.labels.map(function (days) {{
+            return new Date(labelsStart + days * 86400000).toISOString().slice(0, 10);
+        }});
         new Chart(ctx, chartData);
     </script>
     """
+    return create_response(200, 'text/html', html_content, event)
+
+
+def script_json(data):
+    # JSON that can't close the <script> element it is embedded in
+    return json.dumps(data, separators=(',', ':')) \
+        .replace('<', '\\u003c').replace('>', '\\u003e').replace('&', '\\u0026')
+
 
+def create_json_response(chart_data, event):
+    return create_response(200, 'application/json', json.dumps(chart_data, separators=(',', ':')), event)
+
+
+def create_response(code, content_type, body, event):
+    accept_encoding = (event.get('headers') or {}).get('accept-encoding', '')
+    if 'gzip' not in accept_encoding or len(body) < GZIP_MIN_BYTES:
+        return {
+            'statusCode': code,
+            'headers': {
+                'Content-Type': content_type,
+            },
+            'body': body,
+        }
     return {
-        "statusCode": 200,
-        "headers": {
-            "Content-Type": "text/html",
+        'statusCode': code,
+        'headers': {
+            'Content-Type': content_type,
+            'Content-Encoding': 'gzip',
         },
-        "body": html_content,
+        # Level 5 is about as small as the default 6 at half the CPU time
+        'body': base64.b64encode(gzip.compress(body.encode(), compresslevel=5)).decode(),
+        'isBase64Encoded': True,
     }
 
 
 def create_html_error(code, exception):
     html_content = f"""
     <h3>Error</h3>
-    <pre>{str(exception)}</pre>
-    <pre>{traceback.format_exc()}</pre>
+    <pre>{html.escape(str(exception))}</pre>
+    <pre>{html.escape(traceback.format_exc())}</pre>
     """
     return {
         'statusCode': code,
@@ -115,3 +317,13 @@ def create_html_error(code, exception):
         },
         'body': html_content
     }
+
+
+def create_json_error(code, exception):
+    return {
+        'statusCode': code,
+        'headers': {
+            'Content-Type': 'application/json',
+        },
+        'body': json.dumps({'error': str(exception)})
+    }
@@ -0,0 +1,434 @@
+import copy
+import io
+import json
+import math
+from collections import deque
+from datetime import date as dt_date, datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+
+# TA-Lib treats values within 1e-8 of zero as zero
+TA_EPSILON = 0.00000001
+CANDLE_COLUMNS = ['open', 'high', 'low', 'close', 'volume']
+
+
+def check_period(name, value, minimum=2):
+    # TA-Lib's lower bound of the period, see indicators.PARAMETER_BOUNDS.
+    # A state with a shorter period never gets stored
+    if value < minimum:
+        raise Exception(f'{name} must be at least {minimum}, got {value}')
+
+
+class StreamingMFI:
+    """Money Flow Index over a window of positive and negative money flows."""
+
+    output_names = ['real']
+
+    def __init__(self, timeperiod=14):
+        check_period('timeperiod', timeperiod)
+        self.timeperiod = timeperiod
+        self.bar_count = 0
+        self.prev_typical_price = None
+        # Positive and negative money flows of the last timeperiod bars
+        self.flows = deque()
+        self.pos_sum = 0.0
+        self.neg_sum = 0.0
+
+    def update(self, open_, high, low, close, volume):
+        typical_price = (high + low + close) / 3.0
+        self.bar_count += 1
+        if self.prev_typical_price is None:
+            self.prev_typical_price = typical_price
+            return (math.nan,)
+        change = typical_price - self.prev_typical_price
+        self.prev_typical_price = typical_price
+        money_flow = typical_price * volume
+        if len(self.flows) == self.timeperiod:
+            pos, neg = self.flows.popleft()
+            self.pos_sum -= pos
+            self.neg_sum -= neg
+        pos, neg = (money_flow, 0.0) if change > 0 else (0.0, money_flow) if change < 0 else (0.0, 0.0)
+        self.flows.append((pos, neg))
+        self.pos_sum += pos
+        self.neg_sum += neg
+        if self.bar_count <= self.timeperiod:
+            return (math.nan,)
+        total = self.pos_sum + self.neg_sum
+        return (0.0 if total < 1.0 else 100.0 * (self.pos_sum / total),)
+
+
+class StreamingRSI:
+    """Relative Strength Index with Wilder's smoothing of gains and losses."""
+
+    output_names = ['real']
+
+    def __init__(self, timeperiod=14):
+        check_period('timeperiod', timeperiod)
+        self.timeperiod = timeperiod
+        self.bar_count = 0
+        self.prev_close = None
+        self.gain = 0.0
+        self.loss = 0.0
+
+    def update(self, open_, high, low, close, volume):
+        self.bar_count += 1
+        if self.prev_close is None:
+            self.prev_close = close
+            return (math.nan,)
+        change = close - self.prev_close
+        self.prev_close = close
+        if self.bar_count <= self.timeperiod + 1:
+            # The first averages are plain means of timeperiod changes
+            if change < 0:
+                self.loss -= change
+            else:
+                self.gain += change
+            if self.bar_count < self.timeperiod + 1:
+                return (math.nan,)
+            self.loss /= self.timeperiod
+            self.gain /= self.timeperiod
+        else:
+            self.loss *= self.timeperiod - 1
+            self.gain *= self.timeperiod - 1
+            if change < 0:
+                self.loss -= change
+            else:
+                self.gain += change
+            self.loss /= self.timeperiod
+            self.gain /= self.timeperiod
+        total = self.gain + self.loss
+        return (100.0 * (self.gain / total) if not -TA_EPSILON < total < TA_EPSILON else 0.0,)
+
+
+class StreamingOBV:
+    """On Balance Volume, a running total of signed volume."""
+
+    output_names = ['real']
+
+    def __init__(self):
+        self.prev_close = None
+        self.obv = 0.0
+
+    def update(self, open_, high, low, close, volume):
+        if self.prev_close is None:
+            self.obv = volume
+        elif close > self.prev_close:
+            self.obv += volume
+        elif close < self.prev_close:
+            self.obv -= volume
+        self.prev_close = close
+        return (self.obv,)
+
+
+class StreamingATR:
+    """Average True Range with Wilder's smoothing."""
+
+    output_names = ['real']
+
+    def __init__(self, timeperiod=14):
+        check_period('timeperiod', timeperiod, minimum=1)
+        self.timeperiod = timeperiod
+        self.bar_count = 0
+        self.prev_close = None
+        self.atr = 0.0
+
+    def update(self, open_, high, low, close, volume):
+        self.bar_count += 1
+        if self.prev_close is None:
+            self.prev_close = close
+            return (math.nan,)
+        true_range = high - low
+        true_range = max(true_range, abs(self.prev_close - high), abs(self.prev_close - low))
+        self.prev_close = close
+        if self.timeperiod <= 1:
+            return (true_range,)
+        if self.bar_count <= self.timeperiod + 1:
+            # The first ATR is the mean of timeperiod true ranges
+            self.atr += true_range
+            if self.bar_count < self.timeperiod + 1:
+                return (math.nan,)
+            self.atr /= self.timeperiod
+            return (self.atr,)
+        self.atr *= self.timeperiod - 1
+        self.atr += true_range
+        self.atr /= self.timeperiod
+        return (self.atr,)
+
+
+class StreamingBBANDS:
+    """Bollinger Bands around a simple moving average (matype 0)."""
+
+    output_names = ['upperband', 'middleband', 'lowerband']
+
+    def __init__(self, timeperiod=20, nbdevup=2.0, nbdevdn=2.0, matype=0):
+        if matype != 0:
+            raise Exception('Only BBANDS over a simple moving average (matype=0) can be streamed')
+        check_period('timeperiod', timeperiod)
+        self.timeperiod = timeperiod
+        self.nbdevup = nbdevup
+        self.nbdevdn = nbdevdn
+        self.matype = matype
+        # Closes of the last timeperiod bars and their running sums
+        self.closes = deque()
+        self.total = 0.0
+        self.total_squares = 0.0
+
+    def update(self, open_, high, low, close, volume):
+        self.closes.append(close)
+        self.total += close
+        self.total_squares += close * close
+        if len(self.closes) < self.timeperiod:
+            return (math.nan, math.nan, math.nan)
+        middle = self.total / self.timeperiod
+        variance = self.total_squares / self.timeperiod
+        oldest = self.closes.popleft()
+        self.total -= oldest
+        self.total_squares -= oldest * oldest
+        variance -= middle * middle
+        stddev = math.sqrt(variance) if variance >= TA_EPSILON else 0.0
+        return (middle + stddev * self.nbdevup, middle, middle - stddev * self.nbdevdn)
+
+
+class StreamingMACD:
+    """MACD of two exponential moving averages and their signal line.
+
+    Like TA-Lib, each average starts as the simple mean of its first
+    period values, aligned so that both averages start on the same bar.
+    """
+
+    output_names = ['macd', 'macdsignal', 'macdhist']
+
+    def __init__(self, fastperiod=12, slowperiod=26, signalperiod=9):
+        check_period('fastperiod', fastperiod)
+        check_period('slowperiod', slowperiod)
+        check_period('signalperiod', signalperiod, minimum=1)
+        if fastperiod >= slowperiod:
+            raise Exception(f'fastperiod must be less than slowperiod, got {fastperiod} and {slowperiod}')
+        self.fastperiod = fastperiod
+        self.slowperiod = slowperiod
+        self.signalperiod = signalperiod
+        self.bar_count = 0
+        self.macd_count = 0
+        self.fast_ema = 0.0
+        self.slow_ema = 0.0
+        self.signal_ema = 0.0
+
+    def update(self, open_, high, low, close, volume):
+        self.bar_count += 1
+        if self.bar_count <= self.slowperiod:
+            # Seed the slow average with all of its first bars, the fast
+            # average with the last fastperiod of them
+            self.slow_ema += close
+            if self.bar_count > self.slowperiod - self.fastperiod:
+                self.fast_ema += close
+            if self.bar_count < self.slowperiod:
+                return (math.nan, math.nan, math.nan)
+            self.slow_ema /= self.slowperiod
+            self.fast_ema /= self.fastperiod
+        else:
+            self.slow_ema = (close - self.slow_ema) * (2.0 / (self.slowperiod + 1)) + self.slow_ema
+            self.fast_ema = (close - self.fast_ema) * (2.0 / (self.fastperiod + 1)) + self.fast_ema
+        macd = self.fast_ema - self.slow_ema
+        self.macd_count += 1
+        if self.macd_count <= self.signalperiod:
+            self.signal_ema += macd
+            if self.macd_count < self.signalperiod:
+                return (math.nan, math.nan, math.nan)
+            self.signal_ema /= self.signalperiod
+        else:
+            self.signal_ema = (macd - self.signal_ema) * (2.0 / (self.signalperiod + 1)) + self.signal_ema
+        return (macd, self.signal_ema, macd - self.signal_ema)
+
+
+STREAMING_INDICATORS = {
+    'mfi': StreamingMFI,
+    'rsi': StreamingRSI,
+    'obv': StreamingOBV,
+    'atr': StreamingATR,
+    'bbands': StreamingBBANDS,
+    'macd': StreamingMACD,
+}
+
+
+def is_streamable(spec):
+    if spec.name == 'bbands':
+        return spec.parameters['matype'] == 0
+    return spec.name in STREAMING_INDICATORS
+
+
+def state_to_json(state):
+    return json.dumps({
+        key: list(value) if isinstance(value, deque) else value
+        for key, value in vars(state).items()
+    })
+
+
+def state_from_json(spec, state_json):
+    state = STREAMING_INDICATORS[spec.name](**spec.parameters)
+    for key, value in json.loads(state_json).items():
+        if isinstance(getattr(state, key), deque):
+            value = deque(tuple(item) if isinstance(item, list) else item for item in value)
+        setattr(state, key, value)
+    return state
+
+
+class IndicatorStream:
+    """The state of one indicator of one symbol after the last bar of its series.
+
+    Appending a bar costs O(1) regardless of the length of the series.
+    The series itself is stored apart from the state, see IndicatorStreams.
+    """
+
+    def __init__(self, spec, start_date, state=None, next_date=None):
+        self.spec = spec
+        self.start_date = start_date
+        self.state = state or STREAMING_INDICATORS[spec.name](**spec.parameters)
+        # The first date that is not in the series yet
+        self.next_date = next_date or start_date
+
+    def append(self, candle_df):
+        """Return (dates, values) of the bars of candle_df, moving the state past them."""
+        values = run_state(self.state, candle_df)
+        self.next_date = candle_df.index[-1].date() + timedelta(days=1)
+        return candle_df.index.values.astype('datetime64[D]'), values
+
+    def preview(self, candle_df):
+        """Values of bars that are not final yet, without changing the stream."""
+        return run_state(copy.deepcopy(self.state), candle_df)
+
+    def encode(self):
+        out = io.BytesIO()
+        np.savez_compressed(
+            out,
+            start_date=np.int64(self.start_date.toordinal()),
+            next_date=np.int64(self.next_date.toordinal()),
+            state=np.array(state_to_json(self.state))
+        )
+        return out.getvalue()
+
+    @classmethod
+    def decode(cls, spec, data):
+        with np.load(io.BytesIO(data)) as arrays:
+            return cls(
+                spec=spec,
+                start_date=dt_date.fromordinal(int(arrays['start_date'])),
+                state=state_from_json(spec, str(arrays['state'])),
+                next_date=dt_date.fromordinal(int(arrays['next_date']))
+            )
+
+
+def run_state(state, candle_df):
+    # Returns a bars × outputs array of the values after each bar
+    columns = [candle_df[column].to_numpy(dtype='float64').tolist() for column in CANDLE_COLUMNS]
+    values = np.empty((len(candle_df), len(state.output_names)))
+    for i, bar in enumerate(zip(*columns)):
+        values[i] = state.update(*bar)
+    return values
+
+
+def encode_series(dates, values):
+    out = io.BytesIO()
+    np.savez_compressed(out, date=dates.astype('int64'), values=values)
+    return out.getvalue()
+
+
+def decode_series(data, output_count):
+    # Returns (datetime64[D] dates, bars × outputs values)
+    if data is None:
+        return np.array([], dtype='datetime64[D]'), np.empty((0, output_count))
+    with np.load(io.BytesIO(data)) as arrays:
+        return arrays['date'].astype('datetime64[D]'), arrays['values']
+
+
+class IndicatorStreams:
+    """Indicator series kept up to date bar by bar, stored next to the candles.
+
+    A stream starts at the series_start_date of the first request for its
+    symbol and spec, so the first requested bars have values, and serves
+    every later request that starts late enough for the same warm-up.
+    Only the bars after the last stored bar are computed. Bars from today
+    on are not final yet, so they are computed on a copy of the state and
+    not stored. A request that starts earlier rebuilds the stream.
+
+    The state is stored apart from the series, and the series as columns
+    of dates and values in one file per year. A request reads the state
+    and the years it asks for, and appending bars only rewrites the files
+    of their years, so neither depends on the length of the series.
+
+    A stream that started earlier than the warm-up of a request has the same
+    values as one that starts at the warm-up, up to CONVERGENCE_TOLERANCE
+    for the recursive averages of RSI, ATR and MACD. OBV streams always
+    start at HISTORY_START_DATE, so they are never rebuilt.
+    """
+
+    def __init__(self, candle_cache, store=None):
+        self.candle_cache = candle_cache
+        self.store = store or candle_cache.shared_store
+
+    def get_series(self, symbol, spec, start_date, end_date):
+        """Return a DataFrame of the spec's outputs for start_date <= date < end_date."""
+        start_date = dt_date.fromisoformat(str(start_date))
+        end_date = dt_date.fromisoformat(str(end_date))
+        today = datetime.now(timezone.utc).date()
+        name = f'indicators/{symbol}/{spec.key}'
+        data = self.store.load(f'{name}/state')
+        stream = IndicatorStream.decode(spec, data) if data is not None else None
+        series_start_date = spec.series_start_date(start_date)
+        if stream is None or stream.start_date > series_start_date:
+            stream = IndicatorStream(spec, series_start_date)
+
+        preview_df = None
+        written = {}
+        if stream.next_date < end_date:
+            candle_df = self.candle_cache.get_candles([symbol], stream.next_date, end_date)[symbol]
+            is_final = candle_df.index < pd.Timestamp(today)
+            if is_final.any():
+                written = self._append(name, stream, candle_df[is_final])
+            preview_df = candle_df[~is_final]
+
+        dates, values = self._read(name, stream, start_date, min(end_date, stream.next_date), written)
+        if preview_df is not None and not preview_df.empty:
+            dates = np.concatenate([dates, preview_df.index.values.astype('datetime64[D]')])
+            values = np.concatenate([values, stream.preview(preview_df)])
+        series_df = pd.DataFrame(
+            values,
+            index=pd.DatetimeIndex(dates.astype('datetime64[ns]'), name='Date'),
+            columns=stream.state.output_names
+        )
+        return series_df[(series_df.index >= pd.Timestamp(start_date)) & (series_df.index < pd.Timestamp(end_date))]
+
+    def _append(self, name, stream, candle_df):
+        # Returns {year: (dates, values)} of the series files written
+        output_count = len(stream.state.output_names)
+        dates, values = stream.append(candle_df)
+        years = dates.astype('datetime64[Y]').astype('int64') + 1970
+        written = {}
+        for year in np.unique(years).tolist():
+            in_year = years == year
+            year_dates, year_values = decode_series(self.store.load(f'{name}/{year}'), output_count)
+            # Bars from the first new one on are of a replaced stream, or of
+            # a request that failed before it saved the state
+            kept = (year_dates < dates[in_year][0]) & (year_dates >= np.datetime64(stream.start_date, 'D'))
+            year_dates = np.concatenate([year_dates[kept], dates[in_year]])
+            year_values = np.concatenate([year_values[kept], values[in_year]])
+            self.store.save(f'{name}/{year}', encode_series(year_dates, year_values))
+            written[year] = (year_dates, year_values)
+        # The state goes last, so it never points past the stored series
+        self.store.save(f'{name}/state', stream.encode())
+        return written
+
+    def _read(self, name, stream, start_date, end_date, written):
+        # Returns (dates, values) of the stored series for start_date <= date < end_date
+        output_count = len(stream.state.output_names)
+        start_date = max(start_date, stream.start_date)
+        if start_date >= end_date:
+            return decode_series(None, output_count)
+        parts = [
+            written[year] if year in written else decode_series(self.store.load(f'{name}/{year}'), output_count)
+            for year in range(start_date.year, (end_date - timedelta(days=1)).year + 1)
+        ]
+        dates = np.concatenate([part[0] for part in parts])
+        values = np.concatenate([part[1] for part in parts])
+        in_range = (dates >= np.datetime64(start_date, 'D')) & (dates < np.datetime64(end_date, 'D'))
+        return dates[in_range], values[in_range]
@@ -0,0 +1,69 @@
+from datetime import date as dt_date, timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('talib')
+
+from indicator_memo import IndicatorMemo, slice_series  # noqa: E402
+from indicators import IndicatorSpec, compute_indicators  # noqa: E402
+from streaming_indicators import IndicatorStreams  # noqa: E402
+from tests.unit.test_streaming_indicators import FakeCandleCache, random_candles, talib_series  # noqa: E402
+
+SPECS = [
+    ('mfi', {}),
+    ('obv', {}),
+    ('rsi', {}),
+    ('macd', {}),
+    # Not streamable
+    ('bbands', {'matype': 1}),
+]
+REQUESTS = [
+    ('2020-03-02', '2020-09-01'),
+    # A slice of the kept range
+    ('2020-05-01', '2020-06-01'),
+    # Edges before and after the kept range
+    ('2019-11-15', '2020-07-01'),
+    ('2020-02-01', '2021-03-01'),
+    # Apart from the kept range
+    ('2019-06-03', '2019-06-20'),
+]
+
+
+def compute_series(candle_cache, spec, start_date, end_date):
+    # As render_mfi_chart.compute_indicator_series, for one spec
+    candle_df = candle_cache.get_candles(['AAPL'], spec.series_start_date(start_date), end_date)['AAPL']
+    series_df = pd.DataFrame(
+        {output_name: values for _, output_name, values in compute_indicators(candle_df, [spec])},
+        index=candle_df.index
+    )
+    return slice_series(series_df, start_date, end_date)
+
+
+@pytest.mark.parametrize('name, parameters', SPECS)
+@pytest.mark.parametrize('streamed', [False, True])
+def test_memo_matches_talib(name, parameters, streamed):
+    spec = IndicatorSpec(name, parameters)
+    if streamed and name == 'bbands':
+        pytest.skip('BBANDS over an exponential average is not streamable')
+    # Candles from long before the requests, so series start at their
+    # warm-up and only agree with TA-Lib's up to the convergence tolerance
+    candle_df = random_candles('2015-01-01', '2021-06-01', seed=2)
+    candle_cache = FakeCandleCache(candle_df)
+    expected = talib_series(candle_df, spec)
+    memo = IndicatorMemo()
+    for start_date, end_date in REQUESTS:
+        if streamed:
+            compute = lambda range_start, range_end: IndicatorStreams(candle_cache).get_series(  # noqa: E731
+                'AAPL', spec, range_start, range_end
+            )
+        else:
+            compute = lambda range_start, range_end: compute_series(  # noqa: E731
+                candle_cache, spec, range_start, range_end
+            )
+        series_df = memo.get_series('AAPL', spec, start_date, end_date, compute)
+        expected_df = expected[(expected.index >= start_date) & (expected.index < end_date)]
+        pd.testing.assert_index_equal(series_df.index, expected_df.index)
+        np.testing.assert_allclose(series_df.to_numpy(), expected_df.to_numpy(), rtol=1e-9, atol=1e-9, equal_nan=True)
+    assert (memo.hits, memo.extensions, memo.misses) == (1, 2, 2)
@@ -0,0 +1,60 @@
+from datetime import date as dt_date
+
+import numpy as np
+import pytest
+
+pytest.importorskip('talib')
+
+from indicators import CONVERGENCE_TOLERANCE, IndicatorSpec, parse_indicator_specs  # noqa: E402
+from tests.unit.test_streaming_indicators import random_candles, talib_series  # noqa: E402
+
+
+@pytest.mark.parametrize('indicators', [
+    'mfi(timeperiod=0)',
+    'rsi(timeperiod=1)',
+    'rsi(timeperiod=100000)',
+    'atr(timeperiod=0)',
+    'bbands(matype=9)',
+    'macd(signalperiod=0)',
+    'macd(fastperiod=26,slowperiod=12)',
+    'macd(fastperiod=12,slowperiod=12)',
+    'rsi(timeperiod=7.5)',
+])
+def test_parameters_out_of_bounds_are_rejected(indicators):
+    with pytest.raises(Exception):
+        parse_indicator_specs(indicators)
+
+
+def test_parameters_within_bounds_are_accepted():
+    specs = parse_indicator_specs(
+        'atr(timeperiod=1);bbands(timeperiod=5,matype=8);macd(fastperiod=2,slowperiod=1000,signalperiod=1)'
+    )
+    assert [spec.key for spec in specs] == ['atr-1', 'bbands-5-2.0-2.0-8', 'macd-2-1000-1']
+
+
+def test_longest_periods_warm_up_after_1900():
+    spec = IndicatorSpec('macd', {'fastperiod': 999, 'slowperiod': 1000, 'signalperiod': 1000})
+    assert spec.warmup_start_date(dt_date(2024, 1, 2)).year > 1900
+
+
+@pytest.mark.parametrize('name, parameters', [
+    ('mfi', {}),
+    ('rsi', {}),
+    ('rsi', {'timeperiod': 2}),
+    ('atr', {}),
+    ('macd', {}),
+    ('macd', {'fastperiod': 2, 'slowperiod': 3, 'signalperiod': 40}),
+] + [('bbands', {'timeperiod': 20, 'matype': matype}) for matype in range(9)])
+def test_warmup_converges_to_the_full_history(name, parameters):
+    spec = IndicatorSpec(name, parameters)
+    candle_df = random_candles('1995-01-01', '2024-01-01', seed=3)
+    start_date = dt_date(2023, 1, 3)
+    expected = talib_series(candle_df, spec)
+    series_df = talib_series(candle_df[candle_df.index >= str(spec.series_start_date(start_date))], spec)
+    # RSI and MFI are 0..100, the others are on the scale of the prices
+    scale = 100 if name in ['mfi', 'rsi'] else candle_df['close'].max()
+    np.testing.assert_allclose(
+        series_df[series_df.index >= str(start_date)].to_numpy(),
+        expected[expected.index >= str(start_date)].to_numpy(),
+        rtol=0, atol=CONVERGENCE_TOLERANCE * scale
+    )
@@ -0,0 +1,130 @@
+from datetime import date as dt_date
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('talib')
+
+from indicators import IndicatorSpec, compute_indicators  # noqa: E402
+from streaming_indicators import IndicatorStream, IndicatorStreams  # noqa: E402
+
+STREAMED_SPECS = [
+    ('mfi', {}),
+    ('mfi', {'timeperiod': 5}),
+    ('rsi', {}),
+    ('rsi', {'timeperiod': 7}),
+    ('obv', {}),
+    ('atr', {}),
+    ('atr', {'timeperiod': 1}),
+    ('bbands', {}),
+    ('bbands', {'timeperiod': 10, 'nbdevup': 1.5, 'nbdevdn': 3}),
+    ('macd', {}),
+    ('macd', {'fastperiod': 5, 'slowperiod': 35, 'signalperiod': 5}),
+]
+
+
+def random_candles(start_date, end_date, seed=0):
+    rng = np.random.default_rng(seed)
+    index = pd.bdate_range(start_date, end_date, inclusive='left', name='Date')
+    # Prices in quarters, so some closes don't change, and prices that tie are
+    # exactly equal in floating point, not only up to rounding
+    close = np.round(4 * 100 * np.exp(np.cumsum(rng.normal(0, 0.02, len(index))))) / 4
+    open_ = np.round(4 * close * np.exp(rng.normal(0, 0.01, len(index)))) / 4
+    return pd.DataFrame({
+        'open': open_,
+        'high': np.maximum(open_, close) + np.round(4 * rng.uniform(0, 2, len(index))) / 4,
+        'low': np.minimum(open_, close) - np.round(4 * rng.uniform(0, 2, len(index))) / 4,
+        'close': close,
+        'volume': rng.integers(1000, 10 ** 7, len(index)).astype('float64'),
+    }, index=index)
+
+
+def talib_series(candle_df, spec):
+    # The outputs of one TA-Lib run over all of candle_df
+    return pd.DataFrame(
+        {output_name: values for _, output_name, values in compute_indicators(candle_df, [spec])},
+        index=candle_df.index
+    )
+
+
+class MemoryStore:
+    def __init__(self):
+        self.files = {}
+
+    def load(self, name):
+        return self.files.get(name)
+
+    def save(self, name, data):
+        self.files[name] = data
+
+
+class FakeCandleCache:
+    def __init__(self, candle_df):
+        self.candle_df = candle_df
+        self.shared_store = MemoryStore()
+        self.requests = []
+
+    def get_candles(self, symbols, start_date, end_date):
+        self.requests.append((start_date, end_date))
+        index = self.candle_df.index
+        in_range = (index >= pd.Timestamp(start_date)) & (index < pd.Timestamp(end_date))
+        return {symbol: self.candle_df[in_range] for symbol in symbols}
+
+
+@pytest.mark.parametrize('name, parameters', STREAMED_SPECS)
+def test_stream_matches_talib(name, parameters):
+    spec = IndicatorSpec(name, parameters)
+    candle_df = random_candles('2020-01-01', '2022-01-01')
+    stream = IndicatorStream(spec, dt_date(2020, 1, 1))
+    parts = []
+    # The state goes through its stored form between the parts
+    for part_start, part_end in [(0, 1), (1, 40), (40, 300), (300, len(candle_df))]:
+        _, values = stream.append(candle_df.iloc[part_start:part_end])
+        parts.append(values)
+        stream = IndicatorStream.decode(spec, stream.encode())
+    expected = talib_series(candle_df, spec)
+    np.testing.assert_allclose(np.concatenate(parts), expected.to_numpy(), rtol=1e-9, atol=1e-9, equal_nan=True)
+
+
+@pytest.mark.parametrize('name, parameters', STREAMED_SPECS)
+def test_stream_requests_match_talib(name, parameters):
+    spec = IndicatorSpec(name, parameters)
+    candle_df = random_candles('2019-06-03', '2023-01-01', seed=1)
+    candle_cache = FakeCandleCache(candle_df)
+    expected = talib_series(candle_df, spec)
+    requests = [
+        ('2019-09-02', '2020-03-02'),
+        # Crosses the end of a year
+        ('2019-09-02', '2021-07-15'),
+        ('2020-05-01', '2023-01-01'),
+        # Inside the stored series
+        ('2019-10-01', '2020-01-10'),
+    ]
+    for start_date, end_date in requests:
+        # A new instance per request, as in a new Lambda container
+        series_df = IndicatorStreams(candle_cache).get_series('AAPL', spec, start_date, end_date)
+        expected_df = expected[(expected.index >= start_date) & (expected.index < end_date)]
+        pd.testing.assert_index_equal(series_df.index, expected_df.index)
+        np.testing.assert_allclose(series_df.to_numpy(), expected_df.to_numpy(), rtol=1e-9, atol=1e-9, equal_nan=True)
+    # Later requests only fetched the days after the last stored bar, and
+    # the one inside the stored series fetched nothing
+    assert [request[0] for request in candle_cache.requests[1:]] == [dt_date(2020, 2, 29), dt_date(2021, 7, 15)]
+
+
+@pytest.mark.parametrize('name, parameters', [
+    ('mfi', {'timeperiod': 0}),
+    ('rsi', {'timeperiod': 1}),
+    ('atr', {'timeperiod': 0}),
+    ('bbands', {'timeperiod': 1}),
+    ('macd', {'fastperiod': 26, 'slowperiod': 12}),
+    ('macd', {'signalperiod': 0}),
+])
+def test_stream_rejects_parameters_out_of_bounds(name, parameters):
+    spec = IndicatorSpec(name)
+    # As if the spec had skipped the checks of IndicatorSpec
+    spec.parameters.update(parameters)
+    candle_cache = FakeCandleCache(random_candles('2020-01-01', '2021-01-01'))
+    with pytest.raises(Exception, match='must be'):
+        IndicatorStreams(candle_cache).get_series('AAPL', spec, '2020-06-01', '2021-01-01')
+    assert candle_cache.shared_store.files == {}